@@ -1,12 +1,50 @@
 import streamlit as st
-import random
+import streamlit.components.v1 as components
+import html
 import time
 import os
 import json
 import uuid
-import threading
-import redis
-from datetime import datetime
+import hmac
+import hashlib
+from collections import deque, defaultdict
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from utils.redis_client import (
+    get_redis_client,
+    get_chat_service,
+    create_chatroom,
+    get_chatroom_by_code,
+    join_request,
+    get_pending_requests,
+    approve_requests,
+    reject_requests,
+    send_message,
+    send_attachment,
+    get_attachment,
+    issue_room_token,
+    get_message_snapshot,
+    leave_chatroom,
+    close_chatroom,
+    export_transcript,
+    get_presence,
+    busiest_rooms,
+    room_counts,
+    room_directory,
+    reap_idle_rooms,
+    MessageTooLarge,
+    RoomClosed,
+    TRANSCRIPT_FORMATS
+)
+from utils.ui_elements import render_message_html, get_render_cache
+from utils.event_dispatcher import get_event_dispatcher
+from utils.presence import PresenceTracker
+from utils.attachments import prepare_attachment, AttachmentError, IMAGE_FORMATS
+from utils.rerun_scheduler import get_rerun_scheduler
+from utils.metrics import start_metrics_server, track_session, forget_session, DELIVERY_SECONDS
+from utils.profiling import profiled, set_current_room, set_current_session
+from utils.debug_panel import start_debug_run, finish_debug_run
+from components.join import waiting_room
 
 # Set page config
 st.set_page_config(
@@ -16,51 +54,84 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+# Query parameter values that select a performance mode
+LOW_POWER_MODES = ("low", "lite", "low-power")
+FULL_POWER_MODES = ("full", "high")
+
+# Public URL of the HTTP gateway; transcripts are streamed from it when set
+GATEWAY_URL = os.getenv("GATEWAY_URL", "").rstrip("/")
+
+# Largest transcript built in memory for download when there is no gateway
+INAPP_TRANSCRIPT_MAX_BYTES = int(os.getenv("INAPP_TRANSCRIPT_MAX_BYTES", str(5 * 1024 * 1024)))
+
+# Seconds after a send in which submitting the same message again counts as a
+# double submit rather than a new message
+DOUBLE_SUBMIT_SECONDS = 5
+
+# Token that unlocks the operator page (?view=operator&token=...); unset disables it
+OPERATOR_TOKEN = os.getenv("OPERATOR_TOKEN", "")
+
+def operator_authorized():
+    """Whether the URL carries the operator token (?token=...)"""
+    token = st.query_params.get("token", "")
+    return bool(OPERATOR_TOKEN) and hmac.compare_digest(token.encode("utf-8"), OPERATOR_TOKEN.encode("utf-8"))
+
+def detect_performance_mode():
+    """Pick 'full' or 'low' render mode from the query string or device hints"""
+    # An explicit ?perf=low / ?perf=full always wins
+    requested = st.query_params.get("perf", "").lower()
+    if requested in LOW_POWER_MODES:
+        return "low"
+    if requested in FULL_POWER_MODES:
+        return "full"
+    
+    # Otherwise fall back to client hints sent by the browser
+    try:
+        headers = st.context.headers
+    except AttributeError:
+        return "full"
+    
+    if headers.get("Save-Data", "").lower() == "on":
+        return "low"
+    if headers.get("Sec-CH-UA-Mobile", "") == "?1":
+        return "low"
+    user_agent = headers.get("User-Agent", "")
+    if "Mobi" in user_agent or "Android" in user_agent:
+        return "low"
+    
+    return "full"
+
+# Serve /metrics on METRICS_PORT (no-op when metrics are disabled)
+start_metrics_server()
+
 # Initialize session state
 if "page" not in st.session_state:
     st.session_state.page = "home"
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
+if "debug" not in st.session_state:
+    # Debug overlays are enabled with ?debug=1 or CHAT_DEBUG=1
+    st.session_state.debug = st.query_params.get("debug") == "1" or os.getenv("CHAT_DEBUG") == "1"
+if "debug_panel" not in st.session_state:
+    # The debug panel shows server internals, so it also needs the operator token
+    st.session_state.debug_panel = st.session_state.debug and operator_authorized()
+
+# Account (and optionally profile) this rerun for the debug panel
+debug_run = start_debug_run()
+
+# Attribute slow operations in this rerun to the session and its room
+set_current_room(st.session_state.get("room_id"))
+set_current_session(st.session_state.session_id)
+if "performance_mode" not in st.session_state:
+    st.session_state.performance_mode = detect_performance_mode()
 if "transition_effect" not in st.session_state:
-    st.session_state.transition_effect = True
+    # Page transition scripts are skipped in low-power mode
+    st.session_state.transition_effect = st.session_state.performance_mode == "full"
 if "new_messages" not in st.session_state:
     st.session_state.new_messages = []
 if "new_requests" not in st.session_state:
     st.session_state.new_requests = []
 
-# Redis Configuration
-# Key prefixes for different data types
-CHATROOM_PREFIX = "chatroom:"
-MESSAGE_PREFIX = "message:"
-REQUEST_PREFIX = "request:"
-
-# Chatroom expiration time (24 hours)
-CHATROOM_EXPIRY = 60 * 60 * 24
-
-# Redis client singleton
-@st.cache_resource
-def get_redis_client():
-    """Initialize and return Redis client"""
-    # Try to get from environment variables
-    redis_url = os.getenv("REDIS_URL")
-    redis_password = os.getenv("REDIS_PASSWORD")
-    
-    # If not found, try to get from Streamlit secrets
-    if not redis_url:
-        try:
-            redis_url = st.secrets["REDIS_URL"]
-            redis_password = st.secrets.get("REDIS_PASSWORD", None)
-        except:
-            # Default to localhost for development
-            redis_url = "redis://localhost:6379"
-            redis_password = None
-    
-    # Connect to Redis
-    if redis_password:
-        client = redis.from_url(redis_url, password=redis_password)
-    else:
-        client = redis.from_url(redis_url)
-    
-    return client
-
 # Enhanced styling with inline CSS - no external files needed
 st.markdown("""
 <style>
@@ -676,7 +747,11 @@ input[type="text"] {
     margin-bottom: 10px;
 }
 </style>
+""", unsafe_allow_html=True)
 
+if st.session_state.performance_mode == "full":
+    # Animated overlays and effect timers
+    st.markdown("""
 <!-- Dynamic background effects -->
 <div class="scanline"></div>
 <div class="tracking-line" style="top: 30%;"></div>
@@ -745,6 +820,20 @@ window.addEventListener('load', function() {
 });
 </script>
 """, unsafe_allow_html=True)
+else:
+    # Low-power mode: no overlays, no animations and no polling timers
+    st.markdown("""
+<style>
+*, *::before, *::after {
+    animation: none !important;
+    transition: none !important;
+}
+
+body::before {
+    display: none;
+}
+</style>
+""", unsafe_allow_html=True)
 
 # Create footer
 st.markdown(
@@ -756,323 +845,177 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-# ----- Redis Database Operations -----
-
-def create_chatroom(name, host_name):
-    """Create a new chatroom and return its code and ID"""
-    client = get_redis_client()
-    
-    # Generate a random 5-digit code
-    code = str(random.randint(10000, 99999))
-    
-    # Generate a unique ID
-    room_id = str(uuid.uuid4())
-    
-    # Create chatroom data
-    chatroom_data = {
-        "id": room_id,
-        "name": name,
-        "code": code,
-        "host_name": host_name,
-        "is_active": True,
-        "created_at": datetime.now().isoformat()
-    }
-    
-    # Store in Redis with expiration
-    key = f"{CHATROOM_PREFIX}{room_id}"
-    client.set(key, json.dumps(chatroom_data))
-    client.expire(key, CHATROOM_EXPIRY)
-    
-    # Also create a lookup by code
-    client.set(f"{CHATROOM_PREFIX}code:{code}", room_id)
-    client.expire(f"{CHATROOM_PREFIX}code:{code}", CHATROOM_EXPIRY)
-    
-    return {
-        "success": True,
-        "code": code,
-        "id": room_id
-    }
-
-def get_chatroom_by_code(code):
-    """Retrieve a chatroom by its code"""
-    client = get_redis_client()
-    
-    # Get room ID from code
-    room_id = client.get(f"{CHATROOM_PREFIX}code:{code}")
-    
-    if not room_id:
-        return {
-            "success": False,
-            "error": "Chatroom not found or inactive"
-        }
-    
-    room_id = room_id.decode('utf-8')
-    
-    # Get chatroom data
-    chatroom_data = client.get(f"{CHATROOM_PREFIX}{room_id}")
-    
-    if not chatroom_data:
-        return {
-            "success": False,
-            "error": "Chatroom not found or inactive"
-        }
-    
-    chatroom = json.loads(chatroom_data)
-    
-    # Check if active
-    if not chatroom.get("is_active", False):
-        return {
-            "success": False,
-            "error": "Chatroom is inactive"
-        }
-    
-    return {
-        "success": True,
-        "chatroom": chatroom
-    }
-
-def join_request(chatroom_id, username):
-    """Create a join request for a user"""
-    client = get_redis_client()
-    
-    # Generate a unique request ID
-    request_id = str(uuid.uuid4())
-    
-    # Create request data
-    request_data = {
-        "id": request_id,
-        "chatroom_id": chatroom_id,
-        "username": username,
-        "status": "pending",  # pending, approved, rejected
-        "created_at": datetime.now().isoformat()
-    }
-    
-    # Store in Redis with expiration (30 minutes)
-    key = f"{REQUEST_PREFIX}{request_id}"
-    client.set(key, json.dumps(request_data))
-    client.expire(key, 60 * 30)  # 30 minutes expiry
-    
-    # Add to pending requests list for this chatroom
-    client.sadd(f"{REQUEST_PREFIX}pending:{chatroom_id}", request_id)
-    
-    # Publish event for real-time updates
-    client.publish(f"join-requests:{chatroom_id}", json.dumps({
-        "type": "new_request",
-        "request_id": request_id,
-        "username": username
-    }))
-    
-    return {
-        "success": True,
-        "request_id": request_id
-    }
-
-def get_pending_requests(chatroom_id):
-    """Get all pending join requests for a chatroom"""
-    client = get_redis_client()
-    
-    # Get all pending request IDs for this chatroom
-    request_ids = client.smembers(f"{REQUEST_PREFIX}pending:{chatroom_id}")
-    
-    if not request_ids:
-        return []
-    
-    # Get request data for each ID
-    requests = []
-    for req_id in request_ids:
-        req_id = req_id.decode('utf-8')
-        request_data = client.get(f"{REQUEST_PREFIX}{req_id}")
-        if request_data:
-            requests.append(json.loads(request_data))
-    
-    return requests
-
-def update_request_status(request_id, status):
-    """Update the status of a join request"""
-    client = get_redis_client()
-    
-    # Get request data
-    request_data = client.get(f"{REQUEST_PREFIX}{request_id}")
-    
-    if not request_data:
-        return None
-    
-    request = json.loads(request_data)
-    
-    # Update status
-    request["status"] = status
-    client.set(f"{REQUEST_PREFIX}{request_id}", json.dumps(request))
-    
-    # If approved or rejected, remove from pending
-    if status in ["approved", "rejected"]:
-        client.srem(f"{REQUEST_PREFIX}pending:{request['chatroom_id']}", request_id)
-    
-    # Publish event for real-time updates
-    client.publish(f"join-requests:{request['chatroom_id']}", json.dumps({
-        "type": "status_update",
-        "request_id": request_id,
-        "username": request["username"],
-        "status": status
-    }))
-    
-    return request
+# ----- Real-time Subscription Helpers -----
 
-def send_message(chatroom_id, username, content, message_type="user"):
-    """Send a message to a chatroom"""
-    client = get_redis_client()
-    
-    # Generate a unique message ID
-    message_id = str(uuid.uuid4())
-    
-    # Create message data
-    message_data = {
-        "id": message_id,
-        "chatroom_id": chatroom_id,
-        "username": username,
-        "content": content,
-        "type": message_type,
-        "created_at": datetime.now().isoformat()
-    }
-    
-    # Store in Redis with expiration (same as chatroom)
-    key = f"{MESSAGE_PREFIX}{message_id}"
-    client.set(key, json.dumps(message_data))
-    client.expire(key, CHATROOM_EXPIRY)
-    
-    # Add to messages list for this chatroom
-    client.rpush(f"{MESSAGE_PREFIX}list:{chatroom_id}", message_id)
-    
-    # Publish event for real-time updates
-    client.publish(f"messages:{chatroom_id}", json.dumps(message_data))
-    
-    return message_data
+# Number of recent delivery lag samples kept per session for the overlay
+LAG_SAMPLES = 50
 
-def get_messages(chatroom_id, limit=50):
-    """Get messages for a chatroom"""
-    client = get_redis_client()
-    
-    # Get the last 'limit' message IDs
-    message_ids = client.lrange(f"{MESSAGE_PREFIX}list:{chatroom_id}", -limit, -1)
-    
-    if not message_ids:
-        return []
-    
-    # Get message data for each ID
-    messages = []
-    for msg_id in message_ids:
-        msg_id = msg_id.decode('utf-8')
-        message_data = client.get(f"{MESSAGE_PREFIX}{msg_id}")
-        if message_data:
-            messages.append(json.loads(message_data))
-    
-    # Sort by created_at
-    messages.sort(key=lambda x: x["created_at"])
-    
-    return messages
+def receive_event(message):
+    """Decode a pub/sub event and record its publish-to-receive lag"""
+    data = json.loads(message["data"])
+    data["received_at"] = time.time()
+    if "published_at" in data:
+        DELIVERY_SECONDS.observe("publish_to_receive", value=data["received_at"] - data["published_at"])
+    return data
 
-def close_chatroom(chatroom_id):
-    """Mark a chatroom as inactive"""
-    client = get_redis_client()
-    
-    # Get chatroom data
-    chatroom_data = client.get(f"{CHATROOM_PREFIX}{chatroom_id}")
-    
-    if not chatroom_data:
-        return None
-    
-    chatroom = json.loads(chatroom_data)
-    
-    # Update active status
-    chatroom["is_active"] = False
-    client.set(f"{CHATROOM_PREFIX}{chatroom_id}", json.dumps(chatroom))
-    
-    # Publish event for real-time updates
-    client.publish(f"chatroom:{chatroom_id}", json.dumps({
-        "type": "closed"
-    }))
-    
-    return chatroom
+@st.cache_resource
+def get_dispatcher():
+    """Return the process's event dispatcher, evicting caches of closed rooms"""
+    dispatcher = get_event_dispatcher()
+    dispatcher.add_close_hook(get_render_cache().evict_room)
+    dispatcher.add_close_hook(evict_thumbnails)
+    return dispatcher
+
+def session_connected(runtime_session_id):
+    """Whether a Streamlit session still has a browser connected"""
+    # Without a runtime (e.g. under AppTest) there is nothing to check against
+    if runtime_session_id is None or not Runtime.exists():
+        return True
+    return Runtime.instance().is_active_session(runtime_session_id)
 
-# ----- Real-time Subscription Helpers -----
+@st.cache_resource
+def get_presence_tracker():
+    """Return the process's presence tracker, which drops disconnected sessions"""
+    return PresenceTracker(get_chat_service(), is_alive=session_connected)
 
 def start_message_listener(chatroom_id):
-    """Start a thread to listen for new messages"""
+    """Listen for new messages and for the room being closed"""
     # Skip if already listening
     if hasattr(st.session_state, 'message_listener_started') and st.session_state.message_listener_started:
         return
     
+    # Listener callbacks have no script context, so hand them the session's
+    # queue and rerun scheduler directly
+    queue = st.session_state.new_messages
+    scheduler = get_rerun_scheduler()
+    
     # Create a thread-safe callback
     def thread_safe_callback(message):
         try:
-            data = json.loads(message["data"])
-            st.session_state.new_messages.append(data)
+            data = receive_event(message)
+            queue.append(data)
+            scheduler.notify()
         except Exception as e:
             print(f"Error processing message: {e}")
     
-    # Create and start thread
-    def listen_for_messages():
-        client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
-        pubsub = client.pubsub()
-        
-        # Subscribe to messages channel
-        pubsub.subscribe(**{f"messages:{chatroom_id}": thread_safe_callback})
-        
-        # Listen for messages
-        pubsub.run_in_thread(sleep_time=0.01)
-    
-    # Start thread
-    thread = threading.Thread(target=listen_for_messages, daemon=True)
-    thread.start()
+    # One process-wide connection delivers the events of every session; a
+    # closed event also wakes the session so it leaves the room
+    dispatcher = get_dispatcher()
+    dispatcher.subscribe(f"messages:{chatroom_id}", st.session_state.session_id, thread_safe_callback)
+    dispatcher.subscribe(f"chatroom:{chatroom_id}", st.session_state.session_id, thread_safe_callback)
     
     # Mark as started
     st.session_state.message_listener_started = True
 
 def start_request_listener(chatroom_id):
-    """Start a thread to listen for new join requests"""
+    """Listen for new join requests"""
     # Skip if already listening
     if hasattr(st.session_state, 'request_listener_started') and st.session_state.request_listener_started:
         return
     
+    # Listener callbacks have no script context, so hand them the session's
+    # queue and rerun scheduler directly
+    queue = st.session_state.new_requests
+    scheduler = get_rerun_scheduler()
+    
     # Create a thread-safe callback
     def thread_safe_callback(message):
         try:
-            data = json.loads(message["data"])
-            st.session_state.new_requests.append(data)
+            data = receive_event(message)
+            queue.append(data)
+            scheduler.notify()
         except Exception as e:
             print(f"Error processing request: {e}")
     
-    # Create and start thread
-    def listen_for_requests():
-        client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
-        pubsub = client.pubsub()
-        
-        # Subscribe to join requests channel
-        pubsub.subscribe(**{f"join-requests:{chatroom_id}": thread_safe_callback})
-        
-        # Listen for messages
-        pubsub.run_in_thread(sleep_time=0.01)
-    
-    # Start thread
-    thread = threading.Thread(target=listen_for_requests, daemon=True)
-    thread.start()
+    get_dispatcher().subscribe(f"join-requests:{chatroom_id}", st.session_state.session_id, thread_safe_callback)
     
     # Mark as started
     st.session_state.request_listener_started = True
 
-def check_for_updates():
-    """Process any updates from background threads"""
-    # Check for new messages
-    if st.session_state.new_messages:
-        # Trigger a rerun to update the UI
-        st.rerun()
+def record_render_lag(snapshot_seq):
+    """
+    Record receive-to-render lag for the events this run is displaying
     
-    # Check for new join requests
-    if st.session_state.new_requests:
-        # Trigger a rerun to update the UI
-        st.rerun()
+    snapshot_seq is the seq of the snapshot this run rendered; it is where
+    gap counting starts when the session enters a room.
+    """
+    rendered_at = time.time()
+    if "last_seq" not in st.session_state:
+        st.session_state.last_seq = snapshot_seq
+    samples = st.session_state.setdefault("lag_samples", deque(maxlen=LAG_SAMPLES))
+    
+    for event in get_rerun_scheduler().take_delivered():
+        if "received_at" not in event:
+            continue
+        
+        receive_to_render = rendered_at - event["received_at"]
+        DELIVERY_SECONDS.observe("receive_to_render", value=receive_to_render)
+        
+        # A jump in the message sequence means events were missed
+        seq = event.get("seq")
+        last_seq = st.session_state.get("last_seq")
+        if seq is not None:
+            if last_seq is not None and seq > last_seq + 1:
+                st.session_state.seq_gaps = st.session_state.get("seq_gaps", 0) + seq - last_seq - 1
+            st.session_state.last_seq = max(seq, last_seq or 0)
+        
+        samples.append({
+            "seq": seq,
+            "publish_to_receive": event["received_at"] - event["published_at"] if "published_at" in event else None,
+            "receive_to_render": receive_to_render
+        })
+
+def display_lag_overlay():
+    """Show recent real-time delivery lag in a corner overlay (debug only)"""
+    samples = st.session_state.get("lag_samples")
+    if not samples:
+        summary = "NO EVENTS YET"
+    else:
+        def median_ms(stage):
+            values = sorted(sample[stage] for sample in samples if sample[stage] is not None)
+            return f"{values[len(values) // 2] * 1000:.0f}ms" if values else "-"
+        
+        summary = (
+            f"PUB&rarr;RECV {median_ms('publish_to_receive')} | "
+            f"RECV&rarr;RENDER {median_ms('receive_to_render')} | "
+            f"SEQ {st.session_state.get('last_seq', '-')} | "
+            f"GAPS {st.session_state.get('seq_gaps', 0)}"
+        )
+    
+    st.markdown(
+        f"""
+        <div style="position: fixed; top: 10px; right: 10px; z-index: 1000; background-color: rgba(0, 0, 0, 0.85); border: 1px solid #adff2f; padding: 5px 10px; font-size: 12px; color: #adff2f;">
+            LAG (MEDIAN OF {len(samples or [])}): {summary}
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+
+def autoscroll_chat():
+    """Keep the chat scrolled to the newest message (low-power mode)"""
+    # st.markdown never runs scripts, so the observer runs in a zero-height
+    # component frame and watches the app page that embeds it
+    components.html(
+        """
+        <script>
+        const chat = window.parent.document.querySelector('.st-key-chat_messages');
+        if (chat) {
+            // Scroll only when messages are added rather than on a timer
+            const observer = new MutationObserver(() => {
+                chat.scrollTop = chat.scrollHeight;
+            });
+            observer.observe(chat, { childList: true, subtree: true });
+            window.addEventListener('pagehide', () => observer.disconnect());
+            chat.scrollTop = chat.scrollHeight;
+        }
+        </script>
+        """,
+        height=0
+    )
 
 # ----- Application Pages -----
 
+@profiled("home")
 def home_page():
     """Home page with options to host or join"""
     # Initialize Redis on app startup
@@ -1149,6 +1092,7 @@ def home_page():
                 st.session_state.page = "join"
                 st.rerun()
 
+@profiled("host")
 def host_chatroom():
     """Host a new chatroom interface"""
     st.markdown("<h1 class='rainbow-text'>HOST A CHATROOM</h1>", unsafe_allow_html=True)
@@ -1194,9 +1138,6 @@ def host_chatroom():
             # Create chatroom in Redis
             result = create_chatroom(room_name, host_name)
             
-            # Add some delay for effect
-            time.sleep(1.5)
-            
             if result["success"]:
                 # Store chatroom info in session state - FIXED KEYS
                 st.session_state.room_code = result["code"]
@@ -1236,6 +1177,7 @@ def host_chatroom():
         st.session_state.page = "home"
         st.rerun()
 
+@profiled("join")
 def join_chatroom():
     """Interface for joining an existing chatroom"""
     st.markdown("<h1 class='rainbow-text'>JOIN A CHATROOM</h1>", unsafe_allow_html=True)
@@ -1248,6 +1190,10 @@ def join_chatroom():
         unsafe_allow_html=True
     )
     
+    # Show why a previous join attempt ended
+    if "join_error" in st.session_state:
+        st.error(st.session_state.pop("join_error"))
+    
     # Input fields for room code and username - FIXED KEYS
     st.markdown('<p class="cyan-text text-flicker" style="margin-top: 30px;">ENTER ACCESS CREDENTIALS:</p>', unsafe_allow_html=True)
     
@@ -1280,38 +1226,42 @@ def join_chatroom():
         # Get chatroom from Redis
         result = get_chatroom_by_code(room_code)
         
-        # Add some delay for effect
-        time.sleep(1.5)
-        
         if result["success"]:
             chatroom = result["chatroom"]
             
-            # Host approves automatically for this version
-            # In a full version, you would wait for host approval
-            
-            # Store info in session state - FIXED KEYS
-            st.session_state.room_code = room_code
-            st.session_state.room_id = chatroom["id"]
-            st.session_state.username = username
-            st.session_state.current_room_name = chatroom["name"]  # Changed key here
-            st.session_state.is_host = False
-            st.session_state.page = "chat"
+            # One idempotency key per join action, so double clicks and
+            # interrupted reruns don't create duplicate requests
+            if "join_action_key" not in st.session_state:
+                st.session_state.join_action_key = str(uuid.uuid4())
             
-            # Send a system message about new user joining
-            send_message(chatroom["id"], "SYSTEM", f"{username} has joined the chatroom", "system")
+            # Ask the host for approval
+            request_result = join_request(chatroom["id"], username, st.session_state.join_action_key)
             
-            # Add page transition effect
-            if st.session_state.transition_effect:
-                st.markdown(
-                    """
-                    <script>
-                    addPageTransitionEffects();
-                    </script>
-                    """,
-                    unsafe_allow_html=True
-                )
-            
-            st.rerun()
+            if request_result["success"]:
+                del st.session_state.join_action_key
+                
+                # Store request info in session state and wait for the host
+                st.session_state.pending_request_id = request_result["request_id"]
+                st.session_state.pending_room_id = chatroom["id"]
+                st.session_state.pending_room_name = chatroom["name"]
+                st.session_state.pending_room_code = room_code
+                st.session_state.pending_username = username
+                st.session_state.page = "waiting"
+                
+                # Add page transition effect
+                if st.session_state.transition_effect:
+                    st.markdown(
+                        """
+                        <script>
+                        addPageTransitionEffects();
+                        </script>
+                        """,
+                        unsafe_allow_html=True
+                    )
+                
+                st.rerun()
+            else:
+                st.error(f"Error joining chatroom: {request_result.get('error', 'Unknown error')}")
         else:
             st.error(f"Error joining chatroom: {result.get('error', 'Invalid room code or room is inactive')}")
     
@@ -1330,6 +1280,7 @@ def join_chatroom():
         st.session_state.page = "home"
         st.rerun()
 
+@profiled("chat")
 def chat_interface():
     """Enhanced chat interface with Redis integration"""
     # Check if user is in a room
@@ -1338,10 +1289,44 @@ def chat_interface():
         st.rerun()
         return
     
-    # Start real-time listeners
+    # A closed room is left before anything of it is fetched again. Only
+    # closes seen live are known to the dispatcher, so a session entering the
+    # room (or subscribing again) also checks the room's record
     room_id = st.session_state.room_id
+    dispatcher = get_dispatcher()
+    if st.session_state.get("message_listener_started", False):
+        closed = dispatcher.is_closed(room_id)
+    else:
+        closed = dispatcher.check_closed(room_id)
+    if closed:
+        leave_room_state()
+        st.session_state.page = "closed"
+        st.rerun()
+        return
+    
+    # Take the events this run displays; bursts of messages and join requests
+    # arriving later are coalesced into one rerun by the scheduler's timer
+    get_rerun_scheduler().deliver(st.session_state.new_messages, st.session_state.new_requests)
+    
+    # Start real-time listeners
     start_message_listener(room_id)
     
+    # Count this session as active in the room
+    track_session(
+        st.session_state.session_id,
+        room_id,
+        (st.session_state.new_messages, st.session_state.new_requests)
+    )
+    
+    # Keep the user marked online until they leave or disconnect
+    ctx = get_script_run_ctx()
+    get_presence_tracker().track(
+        st.session_state.session_id,
+        room_id,
+        st.session_state.username,
+        ctx.session_id if ctx else None
+    )
+    
     if st.session_state.get("is_host", False):
         start_request_listener(room_id)
     
@@ -1380,6 +1365,7 @@ def chat_interface():
     # Side controls
     with col2:
         st.markdown('<div style="height: 20px;"></div>', unsafe_allow_html=True)
+        display_presence(room_id)
         if st.button("REFRESH", key="refresh_btn"):
             st.rerun()
         
@@ -1387,33 +1373,7 @@ def chat_interface():
             exit_chat()
             
             # Add exit effect
-            st.markdown(
-                """
-                <script>
-                // More dramatic transition for exit
-                let container = document.createElement('div');
-                container.style.position = 'fixed';
-                container.style.top = '0';
-                container.style.left = '0';
-                container.style.width = '100%';
-                container.style.height = '100%';
-                container.style.backgroundColor = 'black';
-                container.style.zIndex = '9999';
-                container.classList.add('crt-off');
-                document.body.appendChild(container);
-                </script>
-                """,
-                unsafe_allow_html=True
-            )
-            
-            st.rerun()
-        
-        if is_host:
-            st.markdown('<div style="height: 20px;"></div>', unsafe_allow_html=True)
-            if st.button("CLOSE CHATROOM", key="close_btn"):
-                close_chat()
-                
-                # Add exit effect 
+            if st.session_state.transition_effect:
                 st.markdown(
                     """
                     <script>
@@ -1432,16 +1392,47 @@ def chat_interface():
                     """,
                     unsafe_allow_html=True
                 )
+            
+            st.rerun()
+        
+        if is_host:
+            st.markdown('<div style="height: 20px;"></div>', unsafe_allow_html=True)
+            if st.button("CLOSE CHATROOM", key="close_btn"):
+                close_chat()
+                
+                # Add exit effect
+                if st.session_state.transition_effect:
+                    st.markdown(
+                        """
+                        <script>
+                        // More dramatic transition for exit
+                        let container = document.createElement('div');
+                        container.style.position = 'fixed';
+                        container.style.top = '0';
+                        container.style.left = '0';
+                        container.style.width = '100%';
+                        container.style.height = '100%';
+                        container.style.backgroundColor = 'black';
+                        container.style.zIndex = '9999';
+                        container.classList.add('crt-off');
+                        document.body.appendChild(container);
+                        </script>
+                        """,
+                        unsafe_allow_html=True
+                    )
                 
                 st.rerun()
+            
+            display_transcript_export(room_id)
     
     # Main chat area
     with col1:
         # Create a container for the chat area
-        chat_container = st.container()
+        chat_container = st.container(key="chat_messages")
         
-        # Get messages from Redis
-        messages = get_messages(room_id)
+        # Get recent messages from the room's precomputed snapshot (one GET)
+        snapshot = get_message_snapshot(room_id)
+        messages = snapshot["messages"]
         
         # Initialize message count for notification
         if "message_count" not in st.session_state:
@@ -1457,7 +1448,8 @@ def chat_interface():
             st.markdown(
                 """
                 <style>
-                [data-testid="stVerticalBlock"] > [style*="flex-direction: column"] > [data-testid="stVerticalBlock"] {
+                [data-testid="stVerticalBlock"] > [style*="flex-direction: column"] > [data-testid="stVerticalBlock"],
+                .st-key-chat_messages {
                     background-color: rgba(0, 0, 0, 0.7);
                     border: 3px solid #ff00c1;
                     border-radius: 0;
@@ -1476,36 +1468,10 @@ def chat_interface():
             # Display messages with their appropriate styles
             if messages:
                 for msg in messages:
-                    if msg["type"] == "system":
-                        # System message
-                        st.markdown(
-                            f"""
-                            <div class="message system-message">
-                                {msg["content"]}
-                            </div>
-                            """,
-                            unsafe_allow_html=True
-                        )
-                    elif msg["username"] == username:
-                        # User's own message
-                        st.markdown(
-                            f"""
-                            <div class="message user-message">
-                                <span class="hot-pink-text">{msg["username"]}:</span> {msg["content"]}
-                            </div>
-                            """,
-                            unsafe_allow_html=True
-                        )
-                    else:
-                        # Other users' messages
-                        st.markdown(
-                            f"""
-                            <div class="message other-message">
-                                <span class="cyan-text">{msg["username"]}:</span> {msg["content"]}
-                            </div>
-                            """,
-                            unsafe_allow_html=True
-                        )
+                    # Rendered fragments are cached per message and perspective
+                    st.markdown(render_message_html(msg, username), unsafe_allow_html=True)
+                    if msg.get("attachment"):
+                        display_attachment(msg["attachment"])
             else:
                 # No messages yet
                 st.markdown(
@@ -1519,21 +1485,154 @@ def chat_interface():
                     """,
                     unsafe_allow_html=True
                 )
+        if st.session_state.performance_mode == "low":
+            autoscroll_chat()
+        
+        # Measure how long real-time events took to reach the screen
+        record_render_lag(snapshot["seq"])
+        if st.session_state.debug:
+            display_lag_overlay()
         
         # Message input with form (this approach doesn't try to clear the field directly)
-        with st.form(key="message_form"):
+        with st.form(key="message_form", clear_on_submit=True):
             message = st.text_input("", placeholder="TYPE YOUR MESSAGE HERE...")
+            upload = st.file_uploader(
+                "ATTACH IMAGE",
+                type=[image_format.lower() for image_format in IMAGE_FORMATS] + ["jpg"],
+                key="attachment_upload"
+            )
             submit = st.form_submit_button("SEND")
             
-            if submit and message:
+            if submit and (message or upload):
+                # One idempotency key per message. The same message submitted
+                # again (a retry after an error, or a double click on SEND
+                # shortly after it was sent) keeps its key, so it is not
+                # posted twice
+                image = upload.getvalue() if upload else b""
+                fingerprint = hashlib.sha256(message.encode("utf-8") + b"\0" + image).hexdigest()
+                action = st.session_state.get("message_action")
+                if (
+                    action is None
+                    or action["fingerprint"] != fingerprint
+                    or (action["sent_at"] is not None and time.time() - action["sent_at"] > DOUBLE_SUBMIT_SECONDS)
+                ):
+                    action = {"fingerprint": fingerprint, "key": str(uuid.uuid4()), "sent_at": None}
+                    st.session_state.message_action = action
+                
                 # Send message to Redis
-                send_message(room_id, username, message)
-                # The form will automatically clear after submission and rerun
-                st.rerun()
+                try:
+                    if upload:
+                        # Validation and thumbnailing run in the process pool
+                        send_attachment(
+                            room_id,
+                            username,
+                            image,
+                            prepare_attachment(image),
+                            message,
+                            idempotency_key=action["key"]
+                        )
+                    else:
+                        send_message(room_id, username, message, idempotency_key=action["key"])
+                except (MessageTooLarge, RoomClosed, AttachmentError) as e:
+                    st.error(f"Message not sent: {e}")
+                else:
+                    action["sent_at"] = time.time()
+                    # The form will automatically clear after submission and rerun
+                    st.rerun()
+
+@st.cache_data(max_entries=500, show_spinner=False)
+def load_thumbnail(room_id, attachment_id):
+    """Fetch an attachment's thumbnail once per process (attachments never change)"""
+    get_cached_thumbnails()[room_id].add(attachment_id)
+    return get_attachment(attachment_id, thumbnail=True)
+
+@st.cache_resource
+def get_cached_thumbnails():
+    """Room id -> ids of the attachments whose thumbnails are cached"""
+    return defaultdict(set)
+
+def evict_thumbnails(room_id):
+    """Drop a closed room's thumbnails from the cache"""
+    for attachment_id in get_cached_thumbnails().pop(room_id, ()):
+        load_thumbnail.clear(room_id, attachment_id)
+
+@st.dialog("ATTACHMENT", width="large")
+def show_full_image(attachment_id):
+    """Show an attachment at full size (only fetched when asked for)"""
+    stored = get_attachment(attachment_id)
+    if stored is None:
+        st.error("This image has expired")
+        return
+    st.image(stored[0])
+
+def display_attachment(attachment):
+    """Show an attachment's thumbnail with a button for the full image"""
+    stored = load_thumbnail(st.session_state.room_id, attachment["id"])
+    if stored is None:
+        st.caption("IMAGE EXPIRED")
+        return
+    
+    st.image(stored[0], caption=f"{attachment['width']}x{attachment['height']}")
+    if st.button("VIEW FULL SIZE", key=f"full_image_{attachment['id']}"):
+        show_full_image(attachment["id"])
+
+def display_presence(room_id):
+    """Show how many users are online in the room, and who"""
+    presence = get_presence(room_id)
+    usernames = ", ".join(html.escape(name) for name in presence["usernames"])
+    more = presence["count"] - len(presence["usernames"])
+    if more > 0:
+        usernames += f" +{more}"
+    st.markdown(
+        f'<p class="lime-text">{presence["count"]} ONLINE</p>'
+        f'<p class="cyan-text" style="font-size: 0.9rem;">{usernames}</p>',
+        unsafe_allow_html=True
+    )
+
+def build_transcript(room_id, transcript_format):
+    """Build a room's transcript in memory, cut off at INAPP_TRANSCRIPT_MAX_BYTES"""
+    lines = []
+    size = 0
+    for line in export_transcript(room_id, transcript_format):
+        size += len(line.encode("utf-8"))
+        if size > INAPP_TRANSCRIPT_MAX_BYTES:
+            notice = f"Transcript truncated at {INAPP_TRANSCRIPT_MAX_BYTES} bytes; export it through the gateway for the full history"
+            if transcript_format == "ndjson":
+                lines.append(json.dumps({"truncated": True, "notice": notice}) + "\n")
+            else:
+                lines.append(f"* {notice}\n")
+            break
+        lines.append(line)
+    return "".join(lines)
+
+def display_transcript_export(room_id):
+    """Offer the room's full history as an NDJSON or text download"""
+    st.markdown('<div style="height: 20px;"></div>', unsafe_allow_html=True)
+    transcript_format = st.selectbox("TRANSCRIPT", list(TRANSCRIPT_FORMATS), key="transcript_format")
+    mime, extension = TRANSCRIPT_FORMATS[transcript_format]
+    
+    # The gateway streams the transcript page by page in constant memory
+    if GATEWAY_URL:
+        token = issue_room_token(room_id, st.session_state.username, f"host:{room_id}")
+        st.link_button(
+            "EXPORT TRANSCRIPT",
+            f"{GATEWAY_URL}/rooms/{room_id}/transcript?format={transcript_format}&token={token}"
+        )
+        return
     
-    # Check for updates from Redis pub/sub
-    check_for_updates()
+    # Without it, Streamlit has to hold the whole file in memory to serve it,
+    # so it is only built when the button is clicked, and only up to a limit
+    st.download_button(
+        "EXPORT TRANSCRIPT",
+        lambda: build_transcript(room_id, transcript_format),
+        file_name=f"transcript-{st.session_state.room_code}.{extension}",
+        mime=mime,
+        key="transcript_btn",
+        on_click="ignore",
+        help=f"Limited to {INAPP_TRANSCRIPT_MAX_BYTES // (1024 * 1024)} MB; set GATEWAY_URL to stream full transcripts"
+    )
 
+@profiled("join_requests")
 def handle_join_requests():
     """Display and handle join requests for host"""
     if not st.session_state.get("is_host", False):
@@ -1549,13 +1648,33 @@ def handle_join_requests():
         if "last_request_count" not in st.session_state:
             st.session_state.last_request_count = 0
         
+        # Bulk actions apply to every request matching the filter
+        name_filter = st.text_input("FILTER BY NAME", key="request_filter", placeholder="ALL REQUESTS")
+        if name_filter:
+            pending_requests = [
+                request for request in pending_requests
+                if name_filter.lower() in request["username"].lower()
+            ]
+        matching_ids = [request["id"] for request in pending_requests]
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button(f"APPROVE ALL ({len(matching_ids)})", key="approve_all", disabled=not matching_ids):
+                approve_requests(st.session_state.room_id, matching_ids)
+                st.rerun()
+        
+        with col2:
+            if st.button(f"REJECT ALL ({len(matching_ids)})", key="reject_all", disabled=not matching_ids):
+                reject_requests(matching_ids)
+                st.rerun()
+        
         # Display each request with approve/reject buttons
         for request in pending_requests:
             with st.container():
                 st.markdown(
                     f"""
                     <div class="request-item">
-                        <span class="hot-pink-text">{request["username"]}</span> wants to join your chatroom
+                        <span class="hot-pink-text">{html.escape(request["username"])}</span> wants to join your chatroom
                     </div>
                     """,
                     unsafe_allow_html=True
@@ -1564,35 +1683,34 @@ def handle_join_requests():
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button("APPROVE", key=f"approve_{request['id']}"):
-                        # Update request status in Redis
-                        updated_request = update_request_status(request["id"], "approved")
-                        if updated_request:
-                            # Send system message
-                            send_message(
-                                st.session_state.room_id,
-                                "SYSTEM",
-                                f"{updated_request['username']} has joined the chatroom",
-                                "system"
-                            )
-                            st.rerun()
+                        approve_requests(st.session_state.room_id, [request["id"]])
+                        st.rerun()
                 
                 with col2:
                     if st.button("REJECT", key=f"reject_{request['id']}"):
-                        # Update request status in Redis
-                        update_request_status(request["id"], "rejected")
+                        reject_requests([request["id"]])
                         st.rerun()
 
 def exit_chat():
     """Exit the current chatroom"""
     # Send exit message to Redis
-    send_message(
-        st.session_state.room_id,
-        "SYSTEM",
-        f"{st.session_state.username} has left the chatroom",
-        "system"
-    )
+    leave_chatroom(st.session_state.room_id, st.session_state.username)
     
     # Clear chatroom data from session
+    leave_room_state()
+    
+    # Go back to home
+    st.session_state.page = "home"
+
+def leave_room_state():
+    """Stop listening to the current room and forget it from the session"""
+    if "room_id" in st.session_state:
+        get_dispatcher().leave_room(st.session_state.room_id, st.session_state.session_id)
+    
+    # Stop counting this session as active, and as online in the room
+    forget_session(st.session_state.session_id)
+    get_presence_tracker().forget(st.session_state.session_id)
+    
     if "room_id" in st.session_state:
         del st.session_state.room_id
     if "current_room_name" in st.session_state:  # FIXED KEY
@@ -1610,8 +1728,25 @@ def exit_chat():
     if "request_listener_started" in st.session_state:
         del st.session_state.request_listener_started
     
-    # Go back to home
-    st.session_state.page = "home"
+    # Delivery stats and pending events belong to the room being left
+    for key in ("last_seq", "seq_gaps", "lag_samples"):
+        if key in st.session_state:
+            del st.session_state[key]
+    st.session_state.new_messages.clear()
+    st.session_state.new_requests.clear()
+    get_rerun_scheduler().take_delivered()
+
+@profiled("room_closed")
+def room_closed_page():
+    """Tell a guest the host has closed the room they were in"""
+    st.markdown("<h1 class='rainbow-text'>ROOM CLOSED</h1>", unsafe_allow_html=True)
+    st.markdown(
+        '<p class="hot-pink-text" style="text-align: center;">THE HOST HAS CLOSED THIS CHATROOM</p>',
+        unsafe_allow_html=True
+    )
+    if st.button("BACK TO HOME", key="closed_home_btn"):
+        st.session_state.page = "home"
+        st.rerun()
 
 def close_chat():
     """Close the chatroom (host only)"""
@@ -1630,28 +1765,63 @@ def close_chat():
     close_chatroom(st.session_state.room_id)
     
     # Clear chatroom data from session
-    if "room_id" in st.session_state:
-        del st.session_state.room_id
-    if "current_room_name" in st.session_state:  # FIXED KEY
-        del st.session_state.current_room_name
-    if "room_code" in st.session_state:
-        del st.session_state.room_code
-    if "username" in st.session_state:
-        del st.session_state.username
-    if "is_host" in st.session_state:
-        del st.session_state.is_host
-    if "message_count" in st.session_state:
-        del st.session_state.message_count
-    if "message_listener_started" in st.session_state:
-        del st.session_state.message_listener_started
-    if "request_listener_started" in st.session_state:
-        del st.session_state.request_listener_started
+    leave_room_state()
     
     # Go back to home
     st.session_state.page = "home"
 
+@profiled("operator")
+def operator_page():
+    """Room activity overview for operators, backed by the activity indexes"""
+    if not operator_authorized():
+        st.error("OPERATOR ACCESS DENIED")
+        return
+    
+    st.markdown("<h1 class='rainbow-text'>OPERATOR</h1>", unsafe_allow_html=True)
+    idle_minutes = st.number_input("IDLE AFTER (MINUTES)", min_value=1, value=60, key="operator_idle")
+    idle_seconds = idle_minutes * 60
+    
+    counts = room_counts(idle_seconds)
+    col1, col2 = st.columns(2)
+    col1.metric("OPEN ROOMS", counts["open"])
+    col2.metric("IDLE ROOMS", counts["idle"])
+    
+    st.markdown('<h3 class="cyan-text">BUSIEST ROOMS</h3>', unsafe_allow_html=True)
+    st.dataframe(
+        [{"room": room_id, "messages": messages} for room_id, messages in busiest_rooms(10)],
+        width="stretch"
+    )
+    
+    st.markdown('<h3 class="cyan-text">RECENTLY ACTIVE</h3>', unsafe_allow_html=True)
+    now = time.time()
+    st.dataframe(
+        [
+            {
+                "room": room["id"],
+                "name": room.get("name", "(expired)"),
+                "host": room.get("host_name", ""),
+                "messages": room["messages"],
+                "idle (min)": round((now - room["last_active"]) / 60, 1)
+            }
+            for room in room_directory(50)
+        ],
+        width="stretch"
+    )
+    
+    if st.button(f"CLOSE {counts['idle']} IDLE ROOMS", key="reap_btn", disabled=not counts["idle"]):
+        # Each call closes one batch; rooms active again since are skipped
+        with st.spinner("CLOSING IDLE ROOMS..."):
+            while reap_idle_rooms(idle_seconds):
+                pass
+        st.rerun()
+
 # Main application logic
 def main():
+    # The operator page sits outside the chat flow
+    if st.query_params.get("view") == "operator":
+        operator_page()
+        return
+    
     # Handle different pages
     if st.session_state.page == "home":
         home_page()
@@ -1659,9 +1829,18 @@ def main():
         host_chatroom()
     elif st.session_state.page == "join":
         join_chatroom()
+    elif st.session_state.page == "waiting":
+        waiting_room()
     elif st.session_state.page == "chat":
         chat_interface()
+    elif st.session_state.page == "closed":
+        room_closed_page()
 
 # Run the main application
 if __name__ == "__main__":
-    main()
+    completed = False
+    try:
+        main()
+        completed = True
+    finally:
+        finish_debug_run(debug_run, completed)
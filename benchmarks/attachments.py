@@ -0,0 +1,92 @@
+"""
+Concurrent image upload throughput
+
+Uploads generated photos from many threads at once through the same path as
+chat_interface: validation and thumbnailing in the process pool
+(utils/attachments.py), then ChatService.send_attachment. Reports uploads per
+second and p50/p95/p99 upload latency for each concurrency level. Set
+THUMBNAIL_WORKERS to size the pool.
+
+    python -m benchmarks.attachments --backend fake --concurrency 1 4 16
+"""
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from benchmarks.redis_ops import make_client
+from benchmarks.stats import summarize_latencies, write_results, check_baseline
+from utils import redis_client
+from utils.attachments import prepare_attachment, process_image, get_thumbnail_pool
+from utils.redis_client import ChatService
+
+def make_images(count, size, image_format):
+    """Encode `count` distinct noise images, which compress like photos"""
+    images = []
+    for _ in range(count):
+        image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+        output = io.BytesIO()
+        image.save(output, image_format)
+        images.append(output.getvalue())
+    return images
+
+def upload(service, room_id, image):
+    """Upload one image and return its latency"""
+    started = time.perf_counter()
+    service.send_attachment(room_id, "bench-user", image, prepare_attachment(image))
+    return time.perf_counter() - started
+
+def run_level(service, images, concurrency, uploads):
+    """Upload `uploads` images from `concurrency` threads"""
+    room = service.create_chatroom("BENCHMARK", "bench-host")
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(
+            lambda index: upload(service, room["id"], images[index % len(images)]),
+            range(uploads)
+        ))
+    elapsed = time.perf_counter() - started
+    
+    service.close_chatroom(room["id"])
+    return {
+        "uploads_per_second": round(uploads / elapsed, 2),
+        "latency": summarize_latencies(latencies)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backend", choices=["redis", "fake"], default="fake")
+    parser.add_argument("--redis-url", default="redis://localhost:6379", help="Redis for the redis backend")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16], help="simultaneous uploads")
+    parser.add_argument("--uploads", type=int, default=64, help="uploads per concurrency level")
+    parser.add_argument("--size", type=int, default=1600, help="image width and height in pixels")
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "PNG", "WEBP"], help="upload format")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--save-baseline", help="write results as the new baseline to this file")
+    parser.add_argument("--compare", help="compare against the baseline in this file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed median slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+    
+    # The room quota would cut a long run short; it is not what's measured
+    redis_client.MAX_ROOM_ATTACHMENT_BYTES = float("inf")
+    
+    service = ChatService(make_client(args.backend, args.redis_url))
+    images = make_images(8, args.size, args.format)
+    
+    # Start the worker processes before anything is timed
+    pool = get_thumbnail_pool()
+    list(pool.map(process_image, images))
+    
+    results = {}
+    for concurrency in args.concurrency:
+        key = f"{args.backend}/{args.format}/size={args.size}/concurrency={concurrency}"
+        results[key] = run_level(service, images, concurrency, args.uploads)
+    write_results(results, args.output)
+    
+    check_baseline(results, args, {"p50": lambda result: result["latency"]["p50"]})
+    pool.shutdown()
+
+if __name__ == "__main__":
+    main()
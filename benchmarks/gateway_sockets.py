@@ -0,0 +1,95 @@
+"""
+Benchmark the gateway's WebSocket fan-out with many concurrent sockets
+
+Opens N sockets on one room through a running gateway, posts messages with
+the ChatService against the same Redis (as the Streamlit UI would), and
+measures how long each message takes to reach every socket.
+
+    uvicorn gateway:app --port 8000 &
+    python -m benchmarks.gateway_sockets --sockets 2000 --messages 50
+
+Raise the open file limit first (ulimit -n) for more than ~1000 sockets.
+"""
+import argparse
+import asyncio
+import json
+import time
+import websockets
+from benchmarks.stats import summarize_latencies, write_results
+from utils.redis_client import get_chat_service
+
+async def watch(url, latencies, ready, expected):
+    """Hold one socket open and record delivery latency of bench messages"""
+    try:
+        socket = await websockets.connect(url, max_queue=None)
+    finally:
+        # Let the next batch start even if this socket failed to connect
+        ready.release()
+    
+    async with socket:
+        received = 0
+        while received < expected:
+            event = json.loads(await socket.recv())
+            if event["channel"] != "messages":
+                continue
+            content = event["data"]["content"]
+            if content.startswith("bench:"):
+                latencies.append(time.time() - float(content.split(":", 1)[1]))
+                received += 1
+
+async def run(args):
+    service = get_chat_service()
+    room = service.create_chatroom("BENCHMARK", "bench-host")
+    token = service.issue_room_token(room["id"], "bench-host", f"host:{room['id']}")
+    url = f"{args.url}/rooms/{room['id']}/events?token={token}"
+    
+    latencies = []
+    ready = asyncio.Semaphore(0)
+    
+    # Open the sockets in batches to avoid a connect storm
+    started = time.perf_counter()
+    watchers = []
+    for start in range(0, args.sockets, args.batch):
+        batch = range(start, min(start + args.batch, args.sockets))
+        watchers.extend(asyncio.create_task(watch(url, latencies, ready, args.messages)) for _ in batch)
+        for _ in batch:
+            await ready.acquire()
+    connect_time = time.perf_counter() - started
+    
+    # Post messages through the data layer at the requested rate
+    interval = 1 / args.rate
+    for _ in range(args.messages):
+        await asyncio.to_thread(service.send_message, room["id"], "bench-host", f"bench:{time.time()}")
+        await asyncio.sleep(interval)
+    
+    done, pending = await asyncio.wait(watchers, timeout=args.timeout)
+    for task in pending:
+        task.cancel()
+    
+    service.close_chatroom(room["id"])
+    
+    expected = args.sockets * args.messages
+    results = {
+        "sockets": args.sockets,
+        "messages": args.messages,
+        "connect_seconds": round(connect_time, 3),
+        "delivered": len(latencies),
+        "expected": expected,
+        "delivery_ratio": round(len(latencies) / expected, 4) if expected else None,
+        "latency_ms": summarize_latencies(latencies)
+    }
+    write_results(results, args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="ws://localhost:8000", help="gateway base URL")
+    parser.add_argument("--sockets", type=int, default=1000, help="concurrent sockets")
+    parser.add_argument("--messages", type=int, default=20, help="messages to fan out")
+    parser.add_argument("--rate", type=float, default=10, help="messages per second")
+    parser.add_argument("--batch", type=int, default=200, help="sockets opened per batch")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for delivery")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
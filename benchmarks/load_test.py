@@ -0,0 +1,139 @@
+"""
+End-to-end load test: many rooms with many simulated chatters
+
+Creates R rooms with U users each against a Redis server and drives the
+real data-layer paths (create_chatroom, join_request, update_request_status,
+send_message, get_messages) from one thread per user. Reports per-operation
+throughput and p50/p95/p99 latency plus Redis commands per second.
+
+    python -m benchmarks.load_test --rooms 10 --users 20 --duration 30 \\
+        --output results/load-$(git rev-parse --short HEAD).json
+"""
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+import redis
+from benchmarks.stats import summarize_latencies, write_results
+from utils.redis_client import ChatService
+
+class LatencyRecorder:
+    """Thread-safe collection of latencies per operation"""
+    
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+    
+    def call(self, operation, func, *args):
+        """Run func, recording its latency (or failure) under operation"""
+        started = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            with self._lock:
+                self.errors[operation] += 1
+            return None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[operation].append(elapsed)
+        return result
+
+def commands_processed(client):
+    """Return Redis' total processed command counter"""
+    return client.info("stats")["total_commands_processed"]
+
+def simulate_user(service, recorder, room_id, username, args, stop_at):
+    """Join a room, then send and read messages at the configured rate"""
+    request = recorder.call("join_request", service.join_request, room_id, username)
+    if request:
+        recorder.call("update_request_status", service.update_request_status, request["request_id"], "approved")
+    
+    interval = 1 / args.rate
+    sent = 0
+    
+    # Spread users out so they don't all send in lock step
+    time.sleep(random.uniform(0, interval))
+    while time.time() < stop_at:
+        started = time.perf_counter()
+        content = "x" * args.payload
+        recorder.call("send_message", service.send_message, room_id, username, content)
+        sent += 1
+        if sent % args.read_every == 0:
+            recorder.call("get_messages", service.get_messages, room_id)
+        time.sleep(max(0, interval - (time.perf_counter() - started)))
+
+def run(args):
+    client = redis.from_url(args.redis_url, max_connections=args.rooms * args.users + 10)
+    service = ChatService(client)
+    recorder = LatencyRecorder()
+    
+    commands_before = commands_processed(client)
+    started = time.perf_counter()
+    
+    rooms = []
+    for index in range(args.rooms):
+        room = recorder.call("create_chatroom", service.create_chatroom, f"LOAD-{index}", f"host-{index}")
+        if room:
+            rooms.append(room)
+    
+    stop_at = time.time() + args.duration
+    threads = [
+        threading.Thread(
+            target=simulate_user,
+            args=(service, recorder, room["id"], f"user-{index}-{user}", args, stop_at),
+            daemon=True
+        )
+        for index, room in enumerate(rooms)
+        for user in range(args.users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    elapsed = time.perf_counter() - started
+    commands = commands_processed(client) - commands_before
+    
+    for room in rooms:
+        service.close_chatroom(room["id"])
+    
+    operations = {}
+    for operation, latencies in sorted(recorder.latencies.items()):
+        operations[operation] = {
+            **summarize_latencies(latencies),
+            "per_second": round(len(latencies) / elapsed, 2),
+            "errors": recorder.errors.get(operation, 0)
+        }
+    
+    results = {
+        "config": {
+            "rooms": args.rooms,
+            "users": args.users,
+            "rate": args.rate,
+            "payload": args.payload,
+            "read_every": args.read_every,
+            "duration": args.duration
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "operations": operations,
+        "total_operations_per_second": round(sum(len(l) for l in recorder.latencies.values()) / elapsed, 2),
+        "redis_commands_per_second": round(commands / elapsed, 2)
+    }
+    write_results(results, args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--redis-url", default="redis://localhost:6379", help="Redis to load")
+    parser.add_argument("--rooms", type=int, default=5, help="number of rooms")
+    parser.add_argument("--users", type=int, default=10, help="simulated users per room")
+    parser.add_argument("--rate", type=float, default=1, help="messages per second per user")
+    parser.add_argument("--payload", type=int, default=64, help="message size in characters")
+    parser.add_argument("--read-every", type=int, default=1, help="read history after every N sends")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of sending")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    run(parser.parse_args())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Size and speed of the record codecs in utils/codecs.py
+
+Encodes and decodes a room, a join request and messages of each payload size
+with every available codec, and reports the encoded size in bytes and
+encode/decode latency. Needs no Redis.
+
+    python -m benchmarks.record_codecs --payload 16 256 4096
+"""
+import argparse
+import time
+import uuid
+from datetime import datetime
+from benchmarks.stats import summarize_latencies, write_results, check_baseline
+from utils.codecs import CODECS, get_codec, decode_record
+
+def sample_records(payload):
+    """Return (name, record) pairs shaped like the ones the data layer stores"""
+    room_id = str(uuid.uuid4())
+    created_at = datetime.now().isoformat()
+    return [
+        ("room", {
+            "id": room_id,
+            "name": "BENCHMARK",
+            "code": "12345",
+            "host_name": "bench-host",
+            "is_active": True,
+            "created_at": created_at
+        }),
+        ("request", {
+            "id": str(uuid.uuid4()),
+            "chatroom_id": room_id,
+            "username": "bench-guest",
+            "status": "pending",
+            "created_at": created_at
+        }),
+        (f"message/payload={payload}", {
+            "id": str(uuid.uuid4()),
+            "chatroom_id": room_id,
+            "username": "bench-user",
+            "content": "x" * payload,
+            "type": "user",
+            "created_at": created_at
+        }),
+    ]
+
+def available_codecs():
+    """Yield the codecs whose dependencies are installed"""
+    for name in CODECS:
+        try:
+            yield get_codec(name)
+        except ValueError as e:
+            print(f"Skipping {name}: {e}")
+
+def measure(func, value, iterations):
+    """Time `iterations` calls of func(value)"""
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func(value)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def run_suite(args):
+    """Encode and decode every sample record with every codec"""
+    results = {}
+    codecs = list(available_codecs())
+    for payload in args.payload:
+        for record_name, record in sample_records(payload):
+            for codec in codecs:
+                # Rooms and requests don't depend on the payload size
+                key = f"{codec.name}/{record_name}"
+                if key in results:
+                    continue
+                encoded = codec.encode(record)
+                results[key] = {
+                    "bytes": len(encoded),
+                    "encode": summarize_latencies(measure(codec.encode, record, args.iterations)),
+                    "decode": summarize_latencies(measure(decode_record, encoded, args.iterations))
+                }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--payload", nargs="+", type=int, default=[16, 256, 4096], help="message sizes in characters")
+    parser.add_argument("--iterations", type=int, default=10000, help="timed calls per codec and record")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--save-baseline", help="write results as the new baseline to this file")
+    parser.add_argument("--compare", help="compare against the baseline in this file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed growth (0.2 = 20%%)")
+    args = parser.parse_args()
+    
+    results = run_suite(args)
+    write_results(results, args.output)
+    
+    check_baseline(results, args, {
+        "bytes": lambda result: result["bytes"],
+        "decode_p50": lambda result: result["decode"]["p50"]
+    })
+
+if __name__ == "__main__":
+    main()
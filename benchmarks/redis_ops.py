@@ -0,0 +1,115 @@
+"""
+Microbenchmarks for every ChatService operation in utils/redis_client.py
+
+Runs each operation against a local Redis and/or an in-process fake
+(fakeredis), for every combination of room history size and message payload
+size. Results can be saved as a baseline and later runs compared against
+it; --compare exits with status 1 when an operation's median latency
+regressed by more than --threshold (20% by default), so CI can fail on it.
+
+    python -m benchmarks.redis_ops --backend fake --save-baseline benchmarks/baseline.json
+    python -m benchmarks.redis_ops --backend fake --compare benchmarks/baseline.json
+"""
+import argparse
+import sys
+import time
+import redis
+from benchmarks.stats import summarize_latencies, write_results, check_baseline
+from utils.redis_client import ChatService
+
+def make_client(backend, redis_url):
+    """Return a Redis client for the chosen backend"""
+    if backend == "fake":
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("The fake backend needs fakeredis: pip install 'fakeredis[lua]'")
+        return fakeredis.FakeRedis()
+    return redis.from_url(redis_url)
+
+def seed_room(service, history, payload):
+    """Create a room with a join request pending and `history` messages"""
+    room = service.create_chatroom("BENCHMARK", "bench-host")
+    for index in range(history):
+        service.send_message(room["id"], f"user-{index % 10}", "x" * payload)
+    service.join_request(room["id"], "bench-guest")
+    return room
+
+def operations(service, room, payload):
+    """
+    Return (name, setup, call) triples for each operation
+    
+    setup runs outside the timed region and returns the arguments for call
+    """
+    room_id = room["id"]
+    content = "x" * payload
+    return [
+        ("create_chatroom", lambda: ("BENCHMARK", "bench-host"), service.create_chatroom),
+        ("get_chatroom_by_code", lambda: (room["code"],), service.get_chatroom_by_code),
+        # Read pending requests before join_request adds more of them
+        ("get_pending_requests", lambda: (room_id,), service.get_pending_requests),
+        ("join_request", lambda: (room_id, "bench-guest"), service.join_request),
+        (
+            "update_request_status",
+            lambda: (service.join_request(room_id, "bench-guest")["request_id"], "approved"),
+            service.update_request_status
+        ),
+        ("send_message", lambda: (room_id, "bench-user", content), service.send_message),
+        ("get_messages", lambda: (room_id,), service.get_messages),
+        ("get_message_snapshot", lambda: (room_id,), service.get_message_snapshot),
+        (
+            "close_chatroom",
+            lambda: (service.create_chatroom("BENCHMARK", "bench-host")["id"],),
+            service.close_chatroom
+        ),
+    ]
+
+def measure(setup, call, iterations):
+    """Time `iterations` calls, running setup before each one"""
+    latencies = []
+    for _ in range(iterations):
+        args = setup()
+        started = time.perf_counter()
+        call(*args)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def run_suite(args):
+    """Run every operation for every backend, history and payload size"""
+    results = {}
+    for backend in args.backend:
+        client = make_client(backend, args.redis_url)
+        service = ChatService(client)
+        for history in args.history:
+            for payload in args.payload:
+                room = seed_room(service, history, payload)
+                for name, setup, call in operations(service, room, payload):
+                    # Warm up connections and script caches
+                    measure(setup, call, args.warmup)
+                    latencies = measure(setup, call, args.iterations)
+                    key = f"{backend}/{name}/history={history}/payload={payload}"
+                    results[key] = summarize_latencies(latencies)
+                service.close_chatroom(room["id"])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backend", nargs="+", choices=["redis", "fake"], default=["fake"])
+    parser.add_argument("--redis-url", default="redis://localhost:6379", help="Redis for the redis backend")
+    parser.add_argument("--history", nargs="+", type=int, default=[0, 100, 1000], help="messages already in the room")
+    parser.add_argument("--payload", nargs="+", type=int, default=[64, 1024, 16384], help="message sizes in characters")
+    parser.add_argument("--iterations", type=int, default=200, help="timed calls per operation")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed calls per operation")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--save-baseline", help="write results as the new baseline to this file")
+    parser.add_argument("--compare", help="compare against the baseline in this file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed median slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+    
+    results = run_suite(args)
+    write_results(results, args.output)
+    
+    check_baseline(results, args, {"p50": lambda result: result["p50"]})
+
+if __name__ == "__main__":
+    main()
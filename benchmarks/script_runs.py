@@ -0,0 +1,129 @@
+"""
+Script-run cost benchmarks for app.py using Streamlit's AppTest
+
+Drives home_page, host_chatroom, join_chatroom and chat_interface in a
+headless script runner with rooms seeded with 0, 50, 500 and 5,000
+messages, and measures script run time, the number of elements emitted and
+the total size of the element deltas sent to the browser. Supports the
+same --save-baseline / --compare regression check as benchmarks.redis_ops.
+
+    python -m benchmarks.script_runs --backend fake --compare script-baseline.json
+"""
+import argparse
+import time
+from pathlib import Path
+from unittest import mock
+import redis
+from streamlit.testing.v1 import AppTest
+from benchmarks.stats import summarize_latencies, write_results, check_baseline
+from utils import redis_client
+
+APP_PATH = str(Path(__file__).parent.parent / "app.py")
+
+def use_backend(backend, redis_url):
+    """Point the data layer at the chosen Redis for the whole run"""
+    redis_client.get_redis_client.cache_clear()
+    redis_client.get_chat_service.cache_clear()
+    
+    if backend == "fake":
+        import fakeredis
+        client = fakeredis.FakeRedis()
+        return mock.patch.object(redis, "from_url", return_value=client)
+    
+    return mock.patch.dict("os.environ", {"REDIS_URL": redis_url})
+
+def seed_room(history):
+    """Create a room holding `history` messages and return it"""
+    service = redis_client.get_chat_service()
+    room = service.create_chatroom("BENCHMARK", "bench-host")
+    for index in range(history):
+        service.send_message(room["id"], f"user-{index % 10}", f"message number {index}")
+    return room
+
+def page_states(room):
+    """Session state that opens each page"""
+    chat_state = {
+        "room_id": room["id"],
+        "room_code": room["code"],
+        "current_room_name": "BENCHMARK",
+        "username": "user-0",
+        "is_host": False,
+        # Background listeners are not part of a script run's cost
+        "message_listener_started": True,
+        "request_listener_started": True,
+    }
+    return {
+        "home_page": {"page": "home"},
+        "host_chatroom": {"page": "host"},
+        "join_chatroom": {"page": "join"},
+        "chat_interface": {"page": "chat", **chat_state},
+        "chat_interface_host": {"page": "chat", **chat_state, "username": "bench-host", "is_host": True},
+    }
+
+def walk(node):
+    """Yield every node of an AppTest element tree"""
+    yield node
+    for child in getattr(node, "children", {}).values():
+        yield from walk(child)
+
+def measure_page(state, iterations, timeout):
+    """Run the app with the given session state and measure each run"""
+    run_times = []
+    elements = delta_bytes = 0
+    for _ in range(iterations):
+        app = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        for key, value in state.items():
+            app.session_state[key] = value
+        
+        started = time.perf_counter()
+        app.run()
+        run_times.append(time.perf_counter() - started)
+        
+        if app.exception:
+            raise RuntimeError(f"Script run failed: {app.exception[0].message}")
+        
+        nodes = list(walk(app._tree))
+        elements = sum(1 for node in nodes if not hasattr(node, "children"))
+        delta_bytes = sum(node.proto.ByteSize() for node in nodes if getattr(node, "proto", None) is not None)
+    
+    return {
+        "run_ms": summarize_latencies(run_times),
+        "elements": elements,
+        "delta_bytes": delta_bytes
+    }
+
+def run_suite(args):
+    """Measure every page for every seeded history size"""
+    results = {}
+    with use_backend(args.backend, args.redis_url):
+        for history in args.history:
+            room = seed_room(history)
+            for page, state in page_states(room).items():
+                results[f"{page}/history={history}"] = measure_page(state, args.iterations, args.timeout)
+            redis_client.close_chatroom(room["id"])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backend", choices=["redis", "fake"], default="fake")
+    parser.add_argument("--redis-url", default="redis://localhost:6379", help="Redis for the redis backend")
+    parser.add_argument("--history", nargs="+", type=int, default=[0, 50, 500, 5000], help="messages in the room")
+    parser.add_argument("--iterations", type=int, default=10, help="script runs per page")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds allowed per script run")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--save-baseline", help="write results as the new baseline to this file")
+    parser.add_argument("--compare", help="compare against the baseline in this file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed growth per metric (0.2 = 20%%)")
+    args = parser.parse_args()
+    
+    results = run_suite(args)
+    write_results(results, args.output)
+    
+    check_baseline(results, args, {
+        "run_p50": lambda result: result["run_ms"]["p50"],
+        "elements": lambda result: result["elements"],
+        "delta_bytes": lambda result: result["delta_bytes"]
+    })
+
+if __name__ == "__main__":
+    main()
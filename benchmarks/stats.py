@@ -0,0 +1,71 @@
+"""Shared helpers for summarizing benchmark measurements"""
+import json
+import statistics
+import sys
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize_latencies(latencies):
+    """Summarize latencies in seconds as milliseconds"""
+    if not latencies:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None}
+    return {
+        "count": len(latencies),
+        "mean": round(statistics.mean(latencies) * 1000, 3),
+        "p50": round(percentile(latencies, 50) * 1000, 3),
+        "p95": round(percentile(latencies, 95) * 1000, 3),
+        "p99": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+def write_results(results, path):
+    """Print results and optionally save them as JSON"""
+    print(json.dumps(results, indent=2))
+    if path:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+def find_regressions(results, baseline, threshold, metrics):
+    """
+    Compare results with a baseline and return the metrics that got worse
+    
+    metrics maps a metric name to a function extracting it from a result;
+    a metric regresses when it grew by more than threshold (0.2 = 20%)
+    """
+    regressions = {}
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for name, extract in metrics.items():
+            before, after = extract(previous), extract(current)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if change > threshold:
+                regressions[f"{key}/{name}"] = {
+                    "baseline": before,
+                    "current": after,
+                    "change": round(change, 3)
+                }
+    return regressions
+
+def check_baseline(results, args, metrics):
+    """Save and/or compare against a baseline as requested on the command line"""
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(results, json.load(f), args.threshold, metrics)
+        if regressions:
+            print("Regressions beyond threshold:")
+            print(json.dumps(regressions, indent=2))
+            sys.exit(1)
+        print("No regressions beyond threshold")
@@ -1,6 +1,6 @@
 import streamlit as st
 import time
-from utils.redis_client import send_message, get_messages, close_chatroom
+from utils.redis_client import send_message, get_message_snapshot, close_chatroom
 from utils.ui_elements import display_title, display_room_code, display_chat_message, play_sound
 from utils.thread_manager import ThreadManager
 from components.host import handle_join_requests
@@ -53,8 +53,8 @@ def chat_interface():
         with st.container():
             st.markdown('<div class="chat-container" id="chat-container">', unsafe_allow_html=True)
             
-            # Get messages from Redis
-            messages = get_messages(st.session_state.room_id)
+            # Get recent messages from the room's precomputed snapshot
+            messages = get_message_snapshot(st.session_state.room_id)["messages"]
             
             # Initialize message count for notification
             if "message_count" not in st.session_state:
@@ -66,7 +66,9 @@ def chat_interface():
                     msg["username"], 
                     msg["content"], 
                     msg["type"], 
-                    st.session_state.username
+                    st.session_state.username,
+                    message_id=msg["id"],
+                    compression=msg.get("compression")
                 )
             
             # Check for new messages and play sound
@@ -1,7 +1,10 @@
 import streamlit as st
-import time
-from utils.supabase_client import get_chatroom_by_code, join_request
+from utils.redis_client import get_chatroom_by_code, join_request, wait_for_request_status, cancel_join_request
 from utils.ui_elements import display_title, create_retro_animation
+from utils.profiling import profiled
+
+# Seconds the waiting room blocks on the request status before rerunning
+REQUEST_WAIT_TIMEOUT = 2
 
 def join_chatroom():
     """Interface for joining an existing chatroom"""
@@ -34,7 +37,7 @@ def join_chatroom():
         # Show retro loading animation
         create_retro_animation()
         
-        # Get chatroom info from Supabase
+        # Get chatroom info from Redis
         result = get_chatroom_by_code(room_code)
         
         if result["success"]:
@@ -48,6 +51,7 @@ def join_chatroom():
                 st.session_state.pending_request_id = request_result["request_id"]
                 st.session_state.pending_room_id = chatroom["id"]
                 st.session_state.pending_room_name = chatroom["name"]
+                st.session_state.pending_room_code = room_code
                 st.session_state.pending_username = username
                 st.session_state.page = "waiting"
                 
@@ -57,11 +61,19 @@ def join_chatroom():
         else:
             st.error(f"Error: {result.get('error', 'Unknown error')}")
 
+def clear_pending_request():
+    """Remove the pending join request from session state"""
+    for key in ["pending_request_id", "pending_room_id", "pending_room_name",
+                "pending_room_code", "pending_username"]:
+        if key in st.session_state:
+            del st.session_state[key]
+
+@profiled("waiting")
 def waiting_room():
     """Waiting room for pending join requests"""
     if "pending_request_id" not in st.session_state:
         st.session_state.page = "join"
-        st.experimental_rerun()
+        st.rerun()
         return
     
     display_title("WAITING FOR APPROVAL", f"Room: {st.session_state.pending_room_name}")
@@ -81,50 +93,37 @@ def waiting_room():
         unsafe_allow_html=True
     )
     
-    # Check request status periodically
-    if "check_timer" not in st.session_state:
-        st.session_state.check_timer = time.time()
-    
-    # Every 3 seconds, check the request status
-    if time.time() - st.session_state.check_timer > 3:
-        st.session_state.check_timer = time.time()
-        
-        # Here you would check the request status from Supabase
-        # For now, we'll simulate with a placeholder
-        
-        # If request is approved
-        if st.button("SIMULATE APPROVAL (Remove in production)", key="sim_approval"):
-            st.session_state.room_id = st.session_state.pending_room_id
-            st.session_state.room_name = st.session_state.pending_room_name
-            st.session_state.username = st.session_state.pending_username
-            st.session_state.is_host = False
-            st.session_state.page = "chat"
-            
-            # Clean up pending state
-            if "pending_request_id" in st.session_state:
-                del st.session_state.pending_request_id
-            if "pending_room_id" in st.session_state:
-                del st.session_state.pending_room_id
-            if "pending_room_name" in st.session_state:
-                del st.session_state.pending_room_name
-            if "pending_username" in st.session_state:
-                del st.session_state.pending_username
-            
-            st.experimental_rerun()
-    
-    # Cancel button
+    # Cancel button (rendered before we block so it stays clickable)
     if st.button("CANCEL REQUEST", key="cancel_request"):
-        # Here you would cancel the request in Supabase
-        
-        # Clean up session state
-        if "pending_request_id" in st.session_state:
-            del st.session_state.pending_request_id
-        if "pending_room_id" in st.session_state:
-            del st.session_state.pending_room_id
-        if "pending_room_name" in st.session_state:
-            del st.session_state.pending_room_name
-        if "pending_username" in st.session_state:
-            del st.session_state.pending_username
+        # Remove the pending request so it disappears from the host's panel
+        cancel_join_request(st.session_state.pending_request_id)
+        clear_pending_request()
         
         st.session_state.page = "join"
-        st.experimental_rerun()
+        st.rerun()
+    
+    # Block on the request status; the host's decision wakes us up immediately
+    status = wait_for_request_status(st.session_state.pending_request_id, timeout=REQUEST_WAIT_TIMEOUT)
+    
+    if status == "approved":
+        st.session_state.room_id = st.session_state.pending_room_id
+        st.session_state.current_room_name = st.session_state.pending_room_name
+        st.session_state.room_code = st.session_state.pending_room_code
+        st.session_state.username = st.session_state.pending_username
+        st.session_state.is_host = False
+        st.session_state.page = "chat"
+        clear_pending_request()
+        st.rerun()
+    elif status == "rejected":
+        clear_pending_request()
+        st.session_state.join_error = "The host rejected your request"
+        st.session_state.page = "join"
+        st.rerun()
+    elif status is None:
+        clear_pending_request()
+        st.session_state.join_error = "Your join request has expired"
+        st.session_state.page = "join"
+        st.rerun()
+    
+    # Still pending, keep waiting
+    st.rerun()
@@ -0,0 +1,354 @@
+"""
+Lightweight HTTP/WebSocket gateway for Retro Chat
+
+Exposes the chat data layer to thin clients and bots. It uses the same Redis
+keys and pub/sub channels as utils/redis_client.py, so gateway clients and
+the Streamlit UI can share rooms.
+
+Per-room routes need a room token, sent as `Authorization: Bearer <token>`
+(or `?token=` where headers can't be set, e.g. browser WebSockets). The host
+gets one when creating a room and a guest once their join request has been
+approved, so knowing a room's code or id is not enough to use it.
+
+Run with:
+    uvicorn gateway:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import json
+import math
+from collections import defaultdict
+import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from utils.redis_client import get_chat_service, get_redis_settings, MessageTooLarge, RoomClosed, REQUEST_PREFIX, TRANSCRIPT_FORMATS
+from utils.codecs import decode_record, inflate_message
+
+# Events buffered per socket before a slow client starts missing events
+SOCKET_QUEUE_SIZE = 256
+
+# Pub/sub channels that make up a room's event stream
+ROOM_CHANNELS = ("messages", "join-requests", "chatroom")
+
+# Longest a request status lookup may wait for a decision (seconds)
+MAX_STATUS_TIMEOUT = 30
+
+class RoomHub:
+    """
+    Fan out room events from one shared pub/sub connection to many sockets
+    
+    Each room is subscribed once per process, however many sockets watch
+    it, so thousands of sockets don't need thousands of Redis connections.
+    """
+    
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = client.pubsub()
+        self.listeners = defaultdict(set)
+        self._lock = asyncio.Lock()
+        self._reader = None
+    
+    async def join(self, room_id):
+        """Subscribe a new socket to a room and return its event queue"""
+        queue = asyncio.Queue(maxsize=SOCKET_QUEUE_SIZE)
+        async with self._lock:
+            if not self.listeners[room_id]:
+                await self.pubsub.subscribe(*[f"{channel}:{room_id}" for channel in ROOM_CHANNELS])
+            self.listeners[room_id].add(queue)
+            if self._reader is None:
+                self._reader = asyncio.create_task(self._read())
+        return queue
+    
+    async def leave(self, room_id, queue):
+        """Remove a socket and drop the room subscription if it was the last"""
+        async with self._lock:
+            self.listeners[room_id].discard(queue)
+            if not self.listeners[room_id]:
+                del self.listeners[room_id]
+                await self.pubsub.unsubscribe(*[f"{channel}:{room_id}" for channel in ROOM_CHANNELS])
+    
+    async def _read(self):
+        """Dispatch published events to the queues of the room's sockets"""
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except RedisConnectionError as e:
+                print(f"Error reading room events: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not message:
+                continue
+            
+            channel, _, room_id = message["channel"].decode("utf-8").partition(":")
+            try:
+                event = {"channel": channel, "data": json.loads(message["data"])}
+                # Thin clients get message contents already decompressed
+                if channel == "messages":
+                    event["data"] = inflate_message(event["data"])
+            except ValueError as e:
+                print(f"Error processing event on {channel}:{room_id}: {e}")
+                continue
+            
+            for queue in list(self.listeners.get(room_id, ())):
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    # Slow consumer: drop the event rather than stall the room
+                    pass
+
+def get_hub():
+    """Return the process-wide room hub"""
+    if not hasattr(app.state, "hub"):
+        redis_url, redis_password = get_redis_settings()
+        app.state.hub = RoomHub(aioredis.from_url(redis_url, password=redis_password))
+    return app.state.hub
+
+async def call_service(method, *args):
+    """Run a blocking ChatService method in the thread pool"""
+    return await run_in_threadpool(getattr(get_chat_service(), method), *args)
+
+async def wait_for_request_status(request_id, timeout):
+    """
+    Async ChatService.wait_for_request_status on the hub's asyncio client
+    
+    Long polls hold a Redis connection rather than one of the thread pool's
+    few threads, so waiting guests cannot stall the other routes.
+    """
+    client = get_hub().client
+    
+    # The decision may have been made before we started waiting
+    request_data = await client.get(f"{REQUEST_PREFIX}{request_id}")
+    if not request_data:
+        return None
+    
+    status = decode_record(request_data)["status"]
+    if status != "pending":
+        return status
+    
+    result = await client.blpop(f"{REQUEST_PREFIX}status:{request_id}", timeout=timeout)
+    if not result:
+        return "pending"
+    return result[1].decode("utf-8")
+
+def parse_message(body):
+    """Return (content, idempotency key) from a posted message, or raise ValueError"""
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    content = body.get("content")
+    if not content or not isinstance(content, str):
+        raise ValueError("content is required and must be a string")
+    idempotency_key = body.get("idempotency_key")
+    if idempotency_key is not None and not isinstance(idempotency_key, str):
+        raise ValueError("idempotency_key must be a string")
+    return content, idempotency_key
+
+async def read_json(request):
+    """Return a request's JSON object body, or None if it isn't one"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+async def authorize(connection, room_id):
+    """Return the username the connection's room token grants in room_id, or None"""
+    scheme, _, token = connection.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer":
+        token = connection.query_params.get("token")
+    return await call_service("check_room_token", token, room_id)
+
+def unauthorized():
+    return JSONResponse({"success": False, "error": "A valid room token is required"}, status_code=401)
+
+def bad_request(error):
+    return JSONResponse({"success": False, "error": error}, status_code=400)
+
+# ----- HTTP endpoints -----
+
+async def create_room(request):
+    """POST /rooms {name, host_name}"""
+    body = await read_json(request) or {}
+    if not body.get("name") or not body.get("host_name"):
+        return JSONResponse({"success": False, "error": "name and host_name are required"}, status_code=400)
+    
+    result = await call_service("create_chatroom", body["name"], body["host_name"])
+    # The creator is the host, so they are let in straight away
+    result["token"] = await call_service(
+        "issue_room_token", result["id"], body["host_name"], f"host:{result['id']}"
+    )
+    return JSONResponse(result, status_code=201)
+
+async def get_room(request):
+    """GET /rooms/{code}"""
+    result = await call_service("get_chatroom_by_code", request.path_params["code"])
+    return JSONResponse(result, status_code=200 if result["success"] else 404)
+
+async def join_room(request):
+    """POST /rooms/{room_id}/join {username, idempotency_key?}"""
+    body = await read_json(request) or {}
+    if not body.get("username"):
+        return JSONResponse({"success": False, "error": "username is required"}, status_code=400)
+    
+    result = await call_service(
+        "join_request",
+        request.path_params["room_id"],
+        body["username"],
+        body.get("idempotency_key")
+    )
+    return JSONResponse(result, status_code=202)
+
+async def request_status(request):
+    """
+    GET /requests/{request_id}?timeout=<seconds> (waits for a decision)
+    
+    Once the request is approved the response carries the guest's room token
+    """
+    try:
+        timeout = float(request.query_params.get("timeout", 0))
+    except ValueError:
+        return bad_request("timeout must be a number of seconds")
+    if not math.isfinite(timeout) or timeout < 0:
+        return bad_request("timeout must be a number of seconds")
+    
+    # BLPOP treats 0 as "wait forever", so a plain lookup waits briefly instead
+    timeout = min(timeout, MAX_STATUS_TIMEOUT) or 0.01
+    request_id = request.path_params["request_id"]
+    status = await wait_for_request_status(request_id, timeout)
+    
+    if status is None:
+        return JSONResponse({"success": False, "error": "Request not found or expired"}, status_code=404)
+    result = {"success": True, "status": status}
+    if status == "approved":
+        result["token"] = await call_service("request_token", request_id)
+    return JSONResponse(result)
+
+async def send(request):
+    """POST /rooms/{room_id}/messages {content, idempotency_key?} (as the token's user)"""
+    room_id = request.path_params["room_id"]
+    username = await authorize(request, room_id)
+    if username is None:
+        return unauthorized()
+    
+    try:
+        content, idempotency_key = parse_message(await read_json(request))
+    except ValueError as e:
+        return bad_request(str(e))
+    
+    try:
+        message = await call_service("send_message", room_id, username, content, "user", idempotency_key)
+    except MessageTooLarge as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=413)
+    except RoomClosed as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=410)
+    return JSONResponse({"success": True, "message": inflate_message(message)}, status_code=201)
+
+async def history(request):
+    """GET /rooms/{room_id}/messages?since=<seq>"""
+    room_id = request.path_params["room_id"]
+    if await authorize(request, room_id) is None:
+        return unauthorized()
+    since = request.query_params.get("since")
+    
+    if since is None:
+        snapshot = await call_service("get_message_snapshot", room_id)
+        messages = [inflate_message(message) for message in snapshot["messages"]]
+        return JSONResponse({"success": True, "seq": snapshot["seq"], "messages": messages})
+    
+    try:
+        since = int(since)
+    except ValueError:
+        return bad_request("since must be a message sequence number")
+    
+    messages = await call_service("get_messages_since", room_id, since)
+    return JSONResponse({"success": True, "messages": [inflate_message(message) for message in messages]})
+
+async def transcript(request):
+    """GET /rooms/{room_id}/transcript?format=ndjson|text (streamed)"""
+    room_id = request.path_params["room_id"]
+    if await authorize(request, room_id) is None:
+        return unauthorized()
+    transcript_format = request.query_params.get("format", "ndjson")
+    if transcript_format not in TRANSCRIPT_FORMATS:
+        return JSONResponse({"success": False, "error": "format must be ndjson or text"}, status_code=400)
+    
+    # Starlette iterates the blocking generator in the thread pool
+    media_type, extension = TRANSCRIPT_FORMATS[transcript_format]
+    return StreamingResponse(
+        get_chat_service().export_transcript(room_id, transcript_format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="transcript-{room_id}.{extension}"'}
+    )
+
+async def attachment(request):
+    """GET /rooms/{room_id}/attachments/{attachment_id}?thumbnail=1"""
+    room_id = request.path_params["room_id"]
+    if await authorize(request, room_id) is None:
+        return unauthorized()
+    
+    thumbnail = request.query_params.get("thumbnail") == "1"
+    stored = await call_service("get_attachment", request.path_params["attachment_id"], thumbnail, room_id)
+    
+    if stored is None:
+        return JSONResponse({"success": False, "error": "Attachment not found or expired"}, status_code=404)
+    data, media_type = stored
+    return Response(data, media_type=media_type, headers={"Cache-Control": "private, max-age=86400, immutable"})
+
+# ----- WebSocket event stream -----
+
+async def room_events(websocket: WebSocket):
+    """
+    WS /rooms/{room_id}/events: stream of the room's pub/sub events
+    
+    Clients may also send {"content", "idempotency_key"?} frames to post
+    messages (as the token's user) over the same socket.
+    """
+    room_id = websocket.path_params["room_id"]
+    username = await authorize(websocket, room_id)
+    if username is None:
+        # Closing before the handshake is accepted refuses the connection
+        await websocket.close(code=1008)
+        return
+    hub = get_hub()
+    
+    await websocket.accept()
+    queue = await hub.join(room_id)
+    
+    async def forward_events():
+        while True:
+            event = await queue.get()
+            await websocket.send_text(json.dumps(event))
+    
+    sender = asyncio.create_task(forward_events())
+    try:
+        while True:
+            frame = await websocket.receive_text()
+            # A bad frame is answered with an error frame; the socket stays open
+            try:
+                content, idempotency_key = parse_message(json.loads(frame))
+                await call_service("send_message", room_id, username, content, "user", idempotency_key)
+            except ValueError as e:
+                await websocket.send_text(json.dumps({"channel": "error", "data": {"error": str(e)}}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        await hub.leave(room_id, queue)
+
+app = Starlette(routes=[
+    Route("/rooms", create_room, methods=["POST"]),
+    Route("/rooms/{code}", get_room, methods=["GET"]),
+    Route("/rooms/{room_id}/join", join_room, methods=["POST"]),
+    Route("/rooms/{room_id}/messages", send, methods=["POST"]),
+    Route("/rooms/{room_id}/messages", history, methods=["GET"]),
+    Route("/rooms/{room_id}/transcript", transcript, methods=["GET"]),
+    Route("/requests/{request_id}", request_status, methods=["GET"]),
+    Route("/rooms/{room_id}/attachments/{attachment_id}", attachment, methods=["GET"]),
+    WebSocketRoute("/rooms/{room_id}/events", room_events),
+])
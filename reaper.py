@@ -0,0 +1,50 @@
+"""
+Close chatrooms that have gone idle
+
+Idle rooms are found through the `rooms:active` activity index (a sorted set
+scored by last activity), so each pass costs O(log n) plus the rooms it
+closes, however many rooms are open. Closed rooms are archived like rooms
+closed by their host, and their guests are told the room has closed. A
+room only closes if it is still idle at that moment.
+
+Run with:
+    python reaper.py --idle-minutes 60 --interval 60
+
+Pass --once to reap a single time (e.g. from cron).
+"""
+import argparse
+import time
+from utils.redis_client import reap_idle_rooms, room_counts
+
+def reap(idle_seconds, batch):
+    """Close idle rooms in batches until none are left"""
+    total = 0
+    while True:
+        reaped = reap_idle_rooms(idle_seconds, batch)
+        total += len(reaped)
+        if len(reaped) < batch:
+            return total
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--idle-minutes", type=float, default=60, help="close rooms idle for longer than this")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between passes")
+    parser.add_argument("--batch", type=int, default=100, help="rooms closed per batch")
+    parser.add_argument("--once", action="store_true", help="reap once and exit")
+    args = parser.parse_args()
+
+    idle_seconds = args.idle_minutes * 60
+    while True:
+        try:
+            reaped = reap(idle_seconds, args.batch)
+            counts = room_counts(idle_seconds)
+            print(f"Reaped {reaped} idle rooms; {counts['open']} rooms open")
+        except Exception as e:
+            print(f"Error reaping idle rooms: {e}")
+
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
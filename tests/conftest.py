@@ -0,0 +1,17 @@
+import fakeredis
+import pytest
+from utils.redis_client import ChatService
+
+@pytest.fixture
+def client():
+    """An in-memory Redis (with Lua scripting) private to one test"""
+    return fakeredis.FakeRedis()
+
+@pytest.fixture
+def service(client):
+    return ChatService(client)
+
+@pytest.fixture
+def room(service):
+    """The id of a freshly created chatroom"""
+    return service.create_chatroom("Test room", "host")["id"]
@@ -0,0 +1,33 @@
+import json
+from utils.redis_client import ARCHIVE_PREFIX, MESSAGE_PREFIX
+
+def test_closing_a_room_archives_its_messages(service, client, room):
+    sent = [service.send_message(room, "alice", str(i)) for i in range(3)]
+    service.close_chatroom(room)
+    
+    assert client.exists(f"{ARCHIVE_PREFIX}{room}")
+    assert not any(client.exists(f"{MESSAGE_PREFIX}{message['id']}") for message in sent)
+    assert client.zcard(f"{MESSAGE_PREFIX}seq-index:{room}") == 0
+    assert [message["content"] for message in service.get_messages(room)] == ["0", "1", "2"]
+
+def test_history_continues_after_the_archive(service, room):
+    for i in range(3):
+        service.send_message(room, "alice", str(i))
+    service.archive_chatroom(room)
+    service.send_message(room, "alice", "3")
+    
+    assert [message["seq"] for message in service.get_messages(room)] == [1, 2, 3, 4]
+    assert [message["content"] for message in service.get_messages(room, limit=2)] == ["2", "3"]
+    assert [message["content"] for message in service.get_messages_since(room, 2)] == ["2", "3"]
+    
+    # A second archive folds the first one in
+    assert service.archive_chatroom(room) == 4
+    assert [message["seq"] for message in service.iter_messages(room)] == [1, 2, 3, 4]
+
+def test_transcript_includes_archived_messages(service, room):
+    service.send_message(room, "alice", "archived")
+    service.archive_chatroom(room)
+    service.send_message(room, "alice", "live")
+    
+    lines = list(service.export_transcript(room))
+    assert [json.loads(line)["content"] for line in lines] == ["archived", "live"]
@@ -0,0 +1,88 @@
+from unittest import mock
+import pytest
+from utils import attachments, redis_client
+from utils.redis_client import ATTACHMENT_PREFIX, MessageTooLarge
+
+PREPARED = {
+    "image_type": "image/png",
+    "width": 1,
+    "height": 1,
+    "thumbnail": b"t" * 10,
+    "thumbnail_type": "image/png"
+}
+IMAGE = b"i" * 100
+
+def quota_used(client, room):
+    return int(client.get(f"{ATTACHMENT_PREFIX}bytes:{room}") or 0)
+
+def stored_images(client):
+    return [key for key in client.keys(f"{ATTACHMENT_PREFIX}*") if b"bytes:" not in key]
+
+def test_attachment_is_stored_and_charged(service, client, room):
+    message = service.send_attachment(room, "alice", IMAGE, PREPARED, "caption")
+    
+    assert quota_used(client, room) == 110
+    assert service.get_attachment(message["attachment"]["id"]) == (IMAGE, "image/png")
+    assert service.get_attachment(message["attachment"]["id"], chatroom_id="another room") is None
+
+def test_retried_upload_is_charged_once(service, client, room):
+    first = service.send_attachment(room, "alice", IMAGE, PREPARED, idempotency_key="k1")
+    retry = service.send_attachment(room, "alice", IMAGE, PREPARED, idempotency_key="k1")
+    
+    assert retry["id"] == first["id"]
+    assert quota_used(client, room) == 110
+    assert len(stored_images(client)) == 2
+
+def test_quota_is_enforced(service, client, room, monkeypatch):
+    monkeypatch.setattr(redis_client, "MAX_ROOM_ATTACHMENT_BYTES", 200)
+    service.send_attachment(room, "alice", IMAGE, PREPARED)
+    
+    with pytest.raises(MessageTooLarge):
+        service.send_attachment(room, "alice", IMAGE, PREPARED, idempotency_key="k1")
+    assert quota_used(client, room) == 110
+    
+    # The refused upload did not keep its idempotency key
+    monkeypatch.setattr(redis_client, "MAX_ROOM_ATTACHMENT_BYTES", 300)
+    assert service.send_attachment(room, "alice", IMAGE, PREPARED, idempotency_key="k1")
+
+def test_failed_upload_is_refunded(service, client, room):
+    with mock.patch.object(service, "send_message", side_effect=ConnectionError("down")):
+        with pytest.raises(ConnectionError):
+            service.send_attachment(room, "alice", IMAGE, PREPARED, idempotency_key="k1")
+    
+    assert quota_used(client, room) == 0
+    assert stored_images(client) == []
+    
+    message = service.send_attachment(room, "alice", IMAGE, PREPARED, idempotency_key="k1")
+    assert message["attachment"]["id"]
+    assert quota_used(client, room) == 110
+
+def test_posted_attachment_survives_a_later_failure(service, client, room):
+    with mock.patch.object(service, "update_message_snapshot", side_effect=ConnectionError("down")):
+        with pytest.raises(ConnectionError):
+            service.send_attachment(room, "alice", IMAGE, PREPARED, idempotency_key="k1")
+    
+    # The message was posted, so its image and quota stay
+    message = service.get_messages(room)[-1]
+    assert service.get_attachment(message["attachment"]["id"]) == (IMAGE, "image/png")
+    assert quota_used(client, room) == 110
+
+def test_broken_thumbnail_pool_is_replaced(monkeypatch):
+    broken = mock.Mock()
+    broken.submit.return_value.result.side_effect = attachments.BrokenProcessPool()
+    attachments.get_thumbnail_pool.cache_clear()
+    monkeypatch.setattr(attachments, "ProcessPoolExecutor", mock.Mock(side_effect=[broken, mock.sentinel.fresh]))
+    
+    with pytest.raises(attachments.AttachmentError):
+        attachments.prepare_attachment(IMAGE)
+    broken.shutdown.assert_called_once_with(wait=False)
+    assert attachments.get_thumbnail_pool() is mock.sentinel.fresh
+    attachments.get_thumbnail_pool.cache_clear()
+
+def test_slow_thumbnail_is_an_attachment_error(monkeypatch):
+    pool = mock.Mock()
+    pool.submit.return_value.result.side_effect = attachments.FutureTimeoutError()
+    monkeypatch.setattr(attachments, "get_thumbnail_pool", lambda: pool)
+    
+    with pytest.raises(attachments.AttachmentError):
+        attachments.prepare_attachment(IMAGE)
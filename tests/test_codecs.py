@@ -0,0 +1,90 @@
+import os
+import base64
+import struct
+import pytest
+from utils import codecs
+from utils.codecs import CompactCodec, decode_record, get_codec
+
+RECORD = {
+    "id": "m1",
+    "chatroom_id": "r1",
+    "username": "alice",
+    "content": "héllo",
+    "type": "user",
+    "created_at": "2025-06-01T12:34:56.789012",
+    "attachment": {"id": "a1", "bytes": 10}
+}
+
+@pytest.mark.parametrize("name", ["json", "compact"])
+def test_records_round_trip(name):
+    assert decode_record(get_codec(name).encode(RECORD)) == RECORD
+
+@pytest.mark.parametrize("created_at", [
+    "2025-06-01T12:34:56.789012",
+    "2025-06-01T12:34:56",
+    "2025-06-01T12:34:56.789012+00:00",
+    "2025-06-01T07:04:56.789012-05:30",
+    "2025-06-01T12:34:56Z",
+    "2025-06-01",
+    "yesterday"
+])
+def test_compact_timestamps_decode_to_the_same_string(created_at):
+    record = {"id": "m1", "created_at": created_at}
+    assert decode_record(CompactCodec().encode(record)) == record
+
+def test_compact_reads_millisecond_timestamps():
+    # Tag 5 is how created_at was written before offsets were kept
+    data = CompactCodec.version + bytes([5]) + struct.pack(">Q", 1748781296789)
+    assert decode_record(data)["created_at"].startswith("2025-06-01T")
+
+def test_compact_is_smaller_than_json():
+    assert len(get_codec("compact").encode(RECORD)) < len(get_codec("json").encode(RECORD))
+
+def test_json_records_from_before_codecs_decode():
+    assert decode_record('{"id": "m1"}') == {"id": "m1"}
+
+def test_unknown_codecs_are_rejected():
+    with pytest.raises(ValueError):
+        get_codec("yaml")
+    with pytest.raises(ValueError):
+        decode_record(b"\x7f")
+
+@pytest.mark.skipif(codecs.msgpack is None, reason="msgpack is not installed")
+def test_msgpack_records_round_trip():
+    assert decode_record(get_codec("msgpack").encode(RECORD)) == RECORD
+
+def test_small_contents_are_stored_as_they_are():
+    assert codecs.pack_content("hi") == ("hi", None)
+
+def test_large_contents_are_compressed():
+    content = "retro " * 1000
+    stored, compression = codecs.pack_content(content, "zlib")
+    
+    assert compression == "zlib"
+    assert len(stored) < len(content)
+    assert codecs.message_content({"content": stored, "compression": compression}) == content
+
+def test_incompressible_contents_are_not_compressed():
+    content = base64.b85encode(os.urandom(2000)).decode("ascii")
+    assert codecs.pack_content(content) == (content, None)
+
+def test_oversized_contents_are_refused(monkeypatch):
+    monkeypatch.setattr(codecs, "MAX_MESSAGE_BYTES", 10)
+    with pytest.raises(codecs.MessageTooLarge):
+        codecs.pack_content("x" * 11)
+
+def test_compressed_messages_are_inflated_for_readers(service, room):
+    content = "retro " * 1000
+    sent = service.send_message(room, "alice", content)
+    
+    stored = service.get_messages(room)[-1]
+    assert stored["compression"] == "zlib"
+    assert codecs.inflate_message(stored)["content"] == content
+    assert "compression" not in codecs.inflate_message(stored)
+    assert codecs.inflate_message(sent)["content"] == content
+
+@pytest.mark.skipif(codecs.zstandard is None, reason="zstandard is not installed")
+def test_zstd_compressed_contents_round_trip():
+    content = "retro " * 1000
+    stored, compression = codecs.pack_content(content, "zstd")
+    assert codecs.message_content({"content": stored, "compression": compression}) == content
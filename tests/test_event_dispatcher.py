@@ -0,0 +1,48 @@
+import json
+import threading
+import pytest
+from utils.event_dispatcher import EventDispatcher
+
+@pytest.fixture
+def dispatcher(client):
+    dispatcher = EventDispatcher(client)
+    yield dispatcher
+    if dispatcher._thread is not None:
+        dispatcher._thread.stop()
+
+def test_live_close_notifies_sessions_and_drops_subscriptions(dispatcher, service, room):
+    closed = threading.Event()
+    evicted = []
+    dispatcher.add_close_hook(evicted.append)
+    
+    def on_room_event(message):
+        if json.loads(message["data"])["type"] == "closed":
+            closed.set()
+    
+    dispatcher.subscribe(f"messages:{room}", "session", lambda message: None)
+    dispatcher.subscribe(f"chatroom:{room}", "session", on_room_event)
+    service.close_chatroom(room)
+    
+    assert closed.wait(2)
+    assert dispatcher.is_closed(room)
+    assert evicted == [room]
+    assert dict(dispatcher.handlers) == {}
+
+def test_close_missed_while_unsubscribed_is_read_from_the_record(dispatcher, service, room):
+    evicted = []
+    dispatcher.add_close_hook(evicted.append)
+    assert not dispatcher.check_closed(room)
+    
+    # Closed before this process subscribed, so the event was never seen
+    service.close_chatroom(room)
+    assert not dispatcher.is_closed(room)
+    assert dispatcher.check_closed(room)
+    assert dispatcher.is_closed(room)
+    assert evicted == [room]
+    
+    # Later checks answer from memory without running the hooks again
+    assert dispatcher.check_closed(room)
+    assert evicted == [room]
+
+def test_expired_room_counts_as_closed(dispatcher):
+    assert dispatcher.check_closed("no such room")
@@ -0,0 +1,109 @@
+import threading
+import fakeredis
+import pytest
+from starlette.testclient import TestClient
+from utils.redis_client import ChatService
+import gateway
+
+@pytest.fixture
+def service(monkeypatch):
+    """A ChatService and the gateway's asyncio client sharing one fake server"""
+    server = fakeredis.FakeServer()
+    service = ChatService(fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(gateway, "get_chat_service", lambda: service)
+    monkeypatch.setattr(gateway.aioredis, "from_url", lambda *args, **kwargs: fakeredis.aioredis.FakeRedis(server=server))
+    monkeypatch.delattr(gateway.app.state, "hub", raising=False)
+    return service
+
+@pytest.fixture
+def client(service):
+    with TestClient(gateway.app) as client:
+        yield client
+
+@pytest.fixture
+def host(client):
+    """(room id, host token) of a room created through the gateway"""
+    created = client.post("/rooms", json={"name": "Test room", "host_name": "host"}).json()
+    return created["id"], created["token"]
+
+def test_per_room_routes_need_a_token(client, host):
+    room, token = host
+    
+    assert client.get(f"/rooms/{room}/messages").status_code == 401
+    assert client.get(f"/rooms/{room}/messages?token=wrong").status_code == 401
+    assert client.get(f"/rooms/{room}/messages", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+
+def test_tokens_are_scoped_to_their_room(client, host):
+    _, token = host
+    other_room = client.post("/rooms", json={"name": "Other room", "host_name": "host"}).json()["id"]
+    
+    assert client.get(f"/rooms/{other_room}/messages?token={token}").status_code == 401
+
+def test_approved_guest_gets_a_token(client, service, host):
+    room, _ = host
+    request_id = client.post(f"/rooms/{room}/join", json={"username": "guest"}).json()["request_id"]
+    
+    pending = client.get(f"/requests/{request_id}").json()
+    assert pending["status"] == "pending" and "token" not in pending
+    
+    service.approve_requests(room, [request_id])
+    approved = client.get(f"/requests/{request_id}").json()
+    assert approved["status"] == "approved"
+    assert client.get(f"/requests/{request_id}").json()["token"] == approved["token"]
+    
+    sent = client.post(f"/rooms/{room}/messages?token={approved['token']}", json={"content": "hi"}).json()
+    assert sent["message"]["username"] == "guest"
+
+def test_long_poll_returns_the_decision(client, service, host):
+    room, _ = host
+    request_id = client.post(f"/rooms/{room}/join", json={"username": "guest"}).json()["request_id"]
+    
+    timer = threading.Timer(0.2, service.approve_requests, (room, [request_id]))
+    timer.start()
+    assert client.get(f"/requests/{request_id}?timeout=5").json()["status"] == "approved"
+    timer.join()
+
+@pytest.mark.parametrize("query", ["timeout=abc", "timeout=nan", "timeout=-1"])
+def test_bad_timeouts_are_rejected(client, host, query):
+    room, _ = host
+    request_id = client.post(f"/rooms/{room}/join", json={"username": "guest"}).json()["request_id"]
+    
+    assert client.get(f"/requests/{request_id}?{query}").status_code == 400
+
+@pytest.mark.parametrize("body", [{}, {"content": 5}, {"content": "hi", "idempotency_key": 1}, ["hi"]])
+def test_bad_messages_are_rejected(client, host, body):
+    room, token = host
+    
+    assert client.post(f"/rooms/{room}/messages?token={token}", json=body).status_code == 400
+
+def test_closed_room_refuses_messages(client, service, host):
+    room, token = host
+    service.close_chatroom(room)
+    
+    assert client.post(f"/rooms/{room}/messages?token={token}", json={"content": "hi"}).status_code == 410
+
+def test_bad_since_is_rejected(client, host):
+    room, token = host
+    
+    assert client.get(f"/rooms/{room}/messages?since=x&token={token}").status_code == 400
+
+def test_socket_without_a_token_is_refused(client, host):
+    room, _ = host
+    
+    with pytest.raises(Exception):
+        with client.websocket_connect(f"/rooms/{room}/events") as socket:
+            socket.receive_text()
+
+@pytest.mark.parametrize("frame", ["not json", "[1, 2]", '{"content": 5}', '{"content": ""}'])
+def test_bad_frames_get_an_error_frame(client, service, host, frame):
+    room, token = host
+    
+    with client.websocket_connect(f"/rooms/{room}/events?token={token}") as socket:
+        socket.send_text(frame)
+        assert socket.receive_json()["channel"] == "error"
+        
+        # The socket is still usable afterwards
+        socket.send_json({"content": "hi"})
+        event = socket.receive_json()
+    assert event["channel"] == "messages"
+    assert event["data"]["content"] == "hi"
@@ -0,0 +1,52 @@
+from unittest import mock
+import pytest
+from utils.redis_client import IDEMPOTENCY_PREFIX, MESSAGE_PREFIX
+
+def test_retried_message_is_posted_once(service, room):
+    first = service.send_message(room, "alice", "hi", idempotency_key="k1")
+    retry = service.send_message(room, "alice", "hi", idempotency_key="k1")
+    
+    assert retry["id"] == first["id"]
+    assert retry["seq"] == first["seq"] == 1
+    assert [message["id"] for message in service.get_messages(room)] == [first["id"]]
+
+def test_keys_are_scoped_to_their_room(service, room):
+    other_room = service.create_chatroom("Other room", "host")["id"]
+    first = service.send_message(room, "alice", "hi", idempotency_key="k1")
+    other = service.send_message(other_room, "alice", "hi", idempotency_key="k1")
+    
+    assert other["id"] != first["id"]
+    assert other["seq"] == 1
+
+def test_failed_send_leaves_no_claim(service, client, room):
+    with mock.patch.object(client, "eval", side_effect=ConnectionError("down")):
+        with pytest.raises(ConnectionError):
+            service.send_message(room, "alice", "hi", idempotency_key="k1")
+    
+    assert not client.exists(f"{IDEMPOTENCY_PREFIX}message:{room}:k1")
+    message = service.send_message(room, "alice", "hi", idempotency_key="k1")
+    assert message["seq"] == 1
+
+def test_retry_of_unindexed_message_has_no_seq(service, client, room):
+    first = service.send_message(room, "alice", "hi", idempotency_key="k1")
+    client.zrem(f"{MESSAGE_PREFIX}seq-index:{room}", first["id"])
+    
+    retry = service.send_message(room, "alice", "hi", idempotency_key="k1")
+    assert retry["id"] == first["id"]
+    assert "seq" not in retry
+
+def test_retried_join_request_reuses_the_request(service, room):
+    first = service.join_request(room, "bob", idempotency_key="k1")
+    retry = service.join_request(room, "bob", idempotency_key="k1")
+    
+    assert retry["request_id"] == first["request_id"]
+    assert len(service.get_pending_requests(room)) == 1
+
+def test_failed_join_request_leaves_no_claim(service, client, room):
+    with mock.patch("redis.client.Pipeline.execute", side_effect=ConnectionError("down")):
+        with pytest.raises(ConnectionError):
+            service.join_request(room, "bob", idempotency_key="k1")
+    
+    assert not client.exists(f"{IDEMPOTENCY_PREFIX}join:{room}:k1")
+    request = service.join_request(room, "bob", idempotency_key="k1")
+    assert [pending["id"] for pending in service.get_pending_requests(room)] == [request["request_id"]]
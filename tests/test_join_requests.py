@@ -0,0 +1,23 @@
+def test_only_pending_requests_are_decided(service, client, room):
+    request_ids = [service.join_request(room, username)["request_id"] for username in ("bob", "carol")]
+    
+    assert [request["username"] for request in service.approve_requests(room, request_ids[:1])] == ["bob"]
+    assert [request["username"] for request in service.reject_requests(request_ids)] == ["carol"]
+    assert service.approve_requests(room, request_ids) == []
+    
+    assert [message["content"] for message in service.get_messages(room)] == ["bob has joined the chatroom"]
+    assert [client.lrange(f"request:status:{request_id}", 0, -1) for request_id in request_ids] == [[b"approved"], [b"rejected"]]
+
+def test_concurrent_decision_retries_the_batch(service, room):
+    request_id = service.join_request(room, "bob")["request_id"]
+    queue_status_updates = service._queue_status_updates
+    
+    # Another host rejects the request between our read and our write
+    def reject_first(pipe, requests, status):
+        service._queue_status_updates = queue_status_updates
+        service.reject_requests([request_id])
+        queue_status_updates(pipe, requests, status)
+    service._queue_status_updates = reject_first
+    
+    assert service.approve_requests(room, [request_id]) == []
+    assert service.update_request_status(request_id, "approved") is None
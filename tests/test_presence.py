@@ -0,0 +1,69 @@
+import time
+from utils import redis_client
+from utils.presence import PresenceTracker
+from utils.redis_client import PRESENCE_PREFIX
+
+def online(service, room):
+    return sorted(service.get_presence(room)["usernames"])
+
+def tracker(service, alive=None):
+    # Heartbeats are sent by calling beat() rather than from the thread
+    return PresenceTracker(service, is_alive=alive.get if alive else None, interval=3600)
+
+def test_tracked_sessions_are_online(service, room):
+    presence = tracker(service)
+    presence.track("k1", room, "alice")
+    presence.track("k2", room, "bob")
+    
+    assert online(service, room) == ["alice", "bob"]
+    presence.forget("k2")
+    assert online(service, room) == ["alice"]
+
+def test_user_stays_online_while_another_session_holds_them(service, room):
+    presence = tracker(service)
+    presence.track("k1", room, "bob")
+    presence.track("k2", room, "bob")
+    
+    presence.forget("k1")
+    assert online(service, room) == ["bob"]
+    presence.forget("k2")
+    assert online(service, room) == []
+
+def test_disconnected_sessions_are_dropped(service, room):
+    alive = {"s1": True, "s2": True}
+    presence = tracker(service, alive)
+    presence.track("k1", room, "alice", "s1")
+    presence.track("k2", room, "bob", "s2")
+    
+    alive["s2"] = False
+    presence.beat()
+    assert online(service, room) == ["alice"]
+    assert list(presence.sessions) == ["k1"]
+
+def test_moving_rooms_or_renaming_leaves_the_old_entry(service, room):
+    other_room = service.create_chatroom("Other room", "host")["id"]
+    presence = tracker(service)
+    presence.track("k1", room, "carol")
+    
+    presence.track("k1", other_room, "carol")
+    assert online(service, room) == []
+    assert online(service, other_room) == ["carol"]
+    
+    presence.track("k1", other_room, "caz")
+    assert online(service, other_room) == ["caz"]
+
+def test_members_without_heartbeats_expire(service, client, room, monkeypatch):
+    monkeypatch.setattr(redis_client, "PRESENCE_TIMEOUT", 2)
+    presence = tracker(service)
+    presence.track("k1", room, "alice")
+    client.zadd(f"{PRESENCE_PREFIX}{room}", {"ghost": time.time() - 10})
+    
+    assert online(service, room) == ["alice"]
+    presence.beat()
+    assert client.zrange(f"{PRESENCE_PREFIX}{room}", 0, -1) == [b"alice"]
+
+def test_closing_a_room_clears_its_presence(service, client, room):
+    tracker(service).track("k1", room, "alice")
+    service.close_chatroom(room)
+    
+    assert not client.exists(f"{PRESENCE_PREFIX}{room}")
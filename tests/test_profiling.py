@@ -0,0 +1,54 @@
+import fakeredis
+import pytest
+from utils import profiling
+from utils.profiling import AccountingRedis, begin_run, profiled, recent_slow_ops
+from utils.redis_client import ChatService
+
+@pytest.fixture
+def accounting_client():
+    return AccountingRedis(connection_pool=fakeredis.FakeRedis().connection_pool)
+
+@pytest.fixture
+def run():
+    run = begin_run()
+    yield run
+    profiling._local.run = None
+
+def test_commands_and_pipelines_are_counted(accounting_client, run):
+    accounting_client.set("a", "1")
+    pipe = accounting_client.pipeline()
+    pipe.get("a")
+    pipe.get("b")
+    pipe.execute()
+    
+    assert run.redis_commands == 3
+    assert run.redis_round_trips == 2
+    assert run.bytes_sent > 0 and run.bytes_received > 0
+
+def test_transactions_count_their_watched_reads(accounting_client, run):
+    service = ChatService(accounting_client)
+    room = service.create_chatroom("Test room", "host")["id"]
+    request_id = service.join_request(room, "bob")["request_id"]
+    before = run.redis_round_trips
+    
+    service.reject_requests([request_id])
+    
+    # WATCH, the MGET of the requests, then the MULTI/EXEC batch
+    assert run.redis_round_trips - before == 3
+
+def test_nothing_is_counted_outside_a_run(accounting_client):
+    profiling._local.run = None
+    accounting_client.set("a", "1")
+    assert profiling.current_run() is None
+
+def test_slow_pages_are_logged(run, monkeypatch):
+    monkeypatch.setattr(profiling, "SLOW_OP_MS", 0.001)
+    
+    @profiled("test_page")
+    def page(chatroom_id):
+        sum(range(10000))
+    
+    page("room-1")
+    assert "test_page" in run.page_times
+    assert recent_slow_ops()[0]["op"] == "test_page"
+    assert recent_slow_ops()[0]["room_id"] == "room-1"
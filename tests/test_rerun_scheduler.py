@@ -0,0 +1,88 @@
+import threading
+import time
+from utils.rerun_scheduler import RerunScheduler
+
+class Wakes:
+    """Counts wake() calls and lets a test wait for them"""
+    
+    def __init__(self):
+        self.count = 0
+        self.event = threading.Event()
+    
+    def __call__(self):
+        self.count += 1
+        self.event.set()
+    
+    def wait(self, timeout=2):
+        fired = self.event.wait(timeout)
+        self.event.clear()
+        return fired
+
+def test_burst_of_events_wakes_once():
+    wakes = Wakes()
+    scheduler = RerunScheduler(coalesce_ms=50, max_per_second=0, wake=wakes)
+    queue = []
+    for i in range(10):
+        queue.append({"seq": i})
+        scheduler.notify()
+    
+    assert wakes.wait()
+    time.sleep(0.1)
+    assert wakes.count == 1
+    
+    scheduler.deliver(queue)
+    assert queue == []
+    assert [event["seq"] for event in scheduler.take_delivered()] == list(range(10))
+    assert scheduler.stats() == {"reruns_triggered": 1, "reruns_suppressed": 9}
+
+def test_nothing_runs_without_events():
+    wakes = Wakes()
+    RerunScheduler(coalesce_ms=10, wake=wakes)
+    
+    assert not wakes.wait(0.1)
+
+def test_wake_waits_for_the_coalescing_window():
+    wakes = Wakes()
+    scheduler = RerunScheduler(coalesce_ms=200, max_per_second=0, wake=wakes)
+    started = time.monotonic()
+    scheduler.notify()
+    
+    assert wakes.wait()
+    assert time.monotonic() - started >= 0.19
+
+def test_rate_cap_spaces_out_wakes():
+    wakes = Wakes()
+    scheduler = RerunScheduler(coalesce_ms=0, max_per_second=5, wake=wakes)
+    queue = [{}]
+    scheduler.notify()
+    assert wakes.wait()
+    first_at = time.monotonic()
+    scheduler.deliver(queue)
+    
+    queue.append({})
+    scheduler.notify()
+    assert wakes.wait()
+    assert time.monotonic() - first_at >= 0.19
+
+def test_events_delivered_by_another_run_cancel_the_timer():
+    wakes = Wakes()
+    scheduler = RerunScheduler(coalesce_ms=200, wake=wakes)
+    queue = [{}]
+    scheduler.notify()
+    
+    # e.g. the user typed a message before the window passed
+    scheduler.deliver(queue)
+    assert not wakes.wait(0.4)
+    
+    # The next event arms a new timer
+    queue.append({})
+    scheduler.notify()
+    assert wakes.wait()
+
+def test_without_wake_events_wait_for_the_next_run():
+    scheduler = RerunScheduler(coalesce_ms=0)
+    queue = [{}]
+    scheduler.notify()
+    
+    scheduler.deliver(queue)
+    assert len(scheduler.take_delivered()) == 1
@@ -0,0 +1,65 @@
+import time
+import pytest
+from utils.redis_client import ARCHIVE_PREFIX, CHATROOM_PREFIX, ROOMS_ACTIVE_KEY, ROOMS_BUSY_KEY, RoomClosed
+def test_sends_update_the_room_indexes(service, client, room):
+    quiet = service.create_chatroom("Quiet room", "host")["id"]
+    client.zadd(ROOMS_ACTIVE_KEY, {quiet: time.time() - 7200})
+    for i in range(3):
+        service.send_message(room, "alice", str(i))
+    
+    assert service.busiest_rooms() == [(room, 3), (quiet, 0)]
+    assert [room_id for room_id, _ in service.idle_rooms(3600)] == [quiet]
+    assert service.room_counts(3600) == {"open": 2, "idle": 1}
+    assert [(entry["id"], entry["messages"]) for entry in service.room_directory()] == [(room, 3), (quiet, 0)]
+
+def test_closed_rooms_leave_the_indexes(service, client, room):
+    service.send_message(room, "alice", "hi")
+    service.close_chatroom(room)
+    
+    # A closed room takes no more messages and is not re-added
+    with pytest.raises(RoomClosed):
+        service.send_message(room, "alice", "bye")
+    assert service.leave_chatroom(room, "alice") is None
+    assert [message["content"] for message in service.get_messages(room)] == ["hi"]
+    assert client.zscore(ROOMS_ACTIVE_KEY, room) is None
+    assert client.zscore(ROOMS_BUSY_KEY, room) is None
+    assert service.room_directory() == []
+
+def test_directory_skips_rooms_closed_while_it_is_read(service, room, monkeypatch):
+    zrevrange = service.client.zrevrange
+    
+    def zrevrange_then_close(*args):
+        room_ids = zrevrange(*args)
+        service.close_chatroom(room)
+        return room_ids
+    
+    monkeypatch.setattr(service.client, "zrevrange", zrevrange_then_close)
+    assert service.room_directory() == []
+
+def test_reaper_archives_idle_rooms(service, client, room):
+    client.zadd(ROOMS_ACTIVE_KEY, {room: time.time() - 7200})
+    
+    assert service.reap_idle_rooms(3600) == [room]
+    assert client.exists(f"{ARCHIVE_PREFIX}{room}")
+    assert service.get_messages(room)[-1]["content"] == "The chatroom was closed after being idle"
+
+def test_reaper_skips_rooms_active_since_they_were_listed(service, client, room):
+    client.zadd(ROOMS_ACTIVE_KEY, {room: time.time() - 7200})
+    idle_rooms = service.idle_rooms
+    
+    def idle_rooms_then_message(*args):
+        rooms = idle_rooms(*args)
+        service.send_message(room, "alice", "still here")
+        return rooms
+    service.idle_rooms = idle_rooms_then_message
+    
+    assert service.reap_idle_rooms(3600) == []
+    assert client.zscore(ROOMS_ACTIVE_KEY, room) is not None
+    assert not client.exists(f"{ARCHIVE_PREFIX}{room}")
+
+def test_closed_room_keeps_its_expiry(service, client, room):
+    ttl = client.ttl(f"{CHATROOM_PREFIX}{room}")
+    service.close_chatroom(room)
+    
+    assert 0 < client.ttl(f"{CHATROOM_PREFIX}{room}") <= ttl
+    assert 0 < client.ttl(f"{CHATROOM_PREFIX}closed:{room}") <= ttl
@@ -0,0 +1,48 @@
+import json
+from utils.redis_client import MESSAGE_PREFIX, SNAPSHOT_PREFIX
+
+def store_legacy_messages(client, room, count):
+    """Store messages the way rooms did before sequence numbers existed"""
+    for i in range(count):
+        message_id = f"legacy-{room}-{i}"
+        client.set(f"{MESSAGE_PREFIX}{message_id}", json.dumps({
+            "id": message_id,
+            "chatroom_id": room,
+            "username": "alice",
+            "content": f"old {i}",
+            "type": "user",
+            "created_at": "2025-01-01T00:00:00"
+        }))
+        client.rpush(f"{MESSAGE_PREFIX}list:{room}", message_id)
+
+def test_messages_get_consecutive_seqs(service, room):
+    seqs = [service.send_message(room, "alice", str(i))["seq"] for i in range(5)]
+    
+    assert seqs == [1, 2, 3, 4, 5]
+    assert [message["content"] for message in service.get_messages_since(room, 3)] == ["3", "4"]
+
+def test_legacy_messages_are_migrated_on_read(service, client, room):
+    store_legacy_messages(client, room, 3)
+    client.set(f"{SNAPSHOT_PREFIX}seq:{room}", 3)
+    
+    assert [(message["content"], message["seq"]) for message in service.get_messages(room)] == [
+        ("old 0", 1), ("old 1", 2), ("old 2", 3)
+    ]
+    assert not client.exists(f"{MESSAGE_PREFIX}list:{room}")
+    assert service.send_message(room, "alice", "new")["seq"] == 4
+
+def test_legacy_messages_are_migrated_on_send(service, client, room):
+    store_legacy_messages(client, room, 2)
+    
+    assert service.send_message(room, "alice", "new")["seq"] == 3
+    assert [message["seq"] for message in service.get_message_snapshot(room)["messages"]] == [1, 2, 3]
+
+def test_sequenced_messages_move_after_legacy_ones(service, client, room):
+    service.send_message(room, "alice", "new")
+    store_legacy_messages(client, room, 2)
+    
+    service.migrate_legacy_messages(room)
+    assert [(message["content"], message["seq"]) for message in service.get_messages(room)] == [
+        ("old 0", 1), ("old 1", 2), ("new", 3)
+    ]
+    assert service.send_message(room, "alice", "next")["seq"] == 4
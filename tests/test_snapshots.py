@@ -0,0 +1,45 @@
+import json
+import zlib
+from utils.redis_client import SNAPSHOT_PREFIX, SNAPSHOT_SIZE
+
+def test_snapshot_follows_sent_messages(service, room):
+    for i in range(SNAPSHOT_SIZE + 5):
+        service.send_message(room, "alice", str(i))
+    
+    snapshot = service.get_message_snapshot(room)
+    assert snapshot["seq"] == SNAPSHOT_SIZE + 5
+    assert len(snapshot["messages"]) == SNAPSHOT_SIZE
+    assert snapshot["messages"][-1]["content"] == str(SNAPSHOT_SIZE + 4)
+
+def test_older_snapshot_never_replaces_a_newer_one(service, client, room):
+    for i in range(3):
+        service.send_message(room, "alice", str(i))
+    stored = client.get(f"{SNAPSHOT_PREFIX}{room}")
+    
+    # A writer that read the room before the last message lost the race
+    service._store_message_snapshot(room, 2, [])
+    
+    assert client.get(f"{SNAPSHOT_PREFIX}{room}") == stored
+    assert json.loads(zlib.decompress(stored))["seq"] == 3
+
+def test_snapshot_with_a_gap_is_rebuilt(service, client, room):
+    first = service.send_message(room, "alice", "a")
+    service.send_message(room, "alice", "b")
+    
+    # The snapshot missed seq 2, so seq 3 cannot just be appended to it
+    client.delete(f"{SNAPSHOT_PREFIX}{room}", f"{SNAPSHOT_PREFIX}seq:{room}")
+    service._store_message_snapshot(room, 1, [first])
+    service.send_message(room, "alice", "c")
+    
+    snapshot = service.get_message_snapshot(room)
+    assert snapshot["seq"] == 3
+    assert [message["content"] for message in snapshot["messages"]] == ["a", "b", "c"]
+
+def test_missing_snapshot_is_rebuilt_from_the_index(service, client, room):
+    for i in range(3):
+        service.send_message(room, "alice", str(i))
+    client.delete(f"{SNAPSHOT_PREFIX}{room}", f"{SNAPSHOT_PREFIX}seq:{room}")
+    
+    snapshot = service.get_message_snapshot(room)
+    assert snapshot["seq"] == 3
+    assert [message["seq"] for message in snapshot["messages"]] == [1, 2, 3]
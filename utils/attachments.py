@@ -0,0 +1,114 @@
+"""
+Image attachment validation and thumbnailing
+
+Decoding and resizing images is CPU bound, so it runs in a process pool
+rather than on the Streamlit script thread (or holding the server's GIL).
+This module has no Streamlit dependency.
+"""
+import io
+import os
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Largest accepted upload in bytes
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(5 * 1024 * 1024)))
+
+# Largest accepted image in pixels, which also guards against decompression bombs
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(25_000_000)))
+
+# Longest side of a thumbnail in pixels
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+
+# Worker processes used for thumbnailing (defaults to the number of CPUs)
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "0")) or None
+
+# Seconds an upload may wait for its thumbnail
+THUMBNAIL_TIMEOUT = 30
+
+# Accepted image formats -> MIME type
+IMAGE_FORMATS = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "GIF": "image/gif",
+    "WEBP": "image/webp"
+}
+
+class AttachmentError(ValueError):
+    """Raised when an upload is not an acceptable image"""
+
+def process_image(data):
+    """
+    Validate an uploaded image and make its thumbnail
+    
+    Runs in a worker process. Returns a dict with the image's MIME type and
+    size and a JPEG (or PNG, if transparent) thumbnail; the original bytes
+    are not sent back, since the caller already has them.
+    """
+    if len(data) > MAX_ATTACHMENT_BYTES:
+        raise AttachmentError(f"Image is {len(data)} bytes; the limit is {MAX_ATTACHMENT_BYTES}")
+    
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+            width, height = image.size
+            image.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise AttachmentError(f"Not a valid image: {e}")
+    
+    if image_format not in IMAGE_FORMATS:
+        raise AttachmentError(f"Unsupported image format {image_format}")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise AttachmentError(f"Image is {width}x{height}; the limit is {MAX_IMAGE_PIXELS} pixels")
+    
+    # verify() leaves the image unusable, so decode it again
+    with Image.open(io.BytesIO(data)) as image:
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        
+        output = io.BytesIO()
+        if thumbnail.mode in ("RGBA", "LA", "P"):
+            thumbnail.save(output, "PNG", optimize=True)
+            thumbnail_type = "image/png"
+        else:
+            thumbnail.convert("RGB").save(output, "JPEG", quality=80)
+            thumbnail_type = "image/jpeg"
+    
+    return {
+        "image_type": IMAGE_FORMATS[image_format],
+        "width": width,
+        "height": height,
+        "thumbnail": output.getvalue(),
+        "thumbnail_type": thumbnail_type
+    }
+
+# Thumbnail pool singleton
+@functools.lru_cache(maxsize=None)
+def get_thumbnail_pool():
+    """Return the process pool shared by every session of this process"""
+    # Forking a threaded server process is unsafe, so workers are spawned
+    return ProcessPoolExecutor(
+        max_workers=THUMBNAIL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+def prepare_attachment(data):
+    """Validate and thumbnail an upload in the process pool and wait for it"""
+    # Obviously oversized uploads are refused without a round trip to a worker
+    if len(data) > MAX_ATTACHMENT_BYTES:
+        raise AttachmentError(f"Image is {len(data)} bytes; the limit is {MAX_ATTACHMENT_BYTES}")
+    
+    pool = get_thumbnail_pool()
+    try:
+        return pool.submit(process_image, data).result(timeout=THUMBNAIL_TIMEOUT)
+    except FutureTimeoutError:
+        raise AttachmentError(f"Processing the image took longer than {THUMBNAIL_TIMEOUT} seconds")
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for running out of memory), which breaks
+        # the whole pool: later uploads get a new one
+        if get_thumbnail_pool() is pool:
+            get_thumbnail_pool.cache_clear()
+        pool.shutdown(wait=False)
+        raise AttachmentError("The image could not be processed")
@@ -0,0 +1,301 @@
+"""
+Codecs for the records (rooms, join requests, messages) stored in Redis
+
+Every encoded value starts with a version byte naming its codec, so readers
+can decode a mix of formats while a new one is rolled out. The JSON codec's
+version byte is the opening '{' itself, which keeps it byte-for-byte
+compatible with values written before codecs existed.
+
+REDIS_CODEC picks the codec new values are written with. Keep it at "json"
+until every reader understands the new format, then switch.
+
+Large message contents are compressed on their own, before the record is
+encoded, and stay compressed until a message is rendered.
+"""
+import os
+import json
+import zlib
+import base64
+import struct
+from datetime import datetime, timedelta, timezone
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec used for newly written records
+REDIS_CODEC = os.getenv("REDIS_CODEC", "json")
+
+# Message contents larger than this many bytes are compressed
+MESSAGE_COMPRESS_BYTES = int(os.getenv("MESSAGE_COMPRESS_BYTES", "1024"))
+
+# Compression used for large message contents ("zlib" or "zstd")
+MESSAGE_COMPRESSION = os.getenv("MESSAGE_COMPRESSION", "zlib")
+
+# Hard limit on the size of a message's content in bytes (before compression)
+MAX_MESSAGE_BYTES = int(os.getenv("MAX_MESSAGE_BYTES", str(64 * 1024)))
+
+class JSONCodec:
+    """Plain JSON, as written before codecs existed"""
+    
+    name = "json"
+    version = b"{"
+    
+    def encode(self, record):
+        return json.dumps(record, separators=(",", ":")).encode("utf-8")
+    
+    def decode(self, data):
+        return json.loads(data)
+
+class MsgpackCodec:
+    """MessagePack behind a version byte (needs the msgpack package)"""
+    
+    name = "msgpack"
+    version = b"\x01"
+    
+    def encode(self, record):
+        if msgpack is None:
+            raise RuntimeError("The msgpack codec needs the msgpack package: pip install msgpack")
+        return self.version + msgpack.packb(record, use_bin_type=True)
+    
+    def decode(self, data):
+        if msgpack is None:
+            raise RuntimeError("Cannot decode a msgpack record without the msgpack package")
+        return msgpack.unpackb(data[1:], raw=False)
+
+# Field types of the compact codec. TIMESTAMP (epoch milliseconds, decoded in
+# local time) is only read: it lost microseconds and UTC offsets
+STRING, BOOLEAN, TIMESTAMP, WALL_TIMESTAMP = range(4)
+
+# Known record fields and their one-byte tags (append only: the index is the tag)
+COMPACT_FIELDS = (
+    ("id", STRING),
+    ("chatroom_id", STRING),
+    ("username", STRING),
+    ("content", STRING),
+    ("type", STRING),
+    ("created_at", TIMESTAMP),
+    ("status", STRING),
+    ("name", STRING),
+    ("code", STRING),
+    ("host_name", STRING),
+    ("is_active", BOOLEAN),
+    ("compression", STRING),
+    ("created_at", WALL_TIMESTAMP),
+)
+# A field listed twice is written with its last (newest) tag
+COMPACT_TAGS = {name: (tag, kind) for tag, (name, kind) in enumerate(COMPACT_FIELDS)}
+
+# Tag of the JSON object holding any fields the table does not cover
+EXTRA_TAG = 0xFF
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def _write_bytes(out, raw):
+    _write_varint(out, len(raw))
+    out += raw
+
+EPOCH = datetime(1970, 1, 1)
+
+# UTC offset stored for timestamps that have none
+NAIVE_OFFSET = -0x8000
+
+def _pack_timestamp(value):
+    """
+    Pack an ISO timestamp as wall-clock microseconds and UTC offset minutes
+    
+    Returns None if value isn't one, or wouldn't decode to the same string.
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    
+    offset = parsed.utcoffset()
+    minutes = NAIVE_OFFSET if offset is None else offset // timedelta(minutes=1)
+    micros = (parsed.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+    packed = struct.pack(">qh", micros, minutes)
+    if _unpack_timestamp(packed, 0)[0] != value:
+        return None
+    return packed
+
+def _unpack_timestamp(data, offset):
+    """Read a packed timestamp back as an ISO string, and the next offset"""
+    micros, minutes = struct.unpack_from(">qh", data, offset)
+    parsed = EPOCH + timedelta(microseconds=micros)
+    if minutes != NAIVE_OFFSET:
+        parsed = parsed.replace(tzinfo=timezone(timedelta(minutes=minutes)))
+    return parsed.isoformat(), offset + struct.calcsize(">qh")
+
+class CompactCodec:
+    """
+    Fixed-field binary encoding with one-byte field tags
+    
+    Strings are length-prefixed UTF-8, booleans a single byte and ISO
+    timestamps their wall-clock time in microseconds plus UTC offset;
+    anything else goes into a JSON extra field. Timestamps decode back to
+    the exact same string (one that would not, e.g. "Z" for UTC, is kept as
+    a string in the extra field) so records look the same whichever codec
+    wrote them.
+    """
+    
+    name = "compact"
+    version = b"\x02"
+    
+    def encode(self, record):
+        out = bytearray(self.version)
+        extra = {}
+        
+        for name, value in record.items():
+            tag, kind = COMPACT_TAGS.get(name, (None, None))
+            if kind == STRING and isinstance(value, str):
+                out.append(tag)
+                _write_bytes(out, value.encode("utf-8"))
+            elif kind == BOOLEAN and isinstance(value, bool):
+                out.append(tag)
+                out.append(value)
+            elif kind == WALL_TIMESTAMP and _pack_timestamp(value) is not None:
+                out.append(tag)
+                out += _pack_timestamp(value)
+            else:
+                extra[name] = value
+        
+        if extra:
+            out.append(EXTRA_TAG)
+            _write_bytes(out, json.dumps(extra, separators=(",", ":")).encode("utf-8"))
+        
+        return bytes(out)
+    
+    def decode(self, data):
+        record = {}
+        offset = 1
+        
+        while offset < len(data):
+            tag = data[offset]
+            offset += 1
+            
+            if tag == EXTRA_TAG:
+                length, offset = _read_varint(data, offset)
+                record.update(json.loads(data[offset:offset + length]))
+                offset += length
+                continue
+            
+            name, kind = COMPACT_FIELDS[tag]
+            if kind == STRING:
+                length, offset = _read_varint(data, offset)
+                record[name] = data[offset:offset + length].decode("utf-8")
+                offset += length
+            elif kind == BOOLEAN:
+                record[name] = bool(data[offset])
+                offset += 1
+            elif kind == WALL_TIMESTAMP:
+                record[name], offset = _unpack_timestamp(data, offset)
+            else:
+                (epoch_ms,) = struct.unpack_from(">Q", data, offset)
+                record[name] = datetime.fromtimestamp(epoch_ms / 1000).isoformat(timespec="milliseconds")
+                offset += 8
+        
+        return record
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), MsgpackCodec(), CompactCodec())}
+CODECS_BY_VERSION = {codec.version[0]: codec for codec in CODECS.values()}
+
+def get_codec(name=None):
+    """Return the codec called name (REDIS_CODEC by default)"""
+    name = name or REDIS_CODEC
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name!r}; expected one of {', '.join(CODECS)}")
+    if name == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack codec needs the msgpack package: pip install msgpack")
+    return CODECS[name]
+
+def decode_record(data):
+    """Decode a stored record written by any codec"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    
+    codec = CODECS_BY_VERSION.get(data[0])
+    if codec is None:
+        raise ValueError(f"Unknown record version byte {data[0]:#04x}")
+    return codec.decode(data)
+
+
+# ----- Message content compression -----
+
+class MessageTooLarge(ValueError):
+    """Raised when a message's content exceeds MAX_MESSAGE_BYTES"""
+
+def _zstd_compress(data):
+    if zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package: pip install zstandard")
+    return zstandard.ZstdCompressor().compress(data)
+
+def _zstd_decompress(data):
+    if zstandard is None:
+        raise RuntimeError("Cannot read a zstd-compressed message without the zstandard package")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+# Compression flag -> (compress, decompress)
+COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "zstd": (_zstd_compress, _zstd_decompress)
+}
+
+def pack_content(content, compression=None):
+    """
+    Prepare message content for storage
+    
+    Returns (content, compression flag); content above MESSAGE_COMPRESS_BYTES
+    comes back compressed and base64 encoded, smaller content unchanged with
+    a None flag. Raises MessageTooLarge above MAX_MESSAGE_BYTES.
+    """
+    raw = content.encode("utf-8")
+    if len(raw) > MAX_MESSAGE_BYTES:
+        raise MessageTooLarge(f"Message is {len(raw)} bytes; the limit is {MAX_MESSAGE_BYTES}")
+    if len(raw) <= MESSAGE_COMPRESS_BYTES:
+        return content, None
+    
+    compression = compression or MESSAGE_COMPRESSION
+    compressed = COMPRESSORS[compression][0](raw)
+    
+    # Incompressible content is cheaper to keep as it is
+    if len(compressed) * 4 / 3 >= len(raw):
+        return content, None
+    return base64.b64encode(compressed).decode("ascii"), compression
+
+def message_content(message):
+    """Return a stored message's content, decompressing it if needed"""
+    compression = message.get("compression")
+    if not compression:
+        return message["content"]
+    return COMPRESSORS[compression][1](base64.b64decode(message["content"])).decode("utf-8")
+
+def inflate_message(message):
+    """Return a copy of a stored message with its content decompressed"""
+    if not message or not message.get("compression"):
+        return message
+    message = dict(message, content=message_content(message))
+    del message["compression"]
+    return message
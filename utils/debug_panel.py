@@ -0,0 +1,128 @@
+import streamlit as st
+import cProfile
+import os
+import time
+from pathlib import Path
+from utils.profiling import begin_run, recent_slow_ops
+from utils.rerun_scheduler import get_rerun_scheduler
+
+# Directory cProfile dumps of profiled reruns are written to
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Number of slow operations listed in the panel
+SLOW_OPS_SHOWN = 20
+
+# Profile dumps kept in PROFILE_DIR; older ones are deleted
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "20"))
+
+def start_debug_run():
+    """Begin accounting this rerun, and profiling it if requested (operators only)"""
+    if not st.session_state.get("debug_panel"):
+        return None
+    
+    run = begin_run()
+    
+    # Profile every rerun with ?profile=1, or just the next one from the panel
+    if st.query_params.get("profile") == "1" or st.session_state.pop("profile_next_rerun", False):
+        run.profiler = cProfile.Profile()
+        run.profiler.enable()
+    
+    return run
+
+def write_profile(profiler):
+    """Write a cProfile dump for this session and return its path"""
+    profile_dir = Path(PROFILE_DIR)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    
+    path = profile_dir / f"rerun-{st.session_state.session_id}-{int(time.time() * 1000)}.prof"
+    profiler.dump_stats(path)
+    
+    # Keep only the newest dumps, so profiling every rerun can't fill the disk
+    dumps = sorted(profile_dir.glob("rerun-*.prof"), key=lambda dump: dump.stat().st_mtime, reverse=True)
+    for old in dumps[PROFILE_MAX_FILES:]:
+        old.unlink(missing_ok=True)
+    return str(path)
+
+def summarize_run(run):
+    """Reduce a run's statistics to the numbers shown in the panel"""
+    return {
+        "wall_ms": run.wall_time() * 1000,
+        "pages": {name: seconds * 1000 for name, seconds in run.page_times.items()},
+        "redis_commands": run.redis_commands,
+        "redis_round_trips": run.redis_round_trips,
+        "bytes_sent": run.bytes_sent,
+        "bytes_received": run.bytes_received,
+        "cache_hits": dict(run.cache_hits),
+        "cache_misses": dict(run.cache_misses)
+    }
+
+def display_debug_panel(summary, last_summary=None):
+    """Show the rerun's statistics in the sidebar"""
+    with st.sidebar:
+        st.markdown('<h3 class="cyan-text">DEBUG</h3>', unsafe_allow_html=True)
+        
+        st.markdown(f"**THIS RUN:** {summary['wall_ms']:.1f} ms")
+        for name, elapsed_ms in summary["pages"].items():
+            st.markdown(f"- `{name}`: {elapsed_ms:.1f} ms")
+        
+        st.markdown(
+            f"**REDIS:** {summary['redis_commands']} commands in "
+            f"{summary['redis_round_trips']} round trips, "
+            f"{summary['bytes_sent'] / 1024:.1f} KB sent / "
+            f"{summary['bytes_received'] / 1024:.1f} KB received"
+        )
+        
+        caches = sorted(set(summary["cache_hits"]) | set(summary["cache_misses"]))
+        for name in caches:
+            st.markdown(
+                f"**{name.upper()} CACHE:** {summary['cache_hits'].get(name, 0)} hits, "
+                f"{summary['cache_misses'].get(name, 0)} misses"
+            )
+        
+        scheduler = get_rerun_scheduler().stats()
+        st.markdown(
+            f"**RERUNS:** {scheduler['reruns_triggered']} triggered, "
+            f"{scheduler['reruns_suppressed']} suppressed"
+        )
+        
+        # Runs that end in st.rerun() are never displayed, so show the last one
+        if last_summary:
+            st.markdown(
+                f"**LAST RUN:** {last_summary['wall_ms']:.1f} ms, "
+                f"{last_summary['redis_commands']} commands in "
+                f"{last_summary['redis_round_trips']} round trips"
+            )
+        
+        # Only this session's slow operations: other sessions' rooms are private
+        slow_ops = recent_slow_ops(st.session_state.session_id)
+        with st.expander(f"SLOW OPS ({len(slow_ops)})"):
+            for entry in slow_ops[:SLOW_OPS_SHOWN]:
+                st.markdown(
+                    f"`{entry['op']}` {entry['elapsed_ms']:.0f} ms "
+                    f"(budget {entry['budget_ms']:.0f}) room `{entry['room_id'] or '-'}` "
+                    f"args {entry['arg_sizes']}"
+                )
+        
+        if st.session_state.get("last_profile_path"):
+            st.markdown(f"**PROFILE:** `{st.session_state.last_profile_path}`")
+        
+        if st.button("PROFILE NEXT RERUN", key="profile_next_rerun_button"):
+            st.session_state.profile_next_rerun = True
+            st.rerun()
+
+def finish_debug_run(run, completed):
+    """Write the rerun's profile and, if it ran to the end, show the panel"""
+    if run is None:
+        return
+    
+    if run.profiler is not None:
+        run.profiler.disable()
+        st.session_state.last_profile_path = write_profile(run.profiler)
+    
+    summary = summarize_run(run)
+    last_summary = st.session_state.get("last_run_summary")
+    st.session_state.last_run_summary = summary
+    
+    # A run interrupted by st.rerun() or st.stop() must not render anything
+    if completed:
+        display_debug_panel(summary, last_summary)
@@ -0,0 +1,142 @@
+"""
+Per-process fan-out of room events to the sessions watching them
+
+Every session used to open its own pub/sub connection and worker thread per
+room. The dispatcher keeps one connection and one worker thread for the
+whole process instead, and handles `chatroom:<id>` closed events itself:
+the room is marked closed and its subscriptions dropped, every watching
+session is told, and close hooks (cache eviction) run.
+
+Has no Streamlit dependency.
+"""
+import json
+import time
+import threading
+import functools
+from collections import OrderedDict, defaultdict
+from utils.redis_client import get_redis_client, CHATROOM_PREFIX
+from utils.codecs import decode_record
+
+# Closed rooms remembered per process, so late reruns still see the closure
+CLOSED_ROOMS_SIZE = 10000
+
+# Channel prefixes that make up a room's events
+ROOM_CHANNELS = ("messages", "join-requests", "chatroom")
+
+class EventDispatcher:
+    """One pub/sub connection per process, fanning room events out to handlers"""
+    
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.handlers = defaultdict(dict)
+        self.closed_rooms = OrderedDict()
+        self.close_hooks = []
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def subscribe(self, channel, key, callback):
+        """Call callback(message) for every event on channel until unsubscribed"""
+        with self._lock:
+            if not self.handlers[channel]:
+                self.pubsub.subscribe(**{channel: self._dispatch})
+            self.handlers[channel][key] = callback
+            
+            if self._thread is None:
+                self._thread = self.pubsub.run_in_thread(
+                    sleep_time=0.01,
+                    daemon=True,
+                    exception_handler=self._handle_error
+                )
+    
+    def unsubscribe(self, channel, key):
+        """Remove one handler, dropping the subscription when it was the last"""
+        with self._lock:
+            handlers = self.handlers.get(channel)
+            if handlers is None:
+                return
+            handlers.pop(key, None)
+            if not handlers:
+                del self.handlers[channel]
+                self.pubsub.unsubscribe(channel)
+    
+    def leave_room(self, room_id, key):
+        """Remove all of one subscriber's handlers for a room"""
+        for channel in ROOM_CHANNELS:
+            self.unsubscribe(f"{channel}:{room_id}", key)
+    
+    def add_close_hook(self, hook):
+        """Call hook(room_id) whenever a room is closed"""
+        self.close_hooks.append(hook)
+    
+    def is_closed(self, room_id):
+        """Whether this process has seen the room being closed"""
+        return room_id in self.closed_rooms
+    
+    def check_closed(self, room_id):
+        """
+        Whether the room is closed, reading its record if no close was seen
+        
+        The closed event is missed if it was published before this process
+        subscribed, or while its connection was down. A closed (or expired)
+        record is then handled as if the event had just arrived.
+        """
+        if self.is_closed(room_id):
+            return True
+        
+        record = self.client.get(f"{CHATROOM_PREFIX}{room_id}")
+        if record and decode_record(record).get("is_active", False):
+            return False
+        
+        self._dispatch({
+            "channel": f"chatroom:{room_id}".encode("utf-8"),
+            "data": json.dumps({"type": "closed"})
+        })
+        return True
+    
+    def _dispatch(self, message):
+        channel = message["channel"].decode("utf-8")
+        prefix, _, room_id = channel.partition(":")
+        closed = prefix == "chatroom" and json.loads(message["data"]).get("type") == "closed"
+        
+        with self._lock:
+            callbacks = list(self.handlers.get(channel, {}).values())
+            # Mark the room closed before any session is told about it
+            if closed:
+                self._close_room(room_id)
+        
+        for callback in callbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"Error handling event on {channel}: {e}")
+        
+        if closed:
+            for hook in self.close_hooks:
+                try:
+                    hook(room_id)
+                except Exception as e:
+                    print(f"Error evicting closed room {room_id}: {e}")
+    
+    def _close_room(self, room_id):
+        """Remember a room as closed and drop its subscriptions (lock held)"""
+        self.closed_rooms[room_id] = time.time()
+        while len(self.closed_rooms) > CLOSED_ROOMS_SIZE:
+            self.closed_rooms.popitem(last=False)
+        
+        # Nobody needs the room's events any more
+        channels = [f"{channel}:{room_id}" for channel in ROOM_CHANNELS]
+        subscribed = [channel for channel in channels if self.handlers.pop(channel, None)]
+        if subscribed:
+            self.pubsub.unsubscribe(*subscribed)
+    
+    def _handle_error(self, error, pubsub, thread):
+        # Keep the worker alive; the connection resubscribes when it reconnects
+        print(f"Error reading room events: {error}")
+        time.sleep(1)
+
+# Event dispatcher singleton
+@functools.lru_cache(maxsize=None)
+def get_event_dispatcher():
+    """Return the event dispatcher shared by every session of this process"""
+    return EventDispatcher(get_redis_client())
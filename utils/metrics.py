@@ -0,0 +1,241 @@
+"""
+Lightweight process metrics with a Prometheus text exposition endpoint
+
+Metrics are only collected when METRICS_PORT is set; otherwise the `timed`
+decorator only checks slow-operation budgets (or returns functions unchanged
+when SLOW_OP_MS is 0) and recording calls return at once.
+"""
+import os
+import threading
+import time
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.profiling import SLOW_OP_MS, check_latency
+
+# Port of the /metrics endpoint; metrics are disabled when unset
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_ENABLED = bool(METRICS_PORT)
+
+# Histogram buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Sessions not seen for this long (seconds) no longer count as active
+SESSION_TIMEOUT = 60
+
+def _format_labels(names, values, extra=""):
+    """Render a Prometheus label set"""
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonically increasing count, optionally split by labels"""
+    
+    kind = "counter"
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            return [
+                (f"{self.name}{_format_labels(self.labels, values)}", value)
+                for values, value in self._values.items()
+            ]
+
+class Gauge:
+    """Value computed on every scrape by a callback"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+    
+    def samples(self):
+        return [(self.name, self.callback())]
+
+class Histogram:
+    """Distribution of observed values, optionally split by labels"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, *label_values, value):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+    
+    def samples(self):
+        samples = []
+        with self._lock:
+            for values, series in self._series.items():
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    labels = _format_labels(self.labels, values, f'le="{bound}"')
+                    samples.append((f"{self.name}_bucket{labels}", count))
+                labels = _format_labels(self.labels, values, 'le="+Inf"')
+                samples.append((f"{self.name}_bucket{labels}", series["count"]))
+                samples.append((f"{self.name}_sum{_format_labels(self.labels, values)}", series["sum"]))
+                samples.append((f"{self.name}_count{_format_labels(self.labels, values)}", series["count"]))
+        return samples
+
+REGISTRY = []
+
+def register(metric):
+    """Add a metric to the exposition output"""
+    REGISTRY.append(metric)
+    return metric
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+# ----- Active sessions -----
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def track_session(session_id, room_id, queues=()):
+    """Record that a session is viewing a room, with its pending event queues"""
+    if not METRICS_ENABLED:
+        return
+    with _sessions_lock:
+        _sessions[session_id] = (room_id, queues, time.monotonic())
+
+def forget_session(session_id):
+    """Stop counting a session that left its room"""
+    with _sessions_lock:
+        _sessions.pop(session_id, None)
+
+def _active_sessions():
+    """Return the sessions seen recently, dropping stale ones"""
+    cutoff = time.monotonic() - SESSION_TIMEOUT
+    with _sessions_lock:
+        for session_id in [key for key, (_, _, seen) in _sessions.items() if seen < cutoff]:
+            del _sessions[session_id]
+        return list(_sessions.values())
+
+def _count_listener_threads():
+    """Count pub/sub listener threads alive in this process"""
+    return sum(1 for thread in threading.enumerate() if type(thread).__name__ == "PubSubWorkerThread")
+
+# ----- Metrics -----
+
+OPERATION_SECONDS = register(Histogram(
+    "chat_operation_seconds", "Latency of data-layer operations", ("operation",)
+))
+OPERATION_ERRORS = register(Counter(
+    "chat_operation_errors_total", "Data-layer operations that raised", ("operation",)
+))
+DELIVERY_SECONDS = register(Histogram(
+    "chat_delivery_seconds", "Real-time event lag: publish to receive, receive to render", ("stage",)
+))
+RERUNS = register(Counter(
+    "chat_reruns_total", "Event-driven reruns by outcome", ("outcome",)
+))
+register(Gauge(
+    "chat_active_sessions", "Sessions that viewed a room recently",
+    lambda: len(_active_sessions())
+))
+register(Gauge(
+    "chat_active_rooms", "Rooms with at least one active session",
+    lambda: len({room_id for room_id, _, _ in _active_sessions()})
+))
+register(Gauge(
+    "chat_pending_events", "Events queued for active sessions and not yet rendered",
+    lambda: sum(len(queue) for _, queues, _ in _active_sessions() for queue in queues)
+))
+register(Gauge(
+    "chat_listener_threads", "Pub/sub listener threads alive",
+    _count_listener_threads
+))
+
+def timed(operation):
+    """Record latency and errors of the decorated function under operation"""
+    def decorator(func):
+        if not METRICS_ENABLED and not SLOW_OP_MS:
+            return func
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if METRICS_ENABLED:
+                    OPERATION_ERRORS.inc(operation)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                if METRICS_ENABLED:
+                    OPERATION_SECONDS.observe(operation, value=elapsed)
+                check_latency(operation, elapsed, func, args, kwargs)
+        return wrapper
+    return decorator
+
+# ----- Exposition endpoint -----
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve GET /metrics"""
+    
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server():
+    """Start the /metrics endpoint on METRICS_PORT once per process"""
+    global _server
+    if not METRICS_ENABLED:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("0.0.0.0", int(METRICS_PORT)), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server
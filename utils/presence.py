@@ -0,0 +1,90 @@
+"""
+Per-process presence heartbeats for the sessions sitting in chatrooms
+
+Every room keeps a `presence:<id>` sorted set of usernames scored by their
+last heartbeat. Rather than each session writing its own heartbeat, one
+thread per process sends a heartbeat for all of its sessions in a single
+pipeline every PRESENCE_HEARTBEAT_SECONDS. Sessions that are no longer
+connected are dropped, and members nobody heartbeats for PRESENCE_TIMEOUT
+seconds (e.g. because their server died) are expired by the next heartbeat
+to their room.
+
+Has no Streamlit dependency.
+"""
+import os
+import time
+import threading
+
+# Seconds between heartbeats; keep it well under PRESENCE_TIMEOUT
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv("PRESENCE_HEARTBEAT_SECONDS", "5"))
+
+class PresenceTracker:
+    """Heartbeat every tracked session's room membership from one thread"""
+    
+    def __init__(self, service, is_alive=None, interval=PRESENCE_HEARTBEAT_SECONDS):
+        self.service = service
+        self.is_alive = is_alive
+        self.interval = interval
+        self.sessions = {}
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def track(self, key, room_id, username, connection=None):
+        """
+        Keep a session marked online in a room until it is forgotten
+        
+        connection is passed to is_alive to tell whether the session is still
+        connected. A session new to the room is marked online straight away,
+        and gone from the room (or name) it tracked before.
+        """
+        member = (room_id, username)
+        with self._lock:
+            previous = self.sessions.get(key, (None,))[0]
+            joined = previous != member
+            self.sessions[key] = (member, connection)
+            gone = self._gone([previous]) if joined and previous else []
+            
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="presence-heartbeat", daemon=True)
+                self._thread.start()
+        
+        if gone:
+            self.service.remove_presence(gone)
+        if joined:
+            self.service.heartbeat([member])
+    
+    def forget(self, key):
+        """Stop tracking a session and mark it gone from its room"""
+        with self._lock:
+            entry = self.sessions.pop(key, None)
+            gone = self._gone([entry[0]]) if entry else []
+        if gone:
+            self.service.remove_presence(gone)
+    
+    def beat(self):
+        """Send one heartbeat for every connected session, dropping the rest"""
+        with self._lock:
+            if self.is_alive is not None:
+                dead = [key for key, (_, connection) in self.sessions.items() if not self.is_alive(connection)]
+                gone = self._gone([self.sessions.pop(key)[0] for key in dead])
+            else:
+                gone = []
+            members = {member for member, _ in self.sessions.values()}
+        
+        if gone:
+            self.service.remove_presence(gone)
+        if members:
+            self.service.heartbeat(members)
+    
+    def _gone(self, members):
+        """Filter out members another session of this process still holds (lock held)"""
+        online = {member for member, _ in self.sessions.values()}
+        return [member for member in members if member not in online]
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.beat()
+            except Exception as e:
+                print(f"Error sending presence heartbeats: {e}")
@@ -0,0 +1,195 @@
+"""
+Per-rerun accounting and the slow-operation log for the debug panel
+
+Each script run collects its own statistics in thread-local storage, since
+every Streamlit session runs its script on its own thread while sharing one
+Redis client. Nothing is collected unless a run was started with
+begin_run(), so background threads and headless drivers pay no overhead.
+
+Data-layer calls and page functions slower than their latency budget are
+logged and kept in a small process-wide ring buffer regardless of debug mode.
+"""
+import os
+import json
+import time
+import inspect
+import logging
+import threading
+import functools
+from collections import deque
+import redis
+from redis.client import Pipeline
+
+# Latency budget for data-layer calls and page functions (0 disables the log)
+SLOW_OP_MS = float(os.getenv("SLOW_OP_MS", "250"))
+
+# Number of recent slow operations kept for the debug panel
+SLOW_OP_SAMPLES = int(os.getenv("SLOW_OP_SAMPLES", "100"))
+
+# Operations that block on purpose get their own budget ("op=ms,op=ms" overrides);
+# calls taking a `timeout` argument (long polls) also get that long on top
+LATENCY_BUDGETS = {
+    "waiting": 3000
+}
+
+logger = logging.getLogger("retro_chat.slow_ops")
+
+for budget in filter(None, os.getenv("SLOW_OP_BUDGETS", "").split(",")):
+    name, _, budget_ms = budget.partition("=")
+    try:
+        LATENCY_BUDGETS[name.strip()] = float(budget_ms)
+    except ValueError:
+        logger.warning("Ignoring malformed SLOW_OP_BUDGETS entry %r (expected op=ms)", budget)
+
+_local = threading.local()
+_slow_ops = deque(maxlen=SLOW_OP_SAMPLES)
+
+class RunStats:
+    """What one script run spent its time and Redis traffic on"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.page_times = {}
+        self.redis_commands = 0
+        self.redis_round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.cache_hits = {}
+        self.cache_misses = {}
+        self.profiler = None
+    
+    def wall_time(self):
+        """Seconds since the run started"""
+        return time.perf_counter() - self.started
+
+def begin_run():
+    """Start collecting statistics for the current script run"""
+    _local.run = RunStats()
+    return _local.run
+
+def current_run():
+    """Return the statistics of the current script run, if any"""
+    return getattr(_local, "run", None)
+
+def record_cache(name, hit):
+    """Count a cache hit or miss for the current run"""
+    run = current_run()
+    if run is None:
+        return
+    counts = run.cache_hits if hit else run.cache_misses
+    counts[name] = counts.get(name, 0) + 1
+
+def set_current_room(room_id):
+    """Attribute slow operations on this thread to a room (None to clear)"""
+    _local.room_id = room_id
+
+def set_current_session(session_id):
+    """Attribute slow operations on this thread to a session (None to clear)"""
+    _local.session_id = session_id
+
+def profiled(name):
+    """Accumulate the decorated page function's time in the current run"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                run = current_run()
+                if run is not None:
+                    run.page_times[name] = run.page_times.get(name, 0) + elapsed
+                check_latency(name, elapsed, func, args, kwargs)
+        return wrapper
+    return decorator
+
+def check_latency(operation, elapsed, func, args, kwargs):
+    """Log the call if it took longer than the operation's latency budget"""
+    budget_ms = LATENCY_BUDGETS.get(operation, SLOW_OP_MS)
+    if not SLOW_OP_MS or elapsed * 1000 <= budget_ms:
+        return
+    
+    # Only slow calls pay for describing their arguments
+    try:
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+    except (TypeError, ValueError):
+        arguments = {}
+    arguments.pop("self", None)
+    
+    # A long poll may block for as long as it was asked to
+    timeout = arguments.get("timeout")
+    if isinstance(timeout, (int, float)) and not isinstance(timeout, bool):
+        budget_ms += timeout * 1000
+        if elapsed * 1000 <= budget_ms:
+            return
+    
+    entry = {
+        "at": time.time(),
+        "op": operation,
+        "room_id": arguments.get("chatroom_id") or getattr(_local, "room_id", None),
+        "session_id": getattr(_local, "session_id", None),
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "budget_ms": budget_ms,
+        "arg_sizes": {name: _size(value) for name, value in arguments.items()}
+    }
+    _slow_ops.append(entry)
+    logger.warning("slow operation %s", json.dumps(entry))
+
+def recent_slow_ops(session_id=None):
+    """Return the sampled slow operations (of one session, if given), newest first"""
+    return [
+        entry for entry in reversed(_slow_ops)
+        if session_id is None or entry["session_id"] == session_id
+    ]
+
+def _size(value):
+    """Approximate the wire size of a command argument or reply"""
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (list, tuple, set)):
+        return sum(_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_size(key) + _size(item) for key, item in value.items())
+    return 8
+
+def _record_redis(run, commands, sent, received):
+    run.redis_commands += commands
+    run.redis_round_trips += 1
+    run.bytes_sent += _size(sent)
+    run.bytes_received += _size(received)
+
+class AccountingPipeline(Pipeline):
+    """Pipeline that reports its batch as one round trip"""
+    
+    def immediate_execute_command(self, *args, **options):
+        # WATCH and the reads after it (e.g. in client.transaction()) are sent
+        # straight away, one round trip each
+        response = super().immediate_execute_command(*args, **options)
+        run = current_run()
+        if run is not None:
+            _record_redis(run, 1, args, response)
+        return response
+    
+    def execute(self, raise_on_error=True):
+        run = current_run()
+        commands = [args for args, _ in self.command_stack]
+        response = super().execute(raise_on_error)
+        if run is not None and commands:
+            _record_redis(run, len(commands), commands, response)
+        return response
+
+class AccountingRedis(redis.Redis):
+    """Redis client that reports commands, round trips and bytes per run"""
+    
+    def execute_command(self, *args, **options):
+        response = super().execute_command(*args, **options)
+        run = current_run()
+        if run is not None:
+            _record_redis(run, 1, args, response)
+        return response
+    
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AccountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
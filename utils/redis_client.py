@@ -1,28 +1,231 @@
 import os
+import sys
 import json
-import time
 import uuid
+import zlib
+import time
+import random
+import functools
 import redis
-import streamlit as st
-from datetime import datetime, timedelta
+from collections import deque
+from secrets import token_urlsafe
+from datetime import datetime
+from utils.metrics import timed
+from utils.codecs import get_codec, decode_record, pack_content, message_content, inflate_message, MessageTooLarge
+from utils.profiling import AccountingRedis, record_cache
 
-# Redis client singleton
-@st.cache_resource
-def get_redis_client():
-    """Initialize and return Redis client"""
+# Key prefixes for different data types
+CHATROOM_PREFIX = "chatroom:"
+MESSAGE_PREFIX = "message:"
+REQUEST_PREFIX = "request:"
+
+SNAPSHOT_PREFIX = "snapshot:"
+ARCHIVE_PREFIX = "archive:"
+ATTACHMENT_PREFIX = "attachment:"
+IDEMPOTENCY_PREFIX = "idempotency:"
+PRESENCE_PREFIX = "presence:"
+TOKEN_PREFIX = "token:"
+
+# Open rooms scored by last activity (epoch seconds) and by messages sent
+ROOMS_ACTIVE_KEY = "rooms:active"
+ROOMS_BUSY_KEY = "rooms:busy"
+
+# Chatroom expiration time (24 hours)
+CHATROOM_EXPIRY = 60 * 60 * 24
+
+# Join request expiration time (30 minutes)
+REQUEST_EXPIRY = 60 * 30
+
+# How long a client-supplied idempotency key is remembered (seconds)
+IDEMPOTENCY_EXPIRY = 60
+
+# Number of recent messages kept in a room's precomputed snapshot
+SNAPSHOT_SIZE = 50
+
+# Messages read per round trip when exporting a transcript
+EXPORT_PAGE_SIZE = 500
+
+# Keys deleted per command when a closed room's messages are archived
+ARCHIVE_DELETE_BATCH = 500
+
+# Compressed archive bytes inflated at a time when an archive is read
+ARCHIVE_READ_CHUNK = 64 * 1024
+
+# Total bytes of attachments a room may store
+MAX_ROOM_ATTACHMENT_BYTES = int(os.getenv("MAX_ROOM_ATTACHMENT_BYTES", str(50 * 1024 * 1024)))
+
+# Largest thumbnail stored in bytes
+MAX_THUMBNAIL_BYTES = 256 * 1024
+
+# Seconds without a heartbeat after which a room member counts as gone
+PRESENCE_TIMEOUT = int(os.getenv("PRESENCE_TIMEOUT", "15"))
+
+# Online members listed per room
+PRESENCE_LIST_SIZE = 100
+
+# Transcript formats -> (MIME type, file extension)
+TRANSCRIPT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "text": ("text/plain", "txt")
+}
+
+# Only replace a snapshot with a newer one (KEYS: blob, seq; ARGV: seq, blob, ttl)
+STORE_SNAPSHOT_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+if current >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[3])
+return 1
+"""
+
+# Delete a claim only if it still holds our value (KEYS: claim; ARGV: value)
+RELEASE_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Issue a room token once per grant: later calls return the first token
+# (KEYS: grant's token key, token record; ARGV: token, record, ttl)
+ISSUE_TOKEN_SCRIPT = """
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    return existing
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return ARGV[1]
+"""
+
+# Store a closed room's record (keeping its expiry), mark it closed for
+# SEND_MESSAGE_SCRIPT and drop it from the activity indexes and presence. With
+# a cutoff, only a room still idle (last active at or before the cutoff) is
+# closed; returns 0 if it was active since or already closed
+# (KEYS: room, rooms:active, rooms:busy, presence, closed marker;
+#  ARGV: record, room id, cutoff)
+CLOSE_ROOM_SCRIPT = """
+if ARGV[3] ~= '' then
+    local last_active = redis.call('ZSCORE', KEYS[2], ARGV[2])
+    if not last_active or tonumber(last_active) > tonumber(ARGV[3]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'KEEPTTL')
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+    redis.call('SET', KEYS[5], 1, 'PX', ttl)
+else
+    redis.call('SET', KEYS[5], 1)
+end
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZREM', KEYS[3], ARGV[2])
+redis.call('UNLINK', KEYS[4])
+return 1
+"""
+
+# Move a room's message:list:<room> (written before sequence numbers existed,
+# where a message's position was its seq) into the sequence index. Legacy
+# messages keep seqs 1..LLEN; messages already numbered by the new counter are
+# shifted after them, and the snapshot is dropped so it is rebuilt from the
+# index. A no-op once the list is gone.
+MIGRATE_LEGACY_LUA = """
+local function migrate_legacy(list, counter, index, snapshot, snapshot_seq, ttl)
+    local ids = redis.call('LRANGE', list, 0, -1)
+    if #ids == 0 then
+        return 0
+    end
+    local shifted = redis.call('ZRANGE', index, 0, -1, 'WITHSCORES')
+    for i = 1, #shifted, 2 do
+        redis.call('ZADD', index, tonumber(shifted[i + 1]) + #ids, shifted[i])
+    end
+    for i, id in ipairs(ids) do
+        redis.call('ZADD', index, i, id)
+    end
+    redis.call('SET', counter, tonumber(redis.call('GET', counter) or '0') + #ids, 'EX', ttl)
+    redis.call('EXPIRE', index, ttl)
+    redis.call('DEL', list, snapshot, snapshot_seq)
+    return #ids
+end
+"""
+
+# (KEYS: legacy list, seq counter, seq index, snapshot, snapshot seq; ARGV: ttl)
+MIGRATE_LEGACY_SCRIPT = MIGRATE_LEGACY_LUA + """
+return migrate_legacy(KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], ARGV[1])
+"""
+
+# Assign the next room sequence number to a message, store it and bump the
+# room's activity atomically. A closed room takes no messages (returns 0)
+# except its closing notice, and is not re-added to the indexes.
+# With an idempotency key, the key is claimed in the same step, and a retry
+# gets the first message's id back instead of a seq.
+# A legacy message list is migrated first, so numbering continues after it.
+# (KEYS: seq counter, seq index, message, rooms:active, rooms:busy,
+#  legacy list, snapshot, snapshot seq, closed marker, [idempotency key];
+#  ARGV: message id, record, ttl, now, room id, idempotency ttl, closing)
+SEND_MESSAGE_SCRIPT = MIGRATE_LEGACY_LUA + """
+if ARGV[7] ~= '1' and redis.call('EXISTS', KEYS[9]) == 1 then
+    return 0
+end
+if KEYS[10] then
+    local existing = redis.call('GET', KEYS[10])
+    if existing then
+        return existing
+    end
+    redis.call('SET', KEYS[10], ARGV[1], 'EX', ARGV[6])
+end
+migrate_legacy(KEYS[6], KEYS[1], KEYS[2], KEYS[7], KEYS[8], ARGV[3])
+local seq = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SET', KEYS[3], ARGV[2], 'EX', ARGV[3])
+redis.call('ZADD', KEYS[2], seq, ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('ZADD', KEYS[4], 'XX', ARGV[4], ARGV[5])
+redis.call('ZADD', KEYS[5], 'XX', 'INCR', 1, ARGV[5])
+return seq
+"""
+
+def get_redis_settings():
+    """Return the Redis URL and password to connect with"""
     # Try to get from environment variables
     redis_url = os.getenv("REDIS_URL")
     redis_password = os.getenv("REDIS_PASSWORD")
     
-    # If not found, try to get from Streamlit secrets
-    if not redis_url:
+    # If not found and we're running inside Streamlit, try its secrets
+    if not redis_url and "streamlit" in sys.modules:
+        secrets = sys.modules["streamlit"].secrets
         try:
-            redis_url = st.secrets["REDIS_URL"]
-            redis_password = st.secrets.get("REDIS_PASSWORD", None)
-        except:
-            # Default to localhost for development
-            redis_url = "redis://localhost:6379"
-            redis_password = None
+            redis_url = secrets["REDIS_URL"]
+            redis_password = secrets.get("REDIS_PASSWORD", None)
+        except Exception:
+            pass
+    
+    # Default to localhost for development
+    if not redis_url:
+        redis_url = "redis://localhost:6379"
+        redis_password = None
+    
+    return redis_url, redis_password
+
+def stamp_event(event, seq=None):
+    """
+    Return a copy of a pub/sub event stamped with its publish time
+    
+    Subscribers use published_at (epoch seconds) to measure delivery lag and
+    seq (the room's message sequence, for messages) to detect gaps.
+    """
+    stamped = dict(event, published_at=time.time())
+    if seq is not None:
+        stamped["seq"] = seq
+    return stamped
+
+# Redis client singleton
+@functools.lru_cache(maxsize=None)
+def get_redis_client():
+    """Initialize and return Redis client"""
+    redis_url, redis_password = get_redis_settings()
     
     # Connect to Redis
     if redis_password:
@@ -30,296 +233,1185 @@ def get_redis_client():
     else:
         client = redis.from_url(redis_url)
     
-    return client
-
-# Key prefixes for different data types
-CHATROOM_PREFIX = "chatroom:"
-MESSAGE_PREFIX = "message:"
-REQUEST_PREFIX = "request:"
-
-# Chatroom expiration time (24 hours)
-CHATROOM_EXPIRY = 60 * 60 * 24
+    # Share the connection pool with a client that feeds the debug panel
+    return AccountingRedis(connection_pool=client.connection_pool)
 
-def create_chatroom(name, host_name):
-    """Create a new chatroom and return its code and ID"""
-    client = get_redis_client()
-    
-    # Generate a random 5-digit code
-    import random
-    code = str(random.randint(10000, 99999))
-    
-    # Generate a unique ID
-    room_id = str(uuid.uuid4())
-    
-    # Create chatroom data
-    chatroom_data = {
-        "id": room_id,
-        "name": name,
-        "code": code,
-        "host_name": host_name,
-        "is_active": True,
-        "created_at": datetime.now().isoformat()
-    }
-    
-    # Store in Redis with expiration
-    key = f"{CHATROOM_PREFIX}{room_id}"
-    client.set(key, json.dumps(chatroom_data))
-    client.expire(key, CHATROOM_EXPIRY)
-    
-    # Also create a lookup by code
-    client.set(f"{CHATROOM_PREFIX}code:{code}", room_id)
-    client.expire(f"{CHATROOM_PREFIX}code:{code}", CHATROOM_EXPIRY)
-    
-    return {
-        "success": True,
-        "code": code,
-        "id": room_id
-    }
+class RoomClosed(ValueError):
+    """Raised when sending a message to a closed chatroom"""
 
-def get_chatroom_by_code(code):
-    """Retrieve a chatroom by its code"""
-    client = get_redis_client()
+class ChatService:
+    """
+    Chat engine on top of Redis: rooms, join requests, messages and events
     
-    # Get room ID from code
-    room_id = client.get(f"{CHATROOM_PREFIX}code:{code}")
+    Has no Streamlit dependency, so it can be driven directly by other front
+    ends, load generators and benchmarks.
+    """
     
-    if not room_id:
-        return {
-            "success": False,
-            "error": "Chatroom not found or inactive"
-        }
+    def __init__(self, client, codec=None):
+        self.client = client
+        # Records are written with this codec and read with whichever wrote them
+        self.codec = get_codec(codec)
     
-    room_id = room_id.decode('utf-8')
+    # ----- Rooms -----
     
-    # Get chatroom data
-    chatroom_data = client.get(f"{CHATROOM_PREFIX}{room_id}")
+    @timed("create_chatroom")
+    def create_chatroom(self, name, host_name):
+        """Create a new chatroom and return its code and ID"""
+        client = self.client
+        
+        # Generate a random 5-digit code
+        code = str(random.randint(10000, 99999))
+        
+        # Generate a unique ID
+        room_id = str(uuid.uuid4())
+        
+        # Create chatroom data
+        chatroom_data = {
+            "id": room_id,
+            "name": name,
+            "code": code,
+            "host_name": host_name,
+            "is_active": True,
+            "created_at": datetime.now().isoformat()
+        }
+        
+        # Store in Redis with expiration, with a lookup by code, and list the
+        # room in the activity indexes
+        pipe = client.pipeline()
+        pipe.set(f"{CHATROOM_PREFIX}{room_id}", self.codec.encode(chatroom_data), ex=CHATROOM_EXPIRY)
+        pipe.set(f"{CHATROOM_PREFIX}code:{code}", room_id, ex=CHATROOM_EXPIRY)
+        pipe.zadd(ROOMS_ACTIVE_KEY, {room_id: time.time()})
+        pipe.zadd(ROOMS_BUSY_KEY, {room_id: 0})
+        pipe.execute()
+        
+        return {
+            "success": True,
+            "code": code,
+            "id": room_id
+        }
     
-    if not chatroom_data:
+    @timed("get_chatroom_by_code")
+    def get_chatroom_by_code(self, code):
+        """Retrieve a chatroom by its code"""
+        client = self.client
+        
+        # Get room ID from code
+        room_id = client.get(f"{CHATROOM_PREFIX}code:{code}")
+        
+        if not room_id:
+            return {
+                "success": False,
+                "error": "Chatroom not found or inactive"
+            }
+        
+        room_id = room_id.decode('utf-8')
+        
+        # Get chatroom data
+        chatroom_data = client.get(f"{CHATROOM_PREFIX}{room_id}")
+        
+        if not chatroom_data:
+            return {
+                "success": False,
+                "error": "Chatroom not found or inactive"
+            }
+        
+        chatroom = decode_record(chatroom_data)
+        
+        # Check if active
+        if not chatroom.get("is_active", False):
+            return {
+                "success": False,
+                "error": "Chatroom is inactive"
+            }
+        
         return {
-            "success": False,
-            "error": "Chatroom not found or inactive"
+            "success": True,
+            "chatroom": chatroom
         }
     
-    chatroom = json.loads(chatroom_data)
+    def leave_chatroom(self, chatroom_id, username):
+        """Announce that a user has left the chatroom (nothing once it is closed)"""
+        try:
+            return self.send_message(chatroom_id, "SYSTEM", f"{username} has left the chatroom", "system")
+        except RoomClosed:
+            return None
+    
+    @timed("close_chatroom")
+    def close_chatroom(self, chatroom_id, idle_before=None, notice=None):
+        """
+        Mark a chatroom as inactive
+        
+        With idle_before (a Unix time), the room is only closed if it has had
+        no activity since then, checked atomically with the close; otherwise
+        None is returned. notice is posted as a system message once the room
+        is closed, before its guests are told.
+        """
+        client = self.client
+        
+        # Get chatroom data
+        chatroom_data = client.get(f"{CHATROOM_PREFIX}{chatroom_id}")
+        
+        if not chatroom_data:
+            return None
+        
+        chatroom = decode_record(chatroom_data)
+        
+        # Update active status and drop the room from the activity indexes
+        chatroom["is_active"] = False
+        closed = client.eval(
+            CLOSE_ROOM_SCRIPT,
+            5,
+            f"{CHATROOM_PREFIX}{chatroom_id}",
+            ROOMS_ACTIVE_KEY,
+            ROOMS_BUSY_KEY,
+            f"{PRESENCE_PREFIX}{chatroom_id}",
+            f"{CHATROOM_PREFIX}closed:{chatroom_id}",
+            self.codec.encode(chatroom),
+            chatroom_id,
+            "" if idle_before is None else repr(idle_before)
+        )
+        if not closed:
+            return None
+        
+        if notice:
+            self.send_message(chatroom_id, "SYSTEM", notice, "system", closing=True)
+        
+        # Publish event for real-time updates
+        client.publish(f"chatroom:{chatroom_id}", json.dumps(stamp_event({
+            "type": "closed"
+        })))
+        
+        # Nobody writes to a closed room any more, so free its message keys
+        self.archive_chatroom(chatroom_id)
+        
+        return chatroom
+    
+    @timed("archive_chatroom")
+    def archive_chatroom(self, chatroom_id):
+        """
+        Compact a room's messages into one compressed archive blob
+        
+        The archived messages' keys are deleted straight away; the history
+        API keeps returning them from the archive. Messages sent after this
+        (e.g. the closing notice) stay live until the next archive.
+        Returns the number of messages archived.
+        """
+        compressor = zlib.compressobj()
+        chunks = []
+        message_ids = []
+        
+        # Any earlier archive is folded into the new one
+        for message in self.iter_messages(chatroom_id):
+            chunks.append(compressor.compress((json.dumps(message) + "\n").encode("utf-8")))
+            message_ids.append(message["id"])
+        chunks.append(compressor.flush())
+        
+        if not message_ids:
+            return 0
+        
+        # Only remove what was archived: messages sent meanwhile stay indexed
+        pipe = self.client.pipeline()
+        pipe.set(f"{ARCHIVE_PREFIX}{chatroom_id}", b"".join(chunks), ex=CHATROOM_EXPIRY)
+        for start in range(0, len(message_ids), ARCHIVE_DELETE_BATCH):
+            batch = message_ids[start:start + ARCHIVE_DELETE_BATCH]
+            pipe.unlink(*[f"{MESSAGE_PREFIX}{message_id}" for message_id in batch])
+            pipe.zrem(f"{MESSAGE_PREFIX}seq-index:{chatroom_id}", *batch)
+        pipe.execute()
+        
+        return len(message_ids)
+    
+    def _iter_archive(self, chatroom_id, after_seq=0):
+        """Yield a room's archived messages after a sequence, inflating lazily"""
+        blob = self.client.get(f"{ARCHIVE_PREFIX}{chatroom_id}")
+        if not blob:
+            return
+        
+        decompressor = zlib.decompressobj()
+        pending = b""
+        for start in range(0, len(blob), ARCHIVE_READ_CHUNK):
+            pending += decompressor.decompress(blob[start:start + ARCHIVE_READ_CHUNK])
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                message = json.loads(line)
+                if message["seq"] > after_seq:
+                    yield message
+    
+    # ----- Presence -----
+    
+    @timed("heartbeat")
+    def heartbeat(self, members):
+        """
+        Mark (room id, username) pairs as online, in one round trip
+        
+        Members of the same rooms whose last heartbeat is older than
+        PRESENCE_TIMEOUT are dropped at the same time.
+        """
+        now = time.time()
+        rooms = {}
+        for room_id, username in members:
+            rooms.setdefault(room_id, {})[username] = now
+        if not rooms:
+            return
+        
+        pipe = self.client.pipeline(transaction=False)
+        for room_id, usernames in rooms.items():
+            key = f"{PRESENCE_PREFIX}{room_id}"
+            pipe.zadd(key, usernames)
+            pipe.zremrangebyscore(key, "-inf", now - PRESENCE_TIMEOUT)
+            pipe.expire(key, PRESENCE_TIMEOUT)
+        pipe.execute()
+    
+    @timed("remove_presence")
+    def remove_presence(self, members):
+        """Mark (room id, username) pairs as gone"""
+        pipe = self.client.pipeline(transaction=False)
+        for room_id, username in members:
+            pipe.zrem(f"{PRESENCE_PREFIX}{room_id}", username)
+        pipe.execute()
+    
+    @timed("get_presence")
+    def get_presence(self, chatroom_id, limit=PRESENCE_LIST_SIZE):
+        """Return the number of online members of a room and (up to limit of) their names"""
+        key = f"{PRESENCE_PREFIX}{chatroom_id}"
+        cutoff = time.time() - PRESENCE_TIMEOUT
+        
+        pipe = self.client.pipeline()
+        pipe.zcount(key, cutoff, "+inf")
+        pipe.zrangebyscore(key, cutoff, "+inf", start=0, num=limit)
+        count, usernames = pipe.execute()
+        return {"count": count, "usernames": sorted(name.decode("utf-8") for name in usernames)}
+    
+    # ----- Room directory -----
+    
+    @timed("busiest_rooms")
+    def busiest_rooms(self, limit=10):
+        """Return (room id, messages sent) for the open rooms with most messages"""
+        entries = self.client.zrevrange(ROOMS_BUSY_KEY, 0, limit - 1, withscores=True)
+        return [(room_id.decode("utf-8"), int(count)) for room_id, count in entries]
+    
+    @timed("idle_rooms")
+    def idle_rooms(self, idle_seconds, limit=100):
+        """Return (room id, last activity) for open rooms idle longer than idle_seconds, oldest first"""
+        entries = self.client.zrangebyscore(
+            ROOMS_ACTIVE_KEY,
+            "-inf",
+            time.time() - idle_seconds,
+            start=0,
+            num=limit,
+            withscores=True
+        )
+        return [(room_id.decode("utf-8"), last_active) for room_id, last_active in entries]
+    
+    @timed("room_counts")
+    def room_counts(self, idle_seconds):
+        """Return the number of open rooms and how many of them are idle"""
+        pipe = self.client.pipeline()
+        pipe.zcard(ROOMS_ACTIVE_KEY)
+        pipe.zcount(ROOMS_ACTIVE_KEY, "-inf", time.time() - idle_seconds)
+        total, idle = pipe.execute()
+        return {"open": total, "idle": idle}
+    
+    @timed("room_directory")
+    def room_directory(self, limit=50):
+        """
+        Return the most recently active open rooms with their details
+        
+        Each entry has the room record plus `last_active` and `messages`.
+        Rooms closed between the two reads are left out.
+        """
+        room_ids = [
+            room_id.decode("utf-8")
+            for room_id in self.client.zrevrange(ROOMS_ACTIVE_KEY, 0, limit - 1)
+        ]
+        if not room_ids:
+            return []
+        
+        pipe = self.client.pipeline()
+        pipe.mget([f"{CHATROOM_PREFIX}{room_id}" for room_id in room_ids])
+        pipe.zmscore(ROOMS_ACTIVE_KEY, room_ids)
+        pipe.zmscore(ROOMS_BUSY_KEY, room_ids)
+        records, last_active, messages = pipe.execute()
+        
+        directory = []
+        for room_id, record, active_at, count in zip(room_ids, records, last_active, messages):
+            if active_at is None:
+                continue
+            room = decode_record(record) if record else {"id": room_id, "expired": True}
+            room["last_active"] = active_at
+            room["messages"] = int(count or 0)
+            directory.append(room)
+        return directory
+    
+    @timed("reap_idle_rooms")
+    def reap_idle_rooms(self, idle_seconds, limit=100):
+        """
+        Close (and archive) rooms idle longer than idle_seconds
+        
+        Each room's idleness is checked again as it is closed, so a room that
+        got a message since it was listed stays open. Rooms whose records
+        already expired are just dropped from the indexes. Returns the ids of
+        the rooms reaped.
+        """
+        reaped = []
+        for room_id, _ in self.idle_rooms(idle_seconds, limit):
+            if self.client.exists(f"{CHATROOM_PREFIX}{room_id}"):
+                closed = self.close_chatroom(
+                    room_id,
+                    idle_before=time.time() - idle_seconds,
+                    notice="The chatroom was closed after being idle"
+                )
+                if not closed:
+                    continue
+            else:
+                pipe = self.client.pipeline()
+                pipe.zrem(ROOMS_ACTIVE_KEY, room_id)
+                pipe.zrem(ROOMS_BUSY_KEY, room_id)
+                pipe.execute()
+            reaped.append(room_id)
+        return reaped
+    
+    # ----- Join requests -----
+    
+    def claim_idempotency_key(self, scope, idempotency_key, value):
+        """
+        Claim an idempotency key for a new operation
+        
+        Returns None if the key was claimed, otherwise the value stored by the
+        operation that claimed it first
+        """
+        client = self.client
+        
+        key = f"{IDEMPOTENCY_PREFIX}{scope}:{idempotency_key}"
+        if client.set(key, value, nx=True, ex=IDEMPOTENCY_EXPIRY):
+            return None
+        
+        existing = client.get(key)
+        
+        # The earlier claim may have expired in the meantime
+        return existing.decode('utf-8') if existing else None
+    
+    def release_idempotency_key(self, scope, idempotency_key, value):
+        """Give up a claim made with claim_idempotency_key after the operation failed"""
+        self.client.eval(RELEASE_CLAIM_SCRIPT, 1, f"{IDEMPOTENCY_PREFIX}{scope}:{idempotency_key}", value)
     
-    # Check if active
-    if not chatroom.get("is_active", False):
+    @timed("join_request")
+    def join_request(self, chatroom_id, username, idempotency_key=None):
+        """
+        Create a join request for a user
+        
+        Repeated calls with the same idempotency_key return the original request
+        """
+        client = self.client
+        
+        # Generate a unique request ID
+        request_id = str(uuid.uuid4())
+        
+        # Retries of the same user action reuse the first request
+        if idempotency_key:
+            existing_id = self.claim_idempotency_key(f"join:{chatroom_id}", idempotency_key, request_id)
+            if existing_id:
+                return {
+                    "success": True,
+                    "request_id": existing_id
+                }
+        
+        # Create request data
+        request_data = {
+            "id": request_id,
+            "chatroom_id": chatroom_id,
+            "username": username,
+            "status": "pending",  # pending, approved, rejected
+            "created_at": datetime.now().isoformat()
+        }
+        
+        # Store in Redis with expiration (30 minutes) and add it to the
+        # chatroom's pending requests in one transaction; a failed write gives
+        # the idempotency key back so the retry can create the request
+        pipe = client.pipeline()
+        pipe.set(f"{REQUEST_PREFIX}{request_id}", self.codec.encode(request_data), ex=REQUEST_EXPIRY)
+        pipe.sadd(f"{REQUEST_PREFIX}pending:{chatroom_id}", request_id)
+        try:
+            pipe.execute()
+        except Exception:
+            if idempotency_key:
+                self.release_idempotency_key(f"join:{chatroom_id}", idempotency_key, request_id)
+            raise
+        
+        # Publish event for real-time updates
+        client.publish(f"join-requests:{chatroom_id}", json.dumps(stamp_event({
+            "type": "new_request",
+            "request_id": request_id,
+            "username": username
+        })))
+        
         return {
-            "success": False,
-            "error": "Chatroom is inactive"
+            "success": True,
+            "request_id": request_id
         }
     
-    return {
-        "success": True,
-        "chatroom": chatroom
-    }
-
-def join_request(chatroom_id, username):
-    """Create a join request for a user"""
-    client = get_redis_client()
-    
-    # Generate a unique request ID
-    request_id = str(uuid.uuid4())
-    
-    # Create request data
-    request_data = {
-        "id": request_id,
-        "chatroom_id": chatroom_id,
-        "username": username,
-        "status": "pending",  # pending, approved, rejected
-        "created_at": datetime.now().isoformat()
-    }
-    
-    # Store in Redis with expiration (30 minutes)
-    key = f"{REQUEST_PREFIX}{request_id}"
-    client.set(key, json.dumps(request_data))
-    client.expire(key, 60 * 30)  # 30 minutes expiry
-    
-    # Add to pending requests list for this chatroom
-    client.sadd(f"{REQUEST_PREFIX}pending:{chatroom_id}", request_id)
-    
-    # Publish event for real-time updates
-    client.publish(f"join-requests:{chatroom_id}", json.dumps({
-        "type": "new_request",
-        "request_id": request_id,
-        "username": username
-    }))
-    
-    return {
-        "success": True,
-        "request_id": request_id
-    }
-
-def get_pending_requests(chatroom_id):
-    """Get all pending join requests for a chatroom"""
-    client = get_redis_client()
+    @timed("get_pending_requests")
+    def get_pending_requests(self, chatroom_id):
+        """Get all pending join requests for a chatroom"""
+        client = self.client
+        
+        # Get all pending request IDs for this chatroom
+        request_ids = client.smembers(f"{REQUEST_PREFIX}pending:{chatroom_id}")
+        
+        if not request_ids:
+            return []
+        
+        # Get request data for all IDs in a single round trip
+        keys = [f"{REQUEST_PREFIX}{req_id.decode('utf-8')}" for req_id in request_ids]
+        
+        return [decode_record(data) for data in client.mget(keys) if data]
     
-    # Get all pending request IDs for this chatroom
-    request_ids = client.smembers(f"{REQUEST_PREFIX}pending:{chatroom_id}")
+    def update_request_status(self, request_id, status):
+        """Update the status of a join request"""
+        updated = self.update_request_statuses([request_id], status)
+        
+        return updated[0] if updated else None
     
-    if not request_ids:
-        return []
+    @timed("update_request_statuses")
+    def update_request_statuses(self, request_ids, status):
+        """
+        Update the status of several join requests in one batch
+        
+        Only requests that are still pending are changed, so two hosts
+        deciding on the same request cannot both approve (or one approve and
+        the other reject) it. Returns the updated requests; IDs that no
+        longer exist or were already decided are skipped.
+        """
+        if not request_ids:
+            return []
+        
+        keys = [f"{REQUEST_PREFIX}{request_id}" for request_id in request_ids]
+        
+        # WATCH the requests so a concurrent decision or cancellation retries
+        # the batch against the new statuses
+        def update(pipe):
+            request_data = pipe.mget(keys)
+            requests = [decode_record(data) for data in request_data if data]
+            requests = [request for request in requests if request["status"] == "pending"]
+            
+            pipe.multi()
+            self._queue_status_updates(pipe, requests, status)
+            return requests
+        
+        return self.client.transaction(update, *keys, value_from_callable=True)
     
-    # Get request data for each ID
-    requests = []
-    for req_id in request_ids:
-        req_id = req_id.decode('utf-8')
-        request_data = client.get(f"{REQUEST_PREFIX}{req_id}")
-        if request_data:
-            requests.append(json.loads(request_data))
+    def _queue_status_updates(self, pipe, requests, status):
+        """Queue the writes and events that move requests to a new status"""
+        for request in requests:
+            request_id = request["id"]
+            
+            # Update status
+            request["status"] = status
+            pipe.set(f"{REQUEST_PREFIX}{request_id}", self.codec.encode(request), keepttl=True)
+            
+            # If approved or rejected, remove from pending and wake up the waiting guest
+            if status in ["approved", "rejected"]:
+                status_key = f"{REQUEST_PREFIX}status:{request_id}"
+                pipe.srem(f"{REQUEST_PREFIX}pending:{request['chatroom_id']}", request_id)
+                pipe.lpush(status_key, status)
+                pipe.expire(status_key, REQUEST_EXPIRY)
+            
+            # Publish event for real-time updates
+            pipe.publish(f"join-requests:{request['chatroom_id']}", json.dumps(stamp_event({
+                "type": "status_update",
+                "request_id": request_id,
+                "username": request["username"],
+                "status": status
+            })))
     
-    return requests
-
-def update_request_status(request_id, status):
-    """Update the status of a join request"""
-    client = get_redis_client()
+    def approve_requests(self, chatroom_id, request_ids):
+        """Approve join requests and announce the new users in one message"""
+        approved = self.update_request_statuses(request_ids, "approved")
+        if not approved:
+            return []
+        
+        usernames = [request["username"] for request in approved]
+        if len(usernames) == 1:
+            notice = f"{usernames[0]} has joined the chatroom"
+        else:
+            notice = f"{', '.join(usernames[:-1])} and {usernames[-1]} have joined the chatroom"
+        
+        # Send system message
+        self.send_message(chatroom_id, "SYSTEM", notice, "system")
+        
+        return approved
     
-    # Get request data
-    request_data = client.get(f"{REQUEST_PREFIX}{request_id}")
+    def reject_requests(self, request_ids):
+        """Reject join requests"""
+        return self.update_request_statuses(request_ids, "rejected")
     
-    if not request_data:
-        return None
+    @timed("wait_for_request_status")
+    def wait_for_request_status(self, request_id, timeout=2):
+        """
+        Block until a join request is approved or rejected
+        
+        Returns "approved" or "rejected", "pending" if nothing happened within
+        the timeout (in seconds), or None if the request no longer exists
+        """
+        client = self.client
+        
+        # The decision may have been made before we started waiting
+        request_data = client.get(f"{REQUEST_PREFIX}{request_id}")
+        
+        if not request_data:
+            return None
+        
+        status = decode_record(request_data)["status"]
+        if status != "pending":
+            return status
+        
+        # Wait for update_request_status to push the decision
+        result = client.blpop(f"{REQUEST_PREFIX}status:{request_id}", timeout=timeout)
+        
+        if not result:
+            return "pending"
+        
+        return result[1].decode('utf-8')
     
-    request = json.loads(request_data)
+    @timed("cancel_join_request")
+    def cancel_join_request(self, request_id):
+        """Withdraw a pending join request"""
+        client = self.client
+        
+        # Get request data
+        request_data = client.get(f"{REQUEST_PREFIX}{request_id}")
+        
+        if not request_data:
+            return None
+        
+        request = decode_record(request_data)
+        
+        pipe = client.pipeline()
+        pipe.delete(f"{REQUEST_PREFIX}{request_id}", f"{REQUEST_PREFIX}status:{request_id}")
+        pipe.srem(f"{REQUEST_PREFIX}pending:{request['chatroom_id']}", request_id)
+        
+        # Publish event for real-time updates
+        pipe.publish(f"join-requests:{request['chatroom_id']}", json.dumps(stamp_event({
+            "type": "cancelled",
+            "request_id": request_id,
+            "username": request["username"]
+        })))
+        pipe.execute()
+        
+        return request
     
-    # Update status
-    request["status"] = status
-    client.set(f"{REQUEST_PREFIX}{request_id}", json.dumps(request))
+    # ----- Room access tokens -----
     
-    # If approved or rejected, remove from pending
-    if status in ["approved", "rejected"]:
-        client.srem(f"{REQUEST_PREFIX}pending:{request['chatroom_id']}", request_id)
+    @timed("issue_room_token")
+    def issue_room_token(self, chatroom_id, username, grant):
+        """
+        Return a token letting username use one room (e.g. over the gateway)
+        
+        grant names what the access was given for ("host:<session>",
+        "request:<id>"); asking again for the same grant returns the same token.
+        """
+        token = token_urlsafe(32)
+        record = self.codec.encode({"chatroom_id": chatroom_id, "username": username})
+        issued = self.client.eval(
+            ISSUE_TOKEN_SCRIPT,
+            2,
+            f"{TOKEN_PREFIX}grant:{grant}",
+            f"{TOKEN_PREFIX}{token}",
+            token,
+            record,
+            CHATROOM_EXPIRY
+        )
+        return issued.decode("utf-8") if isinstance(issued, bytes) else issued
     
-    # Publish event for real-time updates
-    client.publish(f"join-requests:{request['chatroom_id']}", json.dumps({
-        "type": "status_update",
-        "request_id": request_id,
-        "username": request["username"],
-        "status": status
-    }))
+    def request_token(self, request_id):
+        """Return the room token of an approved join request, or None if it isn't approved"""
+        request_data = self.client.get(f"{REQUEST_PREFIX}{request_id}")
+        if not request_data:
+            return None
+        
+        request = decode_record(request_data)
+        if request["status"] != "approved":
+            return None
+        return self.issue_room_token(request["chatroom_id"], request["username"], f"request:{request_id}")
     
-    return request
-
-def send_message(chatroom_id, username, content, message_type="user"):
-    """Send a message to a chatroom"""
-    client = get_redis_client()
+    @timed("check_room_token")
+    def check_room_token(self, token, chatroom_id):
+        """Return the username a token grants access to a room as, or None"""
+        if not token:
+            return None
+        record = self.client.get(f"{TOKEN_PREFIX}{token}")
+        if not record:
+            return None
+        
+        grant = decode_record(record)
+        if grant["chatroom_id"] != chatroom_id:
+            return None
+        return grant["username"]
     
-    # Generate a unique message ID
-    message_id = str(uuid.uuid4())
+    # ----- Messages -----
     
-    # Create message data
-    message_data = {
-        "id": message_id,
-        "chatroom_id": chatroom_id,
-        "username": username,
-        "content": content,
-        "type": message_type,
-        "created_at": datetime.now().isoformat()
-    }
+    @timed("send_message")
+    def send_message(self, chatroom_id, username, content, message_type="user", idempotency_key=None, attachment=None, message_id=None, closing=False):
+        """
+        Send a message to a chatroom
+        
+        Repeated calls with the same idempotency_key do not post the message
+        again; they return the original message (or None if its record has
+        since expired or been archived).
+        Large contents are stored compressed; raises MessageTooLarge above
+        MAX_MESSAGE_BYTES, and RoomClosed once the room is closed (closing
+        posts the room's closing notice regardless). attachment is the
+        metadata of an image stored with send_attachment, which also picks
+        the message_id.
+        """
+        client = self.client
+        
+        # Enforce the size limit before anything is written
+        stored_content, compression = pack_content(content)
+        
+        # Generate a unique message ID
+        message_id = message_id or str(uuid.uuid4())
+        
+        # Create message data
+        message_data = {
+            "id": message_id,
+            "chatroom_id": chatroom_id,
+            "username": username,
+            "content": stored_content,
+            "type": message_type,
+            "created_at": datetime.now().isoformat()
+        }
+        if compression:
+            message_data["compression"] = compression
+        if attachment:
+            message_data["attachment"] = attachment
+        
+        keys = [
+            f"{MESSAGE_PREFIX}seq:{chatroom_id}",
+            f"{MESSAGE_PREFIX}seq-index:{chatroom_id}",
+            f"{MESSAGE_PREFIX}{message_id}",
+            ROOMS_ACTIVE_KEY,
+            ROOMS_BUSY_KEY,
+            f"{MESSAGE_PREFIX}list:{chatroom_id}",
+            f"{SNAPSHOT_PREFIX}{chatroom_id}",
+            f"{SNAPSHOT_PREFIX}seq:{chatroom_id}",
+            f"{CHATROOM_PREFIX}closed:{chatroom_id}"
+        ]
+        # Retries of the same user action reuse the first message; the key is
+        # only claimed together with the write, so a failed write never leaves
+        # a claim behind
+        if idempotency_key:
+            keys.append(f"{IDEMPOTENCY_PREFIX}message:{chatroom_id}:{idempotency_key}")
+        
+        # Store in Redis with expiration (same as chatroom) under the room's
+        # next sequence number, which Redis assigns so every node agrees on it
+        seq = client.eval(
+            SEND_MESSAGE_SCRIPT,
+            len(keys),
+            *keys,
+            message_id,
+            self.codec.encode(message_data),
+            CHATROOM_EXPIRY,
+            time.time(),
+            chatroom_id,
+            IDEMPOTENCY_EXPIRY,
+            "1" if closing else ""
+        )
+        if seq == 0:
+            raise RoomClosed("This chatroom has been closed")
+        if isinstance(seq, bytes):
+            return self._posted_message(chatroom_id, seq.decode("utf-8"))
+        message_data["seq"] = seq
+        
+        # Keep the rendered snapshot of recent messages up to date
+        self.update_message_snapshot(chatroom_id, message_data, seq)
+        
+        # Publish event for real-time updates
+        client.publish(f"messages:{chatroom_id}", json.dumps(stamp_event(message_data, seq)))
+        
+        return message_data
     
-    # Store in Redis with expiration (same as chatroom)
-    key = f"{MESSAGE_PREFIX}{message_id}"
-    client.set(key, json.dumps(message_data))
-    client.expire(key, CHATROOM_EXPIRY)
+    def _posted_message(self, chatroom_id, message_id):
+        """Return an already posted message with its seq, or None if its record is gone"""
+        pipe = self.client.pipeline()
+        pipe.get(f"{MESSAGE_PREFIX}{message_id}")
+        pipe.zscore(f"{MESSAGE_PREFIX}seq-index:{chatroom_id}", message_id)
+        message_data, seq = pipe.execute()
+        if not message_data:
+            return None
+        
+        message = decode_record(message_data)
+        # Messages from before the seq index (not migrated yet) have no seq
+        if seq is not None:
+            message["seq"] = int(seq)
+        return message
     
-    # Add to messages list for this chatroom
-    client.rpush(f"{MESSAGE_PREFIX}list:{chatroom_id}", message_id)
+    @timed("send_attachment")
+    def send_attachment(self, chatroom_id, username, image, prepared, caption="", idempotency_key=None):
+        """
+        Store an image and its thumbnail and post a message pointing to them
+        
+        prepared is the result of utils.attachments.prepare_attachment. Both
+        images expire with the room; raises MessageTooLarge when the thumbnail
+        is too big or the room's attachment quota would be exceeded.
+        
+        Repeated calls with the same idempotency_key store nothing and return
+        the first upload's message (or None while it is in flight). If a step
+        fails, the quota is refunded and the stored images are deleted.
+        """
+        client = self.client
+        
+        if len(prepared["thumbnail"]) > MAX_THUMBNAIL_BYTES:
+            raise MessageTooLarge(f"Thumbnail is {len(prepared['thumbnail'])} bytes; the limit is {MAX_THUMBNAIL_BYTES}")
+        
+        # Claim the key before anything is charged or stored, so a retry costs nothing
+        attachment_id = str(uuid.uuid4())
+        claim_scope = f"attachment:{chatroom_id}"
+        if idempotency_key and self.claim_idempotency_key(claim_scope, idempotency_key, attachment_id):
+            message_id = client.get(f"{IDEMPOTENCY_PREFIX}message:{chatroom_id}:{idempotency_key}")
+            return self._posted_message(chatroom_id, message_id.decode("utf-8")) if message_id else None
+        
+        # Attachments live exactly as long as the room
+        ttl = client.ttl(f"{CHATROOM_PREFIX}{chatroom_id}")
+        if ttl <= 0:
+            ttl = CHATROOM_EXPIRY
+        
+        # Reserve the bytes against the room's quota before storing anything
+        size = len(image) + len(prepared["thumbnail"])
+        quota_key = f"{ATTACHMENT_PREFIX}bytes:{chatroom_id}"
+        pipe = client.pipeline()
+        pipe.incrby(quota_key, size)
+        pipe.expire(quota_key, ttl)
+        used, _ = pipe.execute()
+        if used > MAX_ROOM_ATTACHMENT_BYTES:
+            client.decrby(quota_key, size)
+            if idempotency_key:
+                self.release_idempotency_key(claim_scope, idempotency_key, attachment_id)
+            raise MessageTooLarge(f"This room's {MAX_ROOM_ATTACHMENT_BYTES} bytes of attachment space are used up")
+        
+        image_keys = [f"{ATTACHMENT_PREFIX}{attachment_id}", f"{ATTACHMENT_PREFIX}thumb:{attachment_id}"]
+        message_id = str(uuid.uuid4())
+        try:
+            pipe = client.pipeline()
+            for key, data, mime in (
+                (image_keys[0], image, prepared["image_type"]),
+                (image_keys[1], prepared["thumbnail"], prepared["thumbnail_type"])
+            ):
+                pipe.hset(key, mapping={"type": mime, "data": data, "chatroom_id": chatroom_id})
+                pipe.expire(key, ttl)
+            pipe.execute()
+            
+            message = self.send_message(
+                chatroom_id,
+                username,
+                caption,
+                idempotency_key=idempotency_key,
+                attachment={
+                    "id": attachment_id,
+                    "type": prepared["image_type"],
+                    "width": prepared["width"],
+                    "height": prepared["height"],
+                    "bytes": len(image)
+                },
+                message_id=message_id
+            )
+        except Exception:
+            # A step after the message was posted (e.g. publishing) failed:
+            # the images are in use, so only an unposted upload is undone
+            if not self._message_posted(message_id):
+                self._discard_attachment(quota_key, size, image_keys)
+                if idempotency_key:
+                    self.release_idempotency_key(claim_scope, idempotency_key, attachment_id)
+            raise
+        
+        # The key was already used for another message: this upload isn't referenced
+        if not message or (message.get("attachment") or {}).get("id") != attachment_id:
+            self._discard_attachment(quota_key, size, image_keys)
+        return message
     
-    # Publish event for real-time updates
-    client.publish(f"messages:{chatroom_id}", json.dumps(message_data))
+    def _message_posted(self, message_id):
+        """Whether a message was stored (assumed so if Redis can't tell us)"""
+        try:
+            return bool(self.client.exists(f"{MESSAGE_PREFIX}{message_id}"))
+        except Exception as e:
+            print(f"Error checking message {message_id}: {e}")
+            return True
     
-    return message_data
-
-def get_messages(chatroom_id, limit=50):
-    """Get messages for a chatroom"""
-    client = get_redis_client()
+    def _discard_attachment(self, quota_key, size, image_keys):
+        """Refund an upload's quota and delete whatever of it was stored"""
+        try:
+            pipe = self.client.pipeline()
+            pipe.decrby(quota_key, size)
+            pipe.unlink(*image_keys)
+            pipe.execute()
+        except Exception as e:
+            print(f"Error discarding attachment {image_keys[0]}: {e}")
     
-    # Get the last 'limit' message IDs
-    message_ids = client.lrange(f"{MESSAGE_PREFIX}list:{chatroom_id}", -limit, -1)
+    @timed("get_attachment")
+    def get_attachment(self, attachment_id, thumbnail=False, chatroom_id=None):
+        """
+        Return (bytes, MIME type) of an attachment or its thumbnail, or None
+        
+        With chatroom_id, attachments posted in other rooms are not returned
+        """
+        key = f"{ATTACHMENT_PREFIX}thumb:{attachment_id}" if thumbnail else f"{ATTACHMENT_PREFIX}{attachment_id}"
+        stored = self.client.hgetall(key)
+        if not stored:
+            return None
+        if chatroom_id is not None and stored.get(b"chatroom_id", b"").decode("utf-8") != chatroom_id:
+            return None
+        return stored[b"data"], stored[b"type"].decode("utf-8")
     
-    if not message_ids:
-        return []
+    @timed("get_messages")
+    def get_messages(self, chatroom_id, limit=50):
+        """Get the last `limit` messages of a chatroom, in sequence order"""
+        pipe = self.client.pipeline()
+        pipe.zrange(f"{MESSAGE_PREFIX}seq-index:{chatroom_id}", -limit, -1, withscores=True)
+        pipe.exists(f"{ARCHIVE_PREFIX}{chatroom_id}")
+        pipe.exists(f"{MESSAGE_PREFIX}list:{chatroom_id}")
+        entries, archived, legacy = pipe.execute()
+        if legacy:
+            self.migrate_legacy_messages(chatroom_id)
+            return self.get_messages(chatroom_id, limit)
+        
+        return self._with_archive(chatroom_id, entries, archived, limit=limit)
     
-    # Get message data for each ID
-    messages = []
-    for msg_id in message_ids:
-        msg_id = msg_id.decode('utf-8')
-        message_data = client.get(f"{MESSAGE_PREFIX}{msg_id}")
-        if message_data:
-            messages.append(json.loads(message_data))
+    @timed("get_messages_since")
+    def get_messages_since(self, chatroom_id, seq):
+        """Get the messages sent after the given sequence number"""
+        pipe = self.client.pipeline()
+        pipe.zrangebyscore(f"{MESSAGE_PREFIX}seq-index:{chatroom_id}", f"({seq}", "+inf", withscores=True)
+        pipe.exists(f"{ARCHIVE_PREFIX}{chatroom_id}")
+        pipe.exists(f"{MESSAGE_PREFIX}list:{chatroom_id}")
+        entries, archived, legacy = pipe.execute()
+        if legacy:
+            self.migrate_legacy_messages(chatroom_id)
+            return self.get_messages_since(chatroom_id, seq)
+        
+        return self._with_archive(chatroom_id, entries, archived, after_seq=seq)
     
-    # Sort by created_at
-    messages.sort(key=lambda x: x["created_at"])
+    def _with_archive(self, chatroom_id, entries, archived, after_seq=0, limit=None):
+        """
+        Load indexed messages, preceded by archived ones if the room has an archive
+        
+        Archived messages all come before the indexed ones; with a limit, only
+        the newest `limit` messages overall are returned
+        """
+        messages = self._load_messages(entries)
+        if not archived or (limit is not None and len(messages) >= limit):
+            return messages
+        
+        archived_messages = self._iter_archive(chatroom_id, after_seq)
+        if limit is not None:
+            archived_messages = deque(archived_messages, maxlen=limit - len(messages))
+        return list(archived_messages) + messages
     
-    return messages
-
-def close_chatroom(chatroom_id):
-    """Mark a chatroom as inactive"""
-    client = get_redis_client()
+    def iter_messages(self, chatroom_id, page_size=EXPORT_PAGE_SIZE):
+        """Yield every message of a chatroom in sequence order, one page at a time"""
+        self.migrate_legacy_messages(chatroom_id)
+        
+        # Archived messages (of a closed room) come first
+        seq = 0
+        for message in self._iter_archive(chatroom_id):
+            seq = message["seq"]
+            yield message
+        
+        while True:
+            entries = self.client.zrangebyscore(
+                f"{MESSAGE_PREFIX}seq-index:{chatroom_id}",
+                f"({seq}",
+                "+inf",
+                start=0,
+                num=page_size,
+                withscores=True
+            )
+            yield from self._load_messages(entries)
+            
+            if len(entries) < page_size:
+                return
+            seq = int(entries[-1][1])
     
-    # Get chatroom data
-    chatroom_data = client.get(f"{CHATROOM_PREFIX}{chatroom_id}")
+    def export_transcript(self, chatroom_id, transcript_format="ndjson"):
+        """
+        Yield a chatroom's full history as NDJSON or plain text lines
+        
+        Only one page of messages is held in memory at a time, however long
+        the history is
+        """
+        if transcript_format not in TRANSCRIPT_FORMATS:
+            raise ValueError(f"Unknown transcript format {transcript_format!r}")
+        
+        for message in self.iter_messages(chatroom_id):
+            if transcript_format == "ndjson":
+                yield json.dumps(inflate_message(message)) + "\n"
+            elif message["type"] == "system":
+                yield f"[{message['created_at']}] * {message_content(message)}\n"
+            else:
+                yield f"[{message['created_at']}] {message['username']}: {message_content(message)}\n"
     
-    if not chatroom_data:
-        return None
+    @timed("migrate_legacy_messages")
+    def migrate_legacy_messages(self, chatroom_id):
+        """
+        Move a room's pre-sequence message list into its sequence index
+        
+        Runs at most once per room: sending a message does the same inside
+        its script, and reads run it when they see the old list. Returns the
+        number of messages migrated.
+        """
+        return self.client.eval(
+            MIGRATE_LEGACY_SCRIPT,
+            5,
+            f"{MESSAGE_PREFIX}list:{chatroom_id}",
+            f"{MESSAGE_PREFIX}seq:{chatroom_id}",
+            f"{MESSAGE_PREFIX}seq-index:{chatroom_id}",
+            f"{SNAPSHOT_PREFIX}{chatroom_id}",
+            f"{SNAPSHOT_PREFIX}seq:{chatroom_id}",
+            CHATROOM_EXPIRY
+        )
     
-    chatroom = json.loads(chatroom_data)
+    def _load_messages(self, entries):
+        """
+        Fetch message records for (id, seq) index entries in a single round trip
+        
+        Each record gets its sequence number, so clients can spot gaps
+        """
+        if not entries:
+            return []
+        
+        keys = [f"{MESSAGE_PREFIX}{msg_id.decode('utf-8')}" for msg_id, _ in entries]
+        messages = []
+        for (_, seq), data in zip(entries, self.client.mget(keys)):
+            if data:
+                message = decode_record(data)
+                message["seq"] = int(seq)
+                messages.append(message)
+        return messages
     
-    # Update active status
-    chatroom["is_active"] = False
-    client.set(f"{CHATROOM_PREFIX}{chatroom_id}", json.dumps(chatroom))
+    # ----- Snapshots -----
     
-    # Publish event for real-time updates
-    client.publish(f"chatroom:{chatroom_id}", json.dumps({
-        "type": "closed"
-    }))
+    def _store_message_snapshot(self, chatroom_id, seq, messages):
+        """Write a compressed snapshot unless a newer one is already stored"""
+        blob = zlib.compress(json.dumps({"seq": seq, "messages": messages}).encode("utf-8"))
+        self.client.eval(
+            STORE_SNAPSHOT_SCRIPT,
+            2,
+            f"{SNAPSHOT_PREFIX}{chatroom_id}",
+            f"{SNAPSHOT_PREFIX}seq:{chatroom_id}",
+            seq,
+            blob,
+            CHATROOM_EXPIRY
+        )
     
-    return chatroom
-
-# ----- Real-time message subscription (uses thread-safe callback) -----
-
-def listen_for_messages(chatroom_id, callback):
-    """
-    Listen for new messages in a chatroom
+    @timed("rebuild_message_snapshot")
+    def rebuild_message_snapshot(self, chatroom_id):
+        """Rebuild a room's snapshot from its sequence index (and archive)"""
+        pipe = self.client.pipeline()
+        pipe.get(f"{MESSAGE_PREFIX}seq:{chatroom_id}")
+        pipe.zrange(f"{MESSAGE_PREFIX}seq-index:{chatroom_id}", -SNAPSHOT_SIZE, -1, withscores=True)
+        pipe.exists(f"{ARCHIVE_PREFIX}{chatroom_id}")
+        pipe.exists(f"{MESSAGE_PREFIX}list:{chatroom_id}")
+        seq, entries, archived, legacy = pipe.execute()
+        if legacy:
+            self.migrate_legacy_messages(chatroom_id)
+            return self.rebuild_message_snapshot(chatroom_id)
+        seq = int(seq or 0)
+        
+        messages = self._with_archive(chatroom_id, entries, archived, limit=SNAPSHOT_SIZE)
+        self._store_message_snapshot(chatroom_id, seq, messages)
+        
+        return {
+            "seq": seq,
+            "messages": messages
+        }
     
-    This should be run in a separate thread
-    """
-    client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
-    pubsub = client.pubsub()
+    def update_message_snapshot(self, chatroom_id, message_data, seq):
+        """Append a newly sent message to the room's snapshot"""
+        snapshot_data = self.client.get(f"{SNAPSHOT_PREFIX}{chatroom_id}")
+        
+        # Rebuild if the snapshot is missing or we missed a message in between
+        record_cache("snapshot", bool(snapshot_data))
+        if not snapshot_data:
+            return self.rebuild_message_snapshot(chatroom_id)
+        
+        snapshot = json.loads(zlib.decompress(snapshot_data))
+        if snapshot["seq"] != seq - 1:
+            return self.rebuild_message_snapshot(chatroom_id)
+        
+        messages = (snapshot["messages"] + [message_data])[-SNAPSHOT_SIZE:]
+        self._store_message_snapshot(chatroom_id, seq, messages)
+        
+        return {
+            "seq": seq,
+            "messages": messages
+        }
+    
+    @timed("get_message_snapshot")
+    def get_message_snapshot(self, chatroom_id):
+        """
+        Get the snapshot of a room's recent messages
+        
+        Returns a dict with the message sequence the snapshot was built at and
+        up to SNAPSHOT_SIZE messages; the snapshot is rebuilt if it is missing
+        """
+        snapshot_data = self.client.get(f"{SNAPSHOT_PREFIX}{chatroom_id}")
+        
+        record_cache("snapshot", bool(snapshot_data))
+        if not snapshot_data:
+            return self.rebuild_message_snapshot(chatroom_id)
+        
+        return json.loads(zlib.decompress(snapshot_data))
+    
+    # ----- Real-time events (uses thread-safe callback) -----
     
-    # Subscribe to messages channel
-    pubsub.subscribe(f"messages:{chatroom_id}")
+    def _listen(self, channel, callback):
+        """Call callback with every event published on a channel"""
+        pubsub = self.client.pubsub()
+        
+        # Subscribe to the channel
+        pubsub.subscribe(channel)
+        
+        # Listen for messages
+        for message in pubsub.listen():
+            if message["type"] == "message":
+                try:
+                    data = json.loads(message["data"])
+                    callback(data)
+                except Exception as e:
+                    print(f"Error processing event on {channel}: {e}")
+        
+        pubsub.unsubscribe()
     
-    # Listen for messages
-    for message in pubsub.listen():
-        if message["type"] == "message":
-            try:
-                data = json.loads(message["data"])
-                callback(data)
-            except Exception as e:
-                print(f"Error processing message: {e}")
+    def listen_for_messages(self, chatroom_id, callback):
+        """
+        Listen for new messages in a chatroom
+        
+        This should be run in a separate thread
+        """
+        self._listen(f"messages:{chatroom_id}", callback)
     
-    pubsub.unsubscribe()
+    def listen_for_requests(self, chatroom_id, callback):
+        """
+        Listen for new join requests in a chatroom
+        
+        This should be run in a separate thread
+        """
+        self._listen(f"join-requests:{chatroom_id}", callback)
+
+# Chat service singleton
+@functools.lru_cache(maxsize=None)
+def get_chat_service():
+    """Return the chat service bound to the shared Redis client"""
+    return ChatService(get_redis_client())
+
+# ----- Module-level API used by the Streamlit pages -----
+
+def create_chatroom(name, host_name):
+    """Create a new chatroom and return its code and ID"""
+    return get_chat_service().create_chatroom(name, host_name)
+
+def get_chatroom_by_code(code):
+    """Retrieve a chatroom by its code"""
+    return get_chat_service().get_chatroom_by_code(code)
+
+def leave_chatroom(chatroom_id, username):
+    """Announce that a user has left the chatroom"""
+    return get_chat_service().leave_chatroom(chatroom_id, username)
+
+def close_chatroom(chatroom_id):
+    """Mark a chatroom as inactive"""
+    return get_chat_service().close_chatroom(chatroom_id)
+
+def get_presence(chatroom_id, limit=PRESENCE_LIST_SIZE):
+    """Return who is online in a chatroom"""
+    return get_chat_service().get_presence(chatroom_id, limit)
+
+def busiest_rooms(limit=10):
+    """Return the open rooms with the most messages"""
+    return get_chat_service().busiest_rooms(limit)
+
+def idle_rooms(idle_seconds, limit=100):
+    """Return the open rooms idle longer than idle_seconds"""
+    return get_chat_service().idle_rooms(idle_seconds, limit)
+
+def room_counts(idle_seconds):
+    """Count the open rooms and the idle ones"""
+    return get_chat_service().room_counts(idle_seconds)
+
+def room_directory(limit=50):
+    """Return the most recently active open rooms"""
+    return get_chat_service().room_directory(limit)
+
+def reap_idle_rooms(idle_seconds, limit=100):
+    """Close rooms idle longer than idle_seconds"""
+    return get_chat_service().reap_idle_rooms(idle_seconds, limit)
+
+def join_request(chatroom_id, username, idempotency_key=None):
+    """Create a join request for a user"""
+    return get_chat_service().join_request(chatroom_id, username, idempotency_key)
+
+def get_pending_requests(chatroom_id):
+    """Get all pending join requests for a chatroom"""
+    return get_chat_service().get_pending_requests(chatroom_id)
+
+def update_request_status(request_id, status):
+    """Update the status of a join request"""
+    return get_chat_service().update_request_status(request_id, status)
+
+def update_request_statuses(request_ids, status):
+    """Update the status of several join requests in one batch"""
+    return get_chat_service().update_request_statuses(request_ids, status)
+
+def approve_requests(chatroom_id, request_ids):
+    """Approve join requests and announce the new users in one message"""
+    return get_chat_service().approve_requests(chatroom_id, request_ids)
+
+def reject_requests(request_ids):
+    """Reject join requests"""
+    return get_chat_service().reject_requests(request_ids)
+
+def wait_for_request_status(request_id, timeout=2):
+    """Block until a join request is approved or rejected"""
+    return get_chat_service().wait_for_request_status(request_id, timeout)
+
+def cancel_join_request(request_id):
+    """Withdraw a pending join request"""
+    return get_chat_service().cancel_join_request(request_id)
+
+def send_message(chatroom_id, username, content, message_type="user", idempotency_key=None):
+    """Send a message to a chatroom"""
+    return get_chat_service().send_message(chatroom_id, username, content, message_type, idempotency_key)
+
+def send_attachment(chatroom_id, username, image, prepared, caption="", idempotency_key=None):
+    """Store an image attachment and post a message pointing to it"""
+    return get_chat_service().send_attachment(chatroom_id, username, image, prepared, caption, idempotency_key)
+
+def issue_room_token(chatroom_id, username, grant):
+    """Return a token letting username use one room over the gateway"""
+    return get_chat_service().issue_room_token(chatroom_id, username, grant)
+
+def get_attachment(attachment_id, thumbnail=False):
+    """Return (bytes, MIME type) of an attachment or its thumbnail, or None"""
+    return get_chat_service().get_attachment(attachment_id, thumbnail)
+
+def get_messages(chatroom_id, limit=50):
+    """Get messages for a chatroom"""
+    return get_chat_service().get_messages(chatroom_id, limit)
+
+def get_messages_since(chatroom_id, seq):
+    """Get the messages sent after the given sequence number"""
+    return get_chat_service().get_messages_since(chatroom_id, seq)
+
+def get_message_snapshot(chatroom_id):
+    """Get the snapshot of a room's recent messages"""
+    return get_chat_service().get_message_snapshot(chatroom_id)
+
+def export_transcript(chatroom_id, transcript_format="ndjson"):
+    """Yield a chatroom's full history as NDJSON or plain text lines"""
+    return get_chat_service().export_transcript(chatroom_id, transcript_format)
+
+def listen_for_messages(chatroom_id, callback):
+    """Listen for new messages in a chatroom (run in a separate thread)"""
+    get_chat_service().listen_for_messages(chatroom_id, callback)
 
 def listen_for_requests(chatroom_id, callback):
-    """
-    Listen for new join requests in a chatroom
-    
-    This should be run in a separate thread
-    """
-    client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
-    pubsub = client.pubsub()
-    
-    # Subscribe to join requests channel
-    pubsub.subscribe(f"join-requests:{chatroom_id}")
-    
-    # Listen for messages
-    for message in pubsub.listen():
-        if message["type"] == "message":
-            try:
-                data = json.loads(message["data"])
-                callback(data)
-            except Exception as e:
-                print(f"Error processing request: {e}")
-    
-    pubsub.unsubscribe()
\ No newline at end of file
+    """Listen for new join requests in a chatroom (run in a separate thread)"""
+    get_chat_service().listen_for_requests(chatroom_id, callback)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+import functools
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from utils.metrics import RERUNS
+
+# Events arriving within this window (milliseconds) share a single rerun
+RERUN_COALESCE_MS = int(os.getenv("RERUN_COALESCE_MS", "150"))
+
+# Maximum number of event-driven reruns per second for one session
+RERUN_MAX_PER_SECOND = float(os.getenv("RERUN_MAX_PER_SECOND", "4"))
+
+# Drained events kept for the next run to inspect
+MAX_DELIVERED_EVENTS = 100
+
+class RerunScheduler:
+    """
+    Coalesce background events into rate-limited reruns for one session
+    
+    The first event of a burst arms a one-shot timer; when it fires, after
+    the coalescing window (and the rate cap), wake() asks for one rerun and
+    that run delivers everything queued meanwhile. Nothing polls while no
+    events arrive.
+    """
+    
+    def __init__(self, coalesce_ms=RERUN_COALESCE_MS, max_per_second=RERUN_MAX_PER_SECOND, wake=None):
+        self.window = coalesce_ms / 1000
+        self.min_interval = 1 / max_per_second if max_per_second > 0 else 0
+        self.wake = wake
+        self.reruns_triggered = 0
+        self.reruns_suppressed = 0
+        self._first_event_at = None
+        self._last_rerun_at = 0.0
+        self._timer = None
+        self._delivered = []
+        self._lock = threading.Lock()
+    
+    def notify(self):
+        """Record the arrival of an event (safe to call from listener threads)"""
+        with self._lock:
+            if self._first_event_at is None:
+                self._first_event_at = time.monotonic()
+            
+            # One timer per burst; without wake() events wait for the next run
+            if self._timer is not None or self.wake is None:
+                return
+            ready_at = max(self._first_event_at + self.window, self._last_rerun_at + self.min_interval)
+            self._timer = threading.Timer(max(ready_at - time.monotonic(), 0), self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def _fire(self):
+        with self._lock:
+            self._timer = None
+            self._last_rerun_at = time.monotonic()
+            self.reruns_triggered += 1
+        RERUNS.inc("triggered")
+        
+        try:
+            self.wake()
+        except Exception as e:
+            print(f"Error requesting a rerun: {e}")
+    
+    def deliver(self, *queues):
+        """
+        Drain the given queues for the current run to display
+        
+        Call it before the page reads what the events announce: anything
+        arriving afterwards arms a new timer, so no event is left unrendered.
+        A rerun of the session for another reason (e.g. user input) delivers
+        whatever is pending as well and cancels the timer.
+        """
+        with self._lock:
+            pending = sum(len(queue) for queue in queues)
+            if not pending:
+                return
+            for queue in queues:
+                self._delivered.extend(queue)
+                queue.clear()
+            del self._delivered[:-MAX_DELIVERED_EVENTS]
+            
+            self._first_event_at = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.reruns_suppressed += max(pending - 1, 0)
+        
+        RERUNS.inc("suppressed", amount=max(pending - 1, 0))
+    
+    def take_delivered(self):
+        """Return and forget the events drained by the last runs"""
+        with self._lock:
+            delivered, self._delivered = self._delivered, []
+        return delivered
+    
+    def stats(self):
+        """Return rerun counters for this session"""
+        return {
+            "reruns_triggered": self.reruns_triggered,
+            "reruns_suppressed": self.reruns_suppressed
+        }
+
+def request_session_rerun(session_id):
+    """Ask Streamlit to rerun a session's script (from any thread)"""
+    if not Runtime.exists():
+        return
+    
+    # Streamlit has no public call for this; it reruns sessions from its file
+    # watcher thread the same way when a source file changes
+    session_info = Runtime.instance()._session_mgr.get_active_session_info(session_id)
+    if session_info is not None:
+        session_info.session.request_rerun(None)
+
+def get_rerun_scheduler():
+    """Return the rerun scheduler for the current session"""
+    if "rerun_scheduler" not in st.session_state:
+        ctx = get_script_run_ctx()
+        wake = functools.partial(request_session_rerun, ctx.session_id) if ctx else None
+        st.session_state.rerun_scheduler = RerunScheduler(wake=wake)
+    return st.session_state.rerun_scheduler
@@ -2,6 +2,7 @@ import threading
 import time
 import streamlit as st
 from utils.redis_client import listen_for_messages, listen_for_requests
+from utils.rerun_scheduler import get_rerun_scheduler
 
 class ThreadManager:
     """Manage background threads for Redis pub/sub"""
@@ -9,12 +10,16 @@ class ThreadManager:
     @staticmethod
     def start_message_listener(chatroom_id, callback):
         """Start a thread to listen for new messages"""
+        # Hand the session's queue and rerun scheduler to the thread directly
+        if 'new_messages' not in st.session_state:
+            st.session_state.new_messages = []
+        queue = st.session_state.new_messages
+        scheduler = get_rerun_scheduler()
+        
         # Create a thread-safe wrapper for the callback
         def thread_safe_callback(data):
-            # Use session state to transfer data from thread to main thread
-            if 'new_messages' not in st.session_state:
-                st.session_state.new_messages = []
-            st.session_state.new_messages.append(data)
+            queue.append(data)
+            scheduler.notify()
         
         # Create and start thread
         thread = threading.Thread(
@@ -28,12 +33,16 @@ class ThreadManager:
     @staticmethod
     def start_request_listener(chatroom_id, callback):
         """Start a thread to listen for new join requests"""
+        # Hand the session's queue and rerun scheduler to the thread directly
+        if 'new_requests' not in st.session_state:
+            st.session_state.new_requests = []
+        queue = st.session_state.new_requests
+        scheduler = get_rerun_scheduler()
+        
         # Create a thread-safe wrapper for the callback
         def thread_safe_callback(data):
-            # Use session state to transfer data from thread to main thread
-            if 'new_requests' not in st.session_state:
-                st.session_state.new_requests = []
-            st.session_state.new_requests.append(data)
+            queue.append(data)
+            scheduler.notify()
         
         # Create and start thread
         thread = threading.Thread(
@@ -53,12 +62,6 @@ class ThreadManager:
             for message in st.session_state.new_messages:
                 # Handle message (e.g., play sound, add to chat)
                 st.session_state.message_count += 1
-            
-            # Clear the queue
-            st.session_state.new_messages = []
-            
-            # Trigger a rerun to update the UI
-            st.experimental_rerun()
         
         # Check for new join requests
         if 'new_requests' in st.session_state and st.session_state.new_requests:
@@ -67,9 +70,10 @@ class ThreadManager:
                 # Handle request (e.g., update UI, play sound)
                 if request['type'] == 'new_request':
                     st.session_state.last_request_count += 1
-            
-            # Clear the queue
-            st.session_state.new_requests = []
-            
-            # Trigger a rerun to update the UI
-            st.experimental_rerun()
\ No newline at end of file
+        
+        # Everything pending was handled by this run; later events are
+        # coalesced into a single rerun by the scheduler
+        get_rerun_scheduler().deliver(
+            st.session_state.get('new_messages', []),
+            st.session_state.get('new_requests', [])
+        )
\ No newline at end of file
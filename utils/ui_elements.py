@@ -1,8 +1,15 @@
 import streamlit as st
 import base64
+import html
+import threading
+from collections import OrderedDict
 from pathlib import Path
 import os
-import time
+from utils.profiling import record_cache
+from utils.codecs import message_content
+
+# Maximum number of rendered message fragments kept in memory per process
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "5000"))
 
 def inject_custom_css():
     """Inject custom CSS"""
@@ -33,32 +40,132 @@ def display_room_code(code):
     """Display the room code in a retro style"""
     st.markdown(f'<div class="room-code">{code}</div>', unsafe_allow_html=True)
 
-def display_chat_message(username, content, message_type="user", current_username=None):
-    """Display a chat message with appropriate styling"""
+class MessageRenderCache:
+    """Bounded LRU cache of rendered message HTML fragments
+
+    Messages never change after they are sent, so a fragment keyed by
+    room, message id and viewer perspective can be reused by every session.
+    """
+    
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return a cached fragment (or None) and mark it recently used"""
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return fragment
+    
+    def put(self, key, fragment):
+        """Store a fragment, evicting the least recently used ones"""
+        with self._lock:
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def evict_room(self, room_id):
+        """Drop every fragment of a room's messages"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == room_id]:
+                del self._entries[key]
+    
+    def __len__(self):
+        return len(self._entries)
+
+@st.cache_resource
+def get_render_cache():
+    """Return the render cache shared by all sessions of this process"""
+    return MessageRenderCache()
+
+def message_perspective(username, message_type, current_username=None):
+    """Classify a message as 'system', 'own' or 'other' for the viewer"""
     if message_type == "system":
+        return "system"
+    if current_username and username == current_username:
+        return "own"
+    return "other"
+
+def format_message_html(username, content, perspective):
+    """Format a message as an escaped HTML fragment"""
+    content = html.escape(content)
+    if perspective == "system":
+        # System message
+        return f'<div class="message system-message">{content}</div>'
+    
+    username = html.escape(username)
+    if perspective == "own":
+        # Current user's message
+        return (
+            f'<div class="message user-message">'
+            f'<span class="hot-pink-text">{username}:</span> {content}'
+            f'</div>'
+        )
+    
+    # Other user's message
+    return (
+        f'<div class="message other-message">'
+        f'<span class="cyan-text">{username}:</span> {content}'
+        f'</div>'
+    )
+
+def format_legacy_message_html(username, content, perspective):
+    """Format a message as an escaped HTML fragment in display_chat_message's style"""
+    content = html.escape(content)
+    if perspective == "system":
         # System message (join/leave notifications, etc.)
         if "left the chatroom" in content:
-            st.markdown(f'<div class="message system-message exit-message">{content}</div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="message system-message">{content}</div>', unsafe_allow_html=True)
+            return f'<div class="message system-message exit-message">{content}</div>'
+        return f'<div class="message system-message">{content}</div>'
+    
+    username = html.escape(username)
+    if perspective == "own":
+        # Current user's message
+        return (
+            f'<div class="message user-message">'
+            f'<strong class="lime-text">{username}:</strong> {content}'
+            f'</div>'
+        )
+    
+    # Other user's message
+    return (
+        f'<div class="message other-message">'
+        f'<strong class="hot-pink-text">{username}:</strong> {content}'
+        f'</div>'
+    )
+
+def render_message_html(message, current_username=None, formatter=format_message_html):
+    """Return the HTML fragment for a stored message, using the render cache"""
+    perspective = message_perspective(message["username"], message["type"], current_username)
+    key = (message.get("chatroom_id"), message["id"], perspective, formatter.__name__)
+    
+    cache = get_render_cache()
+    fragment = cache.get(key)
+    record_cache("render", fragment is not None)
+    if fragment is None:
+        # Compressed contents are only inflated here, when a fragment is built
+        fragment = formatter(message["username"], message_content(message), perspective)
+        cache.put(key, fragment)
+    return fragment
+
+def display_chat_message(username, content, message_type="user", current_username=None, message_id=None, compression=None):
+    """Display a chat message with appropriate styling"""
+    message = {"id": message_id, "username": username, "content": content, "type": message_type, "compression": compression}
+    if message_id:
+        fragment = render_message_html(message, current_username, format_legacy_message_html)
     else:
-        # User message
-        if current_username and username == current_username:
-            # Current user's message
-            st.markdown(
-                f'<div class="message user-message">'
-                f'<strong class="lime-text">{username}:</strong> {content}'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-        else:
-            # Other user's message
-            st.markdown(
-                f'<div class="message other-message">'
-                f'<strong class="hot-pink-text">{username}:</strong> {content}'
-                f'</div>',
-                unsafe_allow_html=True
-            )
+        perspective = message_perspective(username, message_type, current_username)
+        fragment = format_legacy_message_html(username, message_content(message), perspective)
+    st.markdown(fragment, unsafe_allow_html=True)
 
 def display_join_request(username, request_id, approve_callback, reject_callback):
     """Display a join request with approve/reject buttons"""
@@ -179,7 +286,6 @@ def create_retro_animation():
     <div style="font-family: 'Press Start 2P', cursive; font-size: 24px; color: #00fff9; text-shadow: 0 0 5px #00fff9, 0 0 10px #00fff9; margin: 20px 0;" class="loading">LOADING</div>
     """
     st.markdown(animation, unsafe_allow_html=True)
-    time.sleep(1.5)  # Simulate loading
 
 def create_retro_footer():
     """Create a retro-styled footer"""